@@ -1,7 +1,7 @@
 import io
 import json
-import os
 from pathlib import Path
+from datetime import datetime
 from contextlib import redirect_stdout
 import pandas as pd
 import plotly.io as pio
@@ -11,12 +11,22 @@ import plotly.graph_objects as go
 import matplotlib.pyplot as plt
 import streamlit as st
 from reason_agents import DfCodeAgent, DfOaCodeAgent
-from functions import check_api_key
+from credentials import key_validator
+from caching import default_cache
+from executor import ExecutionEngine
+from ingest import load_table, format_report, UPLOAD_TYPES
+from backends import DuckDbDataset
+from clients import client_registry
+from datastore import dataset_store, content_hash
+from catalog import DatasetCatalog
+from intents import default_matcher
+from sessions import save_session, load_session, list_sessions, session_path
 
 # otherwise black and white plots are displayed
 pio.templates.default = "plotly"
-PLOT = "temp_fig.json"
-PLOT_DIR = "./app/plots"
+UPLOAD_DIR = "./app/cache/uploads"
+# tables the code can use next to the upload
+DATA_DIR = "./app/data"
 
 # for checking the api key, set session variables
 if "api_key" not in st.session_state:
@@ -31,6 +41,9 @@ if "key_resp" not in st.session_state:
 if "df" not in st.session_state:
     st.session_state.df = None
 
+if "engine" not in st.session_state:
+    st.session_state.engine = None
+
 
 def submit():
     # api key session value takes the widget value
@@ -38,9 +51,60 @@ def submit():
     # st.session_state.widget = ""  # aftter that, delete the value from input widget
 
 
+def stream_response(agent, question):
+    """Show the code and the explanation while the model writes them. The preview is
+    replaced by the usual rendering once the code ran."""
+    box = st.empty()
+    parts = {"answer": "", "explanation": ""}
+    resp = None
+
+    for event in agent.generate_content_stream(question):
+        if event["type"] == "delta":
+            parts[event["field"]] += event["text"]
+            with box.container():
+                if parts["answer"]:
+                    st.code(parts["answer"])
+                if parts["explanation"]:
+                    st.markdown(parts["explanation"])
+        else:
+            resp = event["result"]
+
+    box.empty()
+    return resp
+
+
+@st.fragment(run_every=1)
+def wait_for_key(api_key, which):
+    # poll the background check and redraw the page once the verdict is known
+    if key_validator().status(api_key=api_key, which=which) is not None:
+        st.rerun()
+
+
 def refresh_df():
     # refresh df if the value in upload_file changes
-    st.session_state.df = pd.read_csv(st.session_state.uploaded_file)
+    upload = st.session_state.uploaded_file
+    if upload is None:
+        return
+
+    if st.session_state.backend == "duckdb":
+        # the data stays on disk, only query results are loaded. The folder is the
+        # hash of the content (the key of `datastore`): sessions uploading a file
+        # with the same name do not overwrite each other, the same file is kept once
+        path = Path(UPLOAD_DIR, content_hash(upload), Path(upload.name).name)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_bytes(upload.getbuffer())
+            tmp.replace(path)
+        st.session_state.df = DuckDbDataset(path)
+        st.session_state.load_report = None
+        return
+
+    # the sessions that upload the same file share one loaded copy
+    store = dataset_store()
+    key = store.put(upload)
+    st.session_state.df = store.acquire(key)
+    st.session_state.load_report = store.report(key)
     st.session_state.columns = st.session_state.df.columns.to_list()  # refresh columns
 
 
@@ -67,50 +131,302 @@ with st.sidebar:
     )
 
     if st.session_state.api_key:
-        # test if a call to the model is successful using the api key
-        st.session_state.key_resp = check_api_key(
+        # the key is checked once in the background, reruns only read the verdict
+        key_resp = key_validator().status(
             api_key=st.session_state.api_key, which=select_llm
         )
+        st.session_state.key_resp = key_resp or "pending"
+        st.session_state.valid = st.session_state.key_resp == "valid_key"
 
         if st.session_state.key_resp == "invalid_key":
             st.markdown(""":red[The key is invalid. Try again]""")
         elif st.session_state.key_resp == "valid_key":
             st.markdown(""":green[The key is valid]""")
-            st.session_state.valid = True
         elif st.session_state.key_resp == "empty_key":
             st.markdown(""":orange[The key is empty]""")
+        elif st.session_state.key_resp == "pending":
+            st.markdown(""":gray[Checking the key...]""")
+            wait_for_key(st.session_state.api_key, select_llm)
         else:
             st.markdown(f""":orange[{st.session_state.key_resp}]""")
 
+    use_cache = st.checkbox(
+        "Reuse cached answers",
+        value=True,
+        help="Same question on the same columns is answered without calling the model",
+    )
+
+    local_answers = st.checkbox(
+        "Answer common questions locally",
+        value=True,
+        help="Column names, types, missing values, unique values, descriptions and "
+        "correlations are answered from templates, without calling the model",
+    )
+
+    vectorize = st.checkbox(
+        "Vectorize loops",
+        value=True,
+        help="Row by row loops of the code (iterrows, apply with axis=1...) are "
+        "rewritten with column operations when the results are the same",
+    )
+
+    isolated = st.checkbox(
+        "Run code in a separate process",
+        value=False,
+        help="Code running over 2 minutes or 4 GB is stopped, and long runs do "
+        "not block the other users",
+    )
+    if isolated and st.session_state.engine is None:
+        st.session_state.engine = ExecutionEngine(timeout=120, memory_limit_mb=4096)
+    elif not isolated and st.session_state.engine is not None:
+        # the worker processes are not kept for a session that does not use them
+        st.session_state.engine.close()
+        st.session_state.engine = None
+
+    max_points = st.number_input(
+        "Plot point budget",
+        min_value=1_000,
+        value=50_000,
+        step=10_000,
+        help="Larger plots are binned, summarized or downsampled before they are drawn",
+    )
+
+    execution = st.radio(
+        "Run the code on",
+        ("full data", "sample first", "sample, then ask"),
+        help="The sample shows results (and errors) in a moment, "
+        "errors on the sample never touch the full data",
+    )
+
+    st.selectbox(
+        "Data engine",
+        ("pandas", "duckdb"),
+        key="backend",
+        help="duckdb keeps the data on disk, for files larger than the memory",
+        on_change=refresh_df,
+    )
+
     # upload csv file
     st.file_uploader(
         "Upload dataframe",
         key="uploaded_file",
-        type=["csv"],
+        type=UPLOAD_TYPES,
         accept_multiple_files=False,
         on_change=refresh_df,
     )
+    if st.session_state.get("load_report"):
+        st.caption(format_report(st.session_state.load_report))
+
+    more_tables = st.multiselect(
+        "More tables",
+        sorted(p.name for p in Path(DATA_DIR).glob("*") if p.is_file()),
+        help="The code can join or compare them with the upload. "
+        "A table is only loaded when a question needs it",
+    )
 
-if st.session_state.key_resp == "valid_key":
-    if st.session_state.df is not None:
-        if select_llm == "openai":
-            cda = DfOaCodeAgent(
+    # the data and the chat survive a restart of the app
+    with st.expander("Session"):
+        if "session_name" not in st.session_state:
+            st.session_state.session_name = datetime.now().strftime(
+                "session-%Y%m%d-%H%M"
+            )
+        session_name = st.text_input("Name", key="session_name")
+        agent = st.session_state.get("agent")
+        if st.button(
+            "Save session",
+            disabled=agent is None
+            or agent.dataset is not None
+            or not session_name.strip(),
+        ):
+            try:
+                saved = save_session(
+                    session_path(session_name), agent, st.session_state.messages
+                )
+                st.caption(f"Saved {saved['mb']:.1f} MB in {saved['seconds']:.2f}s")
+                if saved["as_text"]:
+                    st.caption("Saved as text: " + ", ".join(saved["as_text"]))
+            except Exception as e:
+                st.markdown(f":red[The session could not be saved: {e}]")
+
+        sessions = list_sessions()
+        resume = st.selectbox(
+            "Saved sessions",
+            [s["name"] for s in sessions],
+            format_func=lambda name: next(
+                "{name} ({saved}, {questions} questions)".format(**s)
+                for s in sessions
+                if s["name"] == name
+            ),
+        )
+        if st.button("Resume", disabled=resume is None):
+            session = load_session(session_path(resume))
+            st.session_state.df = session["frame"]
+            st.session_state.columns = session["frame"].columns.to_list()
+            st.session_state.messages = session["messages"]
+            # given to the agent built for the resumed frame
+            st.session_state.resume_history = session["history"]
+            st.session_state.load_report = None
+            st.caption(f"Resumed in {session['seconds']:.2f}s")
+
+
+def get_agent(which, use_cache, isolated, execution):
+    """Agent of the session. It is built once per model and dataframe so the state of
+    dff (and its versions) survives the reruns."""
+    agent_key = (
+        which,
+        st.session_state.api_key,
+        id(st.session_state.df),
+        tuple(more_tables),
+    )
+
+    if st.session_state.get("agent_key") != agent_key:
+        catalog = None
+        if more_tables:
+            catalog = DatasetCatalog([Path(DATA_DIR, name) for name in more_tables])
+        if which == "openai":
+            st.session_state.agent = DfOaCodeAgent(
                 st.session_state.df,
-                api_key=st.session_state.widget,
+                api_key=st.session_state.api_key,
                 save_plot=True,
                 model="gpt-4o",
                 diagnostics=True,
+                catalog=catalog,
             )
-        if select_llm == "gemini":
-            cda = DfCodeAgent(
-                st.session_state.df, api_key=st.session_state.widget, save_plot=True
+        if which == "gemini":
+            st.session_state.agent = DfCodeAgent(
+                st.session_state.df,
+                api_key=st.session_state.api_key,
+                save_plot=True,
+                catalog=catalog,
             )
+        st.session_state.agent.history.turns = st.session_state.pop(
+            "resume_history", []
+        )
+        st.session_state.agent_key = agent_key
+
+    agent = st.session_state.agent
+    agent.cache = default_cache() if use_cache else None
+    agent.intents = default_matcher() if local_answers else None
+    agent.vectorize = vectorize
+    agent.executor = st.session_state.engine if isolated else None
+    # "sample first" runs the full data itself once the preview is shown
+    agent.execution_mode = "full" if execution == "full data" else "confirm"
+    agent.max_points = max_points
+    return agent
+
+
+if st.session_state.key_resp == "valid_key":
+    if st.session_state.df is not None:
+        cda = get_agent(select_llm, use_cache, isolated, execution)
+
+    if st.session_state.df is not None and cda.snapshots is not None:
+        with st.sidebar:
+            st.subheader("Data versions")
+            col_undo, col_redo = st.columns(2)
+            if col_undo.button("Undo", disabled=not cda.snapshots.can_undo):
+                cda.undo()
+            if col_redo.button("Redo", disabled=not cda.snapshots.can_redo):
+                cda.redo()
+
+            versions = cda.snapshots.versions()
+            position = st.selectbox(
+                "Continue from version",
+                options=[v["position"] for v in versions],
+                index=cda.snapshots.position,
+                format_func=lambda i: "{}: {} {} (+{:.1f} MB)".format(
+                    i,
+                    versions[i]["label"][:30],
+                    versions[i]["shape"],
+                    versions[i]["own_bytes"] / 2**20,
+                ),
+            )
+            if position != cda.snapshots.position:
+                cda.checkout(position)
+                st.rerun()
 
 
 # initialize the history of the chat. all messages go here
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+
+def show_figures(figures):
+    for figure in figures:
+        if figure["kind"] == "plotly":
+            st.plotly_chart(figure["figure"])
+            if figure.get("reduction"):
+                st.caption(
+                    "Reduced from {points_before:,} to {points_after:,} points in "
+                    "{seconds:.2f}s".format(**figure["reduction"])
+                )
+        else:
+            st.image(figure["image"])
+
+
+def show_response(resp):
+    """Render the answer of the agent and keep it in the chat history."""
+    if resp is None:
+        st.markdown("The response could not be read. Try to ask again.")
+        return
+
+    model = resp["model"]
+    code_run = resp.get("code_run") or {}
+
+    if code_run.get("figures"):
+        # the figures are kept in memory, in the history of this session
+        st.session_state.messages.append(
+            {
+                "role": "assistant",
+                "type": "plot",
+                "figures": code_run["figures"],
+                "code": model["answer"],
+            }
+        )
+        show_figures(code_run["figures"])
+        st.code(model["answer"])
+
+    elif model["answer"] == "no code":
+        st.session_state.messages.append(
+            {
+                "role": "assistant",
+                "type": "text",
+                "content": model["explanation"],
+            }
+        )
+        st.markdown(model["explanation"])
+
+    elif code_run:
+        output = code_run.get("output", code_run.get("exception"))
+        st.session_state.messages.append(
+            {
+                "role": "assistant",
+                "type": "text",
+                "code_output": output,
+                "code": model["answer"],
+                "explanation": model["explanation"],
+            }
+        )
+        st.text(output)
+        st.code(model["answer"])
+        st.markdown(model["explanation"])
+
+
+def show_preview(resp):
+    """Render the run on the sample, it stays in the history until the full run."""
+    preview = resp["preview"]
+    message = {
+        "role": "assistant",
+        "type": "text",
+        "content": f"Preview on a sample of {resp['sample_rows']} rows",
+        "code_output": preview.get("output", preview.get("exception")),
+        "figures": preview.get("figures", []),
+    }
+    st.session_state.messages.append(message)
+    st.markdown(message["content"])
+    st.text(message["code_output"])
+    show_figures(message["figures"])
+
+
 # show the history
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -119,15 +435,27 @@ for message in st.session_state.messages:
                 st.markdown(message["content"])
             if message.get("code_output"):
                 st.text(message["code_output"])
+            show_figures(message.get("figures", []))
             if message.get("code"):
                 st.code(message.get("code"))
             if message.get("explanation"):
                 st.markdown(message.get("explanation"))
         else:
-            # st.image(message["content"])  # display image
+            show_figures(message["figures"])
             if message.get("code"):
                 st.code(message.get("code"))
 
+# code previewed on the sample waits for the user before it runs on the full data
+if st.session_state.get("agent") is not None and st.session_state.agent.pending:
+    with st.chat_message("assistant"):
+        st.code(st.session_state.agent.pending["response"]["answer"])
+        if st.button("Run on the full data"):
+            agent = st.session_state.agent
+            with agent.telemetry.trace("chat", model=agent.model):
+                resp = agent.run_pending()
+                with agent.telemetry.span("render"):
+                    show_response(resp)
+
 # while the api key is not valid or missing, the chat is blocked
 if prompt := st.chat_input(
     "What do you want to know?", disabled=(not st.session_state.valid)
@@ -143,89 +471,87 @@ if prompt := st.chat_input(
 
     # assistent response
     with st.chat_message("assistant"):
-        # breakpoint()
         # take question from user
         question = prompt
 
-        if PLOT in os.listdir(PLOT_DIR):
-            os.remove(Path(PLOT_DIR, PLOT))
-
-        plot_start = len(os.listdir("./app/plots"))
         try:
-            # get the response from LLM
-            # breakpoint()
-            resp = cda.generate_content(question)
-            plot_stop = len(os.listdir("./app/plots"))
+            with cda.telemetry.trace("chat", model=cda.model, question=question):
+                # get the response from LLM
+                resp = stream_response(cda, question)
 
-            # if plot_stop > plot_start:
-            if PLOT in os.listdir(PLOT_DIR):
+                with cda.telemetry.span("render"):
+                    if resp is not None and resp.get("preview"):
+                        show_preview(resp)
+                    if resp is None or not resp.get("pending"):
+                        show_response(resp)
 
-                # plot_start = plot_stop
+                if cda.pending is not None and execution == "sample first":
+                    # the preview is on screen, now the full data
+                    resp = cda.run_pending()
+                    with cda.telemetry.span("render"):
+                        show_response(resp)
 
-                # path = sorted(Path("./app/plots").glob("*.png"))[-1]
-
-                st.session_state.messages.append(
-                    {
-                        "role": "assistant",
-                        # "content": str(path),
-                        "type": "plot",
-                        "code": resp["model"]["answer"],
-                    }
-                )
-                # show the code and plot now
-                # path = list(Path("./app/plots").glob("*.json"))[0]
+            if cda.pending is not None:
+                st.rerun()
 
-                with open(Path(PLOT_DIR, PLOT), "r") as f:
-                    dct_plot = json.load(f)
-
-                st.plotly_chart(dct_plot)
-
-                st.code(resp["answer"])
-
-            else:
+        except Exception as e:
+            print(e)
 
-                if resp["model"]["answer"] == "no code":
-                    # print(resp["model"]["explanation"])
-                    st.session_state.messages.append(
+# where the seconds of the answers go
+if st.session_state.get("agent") is not None:
+    with st.sidebar.expander("Debug"):
+        telemetry = st.session_state.agent.telemetry
+        trace = telemetry.last_trace
+        if trace is not None:
+            st.caption(f"Last answer: {trace['duration']:.2f}s")
+            st.dataframe(
+                pd.DataFrame(
+                    [
                         {
-                            "role": "assistant",
-                            "type": "text",
-                            "content": resp["model"]["explanation"],
+                            "stage": span["name"],
+                            "seconds": span["duration"],
+                            "details": json.dumps(span["attributes"], default=str),
                         }
-                    )
-                    st.markdown(resp["model"]["explanation"])
-                    # st.code(resp["answer"])
-                else:
-
-                    if resp.get("code_run"):
-
-                        if resp["code_run"].get("output") is not None:
-                            st.session_state.messages.append(
-                                {
-                                    "role": "assistant",
-                                    "type": "text",
-                                    "code_output": resp["code_run"]["output"],
-                                    "code": resp["model"]["answer"],
-                                    "explanation": resp["model"]["explanation"],
-                                }
-                            )
-                            st.text(resp["code_run"]["output"])
-                            st.code(resp["model"]["answer"])
-                            st.markdown(resp["model"]["explanation"])
-                        else:
-                            # print(resp["code_run"]["exception"])
-                            st.session_state.messages.append(
-                                {
-                                    "role": "assistant",
-                                    "type": "text",
-                                    "code_output": resp["code_run"]["output"],
-                                    "code": "",
-                                    "explanation": resp["model"]["explanation"],
-                                }
-                            )
-                            st.text(resp["code_run"]["exception"])
-                            st.code(resp["model"]["answer"])
-                            st.markdown(resp["model"]["explanation"])
-
-        except Exception as e:
-            print(e)
+                        for span in trace["spans"]
+                    ]
+                ),
+                hide_index=True,
+            )
+        if telemetry.summary():
+            st.dataframe(pd.DataFrame(telemetry.summary()).set_index("stage").round(3))
+        totals = telemetry.totals()
+        if totals.get("parses"):
+            st.caption(
+                "Unreadable responses: {:.0f} of {:.0f}".format(
+                    totals.get("parse_failures", 0), totals["parses"]
+                )
+            )
+        local = totals.get("local_answers", 0)
+        if local or totals.get("local_fallbacks"):
+            asked = local + totals.get("local_fallbacks", 0)
+            stages = {stage["stage"]: stage for stage in telemetry.summary()}
+            st.caption(
+                "Answered locally: {:.0f} of {:.0f} questions ({:.0%})".format(
+                    local, asked, local / asked
+                )
+                + (
+                    ", p50 {:.3f}s".format(stages["local_answer"]["p50"])
+                    if "local_answer" in stages
+                    else ""
+                )
+            )
+        if totals.get("loops_found"):
+            st.caption(
+                "Loops rewritten: {:.0f} of {:.0f}".format(
+                    totals.get("loops_rewritten", 0), totals["loops_found"]
+                )
+            )
+        st.json(totals)
+        if st.session_state.agent.catalog is not None:
+            st.caption("More tables")
+            st.json(st.session_state.agent.catalog.stats)
+        # shared by all the sessions of the process
+        st.caption("Provider connections")
+        st.json(client_registry().stats)
+        st.caption("Shared datasets")
+        st.json(dataset_store().stats)
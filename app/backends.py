@@ -0,0 +1,197 @@
+import re
+import json
+from pathlib import Path
+from caching import CACHE_DIR, fingerprint
+from ingest import detect_format
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# columns types that are reported as numeric to the model
+NUMERIC_TYPES = (
+    "TINYINT",
+    "SMALLINT",
+    "INTEGER",
+    "BIGINT",
+    "HUGEINT",
+    "UTINYINT",
+    "USMALLINT",
+    "UINTEGER",
+    "UBIGINT",
+    "FLOAT",
+    "DOUBLE",
+    "DECIMAL",
+)
+
+DUCKDB_INSTRUCTION = """
+    # Out-of-core data (this replaces the dataframe setup above):
+
+    - **There is NO dataframe called "dff". The data is a DuckDB table called "data" stored on disk and it can be larger than the memory.
+    - **Use the function sql(query) to run DuckDB SQL. It returns the result as a pandas DataFrame.
+    - **Do the filtering, grouping and aggregation in SQL, so that only small results are returned. Results above {max_rows} rows raise an error.
+    - **For plots, aggregate or sample in SQL first (GROUP BY, approx_quantile, USING SAMPLE) and plot the pandas result with Plotly.
+    - **To transform the data (add, change or remove columns or rows) use replace_data(query). The result of the SELECT query becomes the new "data" table.
+    - **Quote column names with double quotes inside the SQL. Use single quotes for the Python string that holds the query.
+    """
+
+
+class DuckDbDataset:
+    """Dataset kept on disk and queried with DuckDB, for data larger than memory.
+
+    CSV files are converted once to Parquet in the cache folder; Parquet and
+    Feather files are queried in place through an Arrow dataset. The generated
+    code only gets `sql`, which materializes query results in pandas and refuses
+    results longer than `max_rows`, and `replace_data`, which stores the result of
+    a query as the new table (spilled to disk above the memory limit). Once the
+    table is set up the connection cannot read or write other files.
+
+    Args:
+        path (str): csv (plain, .gz or .zst), parquet or feather file.
+        max_rows (int): longest result `sql` returns.
+        memory_limit (str): DuckDB memory limit, like "4GB". Data above it spills
+            to the temporary directory.
+        sample_rows (int): rows used to profile the table.
+    """
+
+    table = "data"
+
+    def __init__(self, path, max_rows=100_000, memory_limit=None, sample_rows=100_000):
+        if duckdb is None:
+            raise ImportError(
+                "The out-of-core backend needs duckdb: pip install duckdb"
+            )
+
+        self.path = Path(path)
+        self.max_rows = max_rows
+        self.sample_rows = sample_rows
+        self.version = 0
+        self._schema = None
+        self._arrow = None
+        self._step = None
+
+        self.con = duckdb.connect(":memory:")
+        self.con.execute(
+            f"SET temp_directory = '{Path(CACHE_DIR, 'duckdb', 'tmp').as_posix()}'"
+        )
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = '{memory_limit}'")
+
+        import pyarrow.dataset as ds
+
+        fmt, compression = detect_format(self.path)
+        # the paths are passed to the readers, never put in the SQL text. The
+        # file is scanned through Arrow, DuckDB's own readers stop working once
+        # external access is off
+        if fmt == "csv":
+            self._arrow = ds.dataset(self._to_parquet(compression), format="parquet")
+        elif fmt == "parquet":
+            self._arrow = ds.dataset(str(self.path), format="parquet")
+        else:
+            self._arrow = ds.dataset(str(self.path), format="feather")
+        self.con.from_arrow(self._arrow).create_view(self.table)
+
+        # the generated SQL runs here: no read_csv('/etc/...'), COPY TO, ATTACH or
+        # INSTALL, and no SET to turn it back on
+        self.con.execute("SET enable_external_access = false")
+        self.con.execute("SET lock_configuration = true")
+
+    def _to_parquet(self, compression):
+        stat = self.path.stat()
+        target = Path(
+            CACHE_DIR,
+            "duckdb",
+            fingerprint(str(self.path.resolve()), stat.st_size, stat.st_mtime)
+            + ".parquet",
+        )
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            options = {"compression": compression} if compression else {}
+            self.con.read_csv(self.path.as_posix(), **options).write_parquet(
+                target.as_posix()
+            )
+        return target.as_posix()
+
+    def sql(self, query):
+        """Run a query and return the result as a pandas DataFrame (None for
+        statements without a result)."""
+        relation = self.con.sql(query)
+
+        if not re.match(
+            r"\s*(\(|select|with|from|summarize|describe|show|pivot)", query, re.I
+        ):
+            # the table changed, the profile is stale
+            self.version += 1
+            self._schema = None
+
+        if relation is None:
+            return None
+
+        result = relation.limit(self.max_rows + 1).df()
+        if len(result) > self.max_rows:
+            raise ValueError(
+                f"The query returns more than {self.max_rows} rows. "
+                "Aggregate, sample or add a LIMIT."
+            )
+        return result
+
+    def replace_data(self, query) -> None:
+        """Make the result of the query the new `data` table."""
+        self.version += 1
+        step = f"{self.table}_{self.version}"
+        self.con.execute(f"CREATE TABLE {step} AS {query}")
+        self.con.execute(f"CREATE OR REPLACE VIEW {self.table} AS SELECT * FROM {step}")
+        if self._step is not None:
+            self.con.execute(f"DROP TABLE IF EXISTS {self._step}")
+        self._step = step
+        self._schema = None
+
+    def namespace(self) -> dict:
+        return {"sql": self.sql, "replace_data": self.replace_data}
+
+    def instruction(self) -> str:
+        return DUCKDB_INSTRUCTION.format(max_rows=self.max_rows)
+
+    @property
+    def shape(self):
+        rows = self.con.sql(f"SELECT count(*) FROM {self.table}").fetchone()[0]
+        return rows, len(self.con.sql(f"DESCRIBE {self.table}").fetchall())
+
+    def to_prompt(self) -> str:
+        """Profile of the table in the format of `DatasetProfile.to_prompt`, from a
+        block sample of at most `sample_rows` rows."""
+        if self._schema is not None:
+            return self._schema
+
+        rows = self.shape[0]
+        percent = min(100.0, 100.0 * self.sample_rows / max(rows, 1))
+        summary = self.con.sql(
+            f"SUMMARIZE SELECT * FROM {self.table} USING SAMPLE {percent}% (system)"
+        ).fetchall()
+        approx = "~" if percent < 100 else ""
+
+        columns = {}
+        for name, ctype, lo, hi, unique, *_, count, null_pct in summary:
+            if ctype.startswith(NUMERIC_TYPES):
+                kind = "numeric"
+            elif ctype == "BOOLEAN":
+                kind = "boolean"
+            elif ctype.startswith(("DATE", "TIMESTAMP", "TIME")):
+                kind = "datetime"
+            elif unique is not None and unique <= max(20, 0.05 * (count or 0)):
+                kind = "categorical"
+            else:
+                kind = "text"
+
+            text = f"{ctype} {kind} nulls={approx}{null_pct or 0:.3g}% unique=~{unique}"
+            if kind in ("numeric", "datetime"):
+                text += f" range={approx}{lo}..{hi}"
+            elif kind in ("categorical", "boolean"):
+                text += f" e.g. {lo}|{hi}"
+            columns[name] = text
+
+        self._schema = json.dumps(
+            {"rows": rows, "table": self.table, "columns": columns}, default=str
+        )
+        return self._schema
@@ -0,0 +1,202 @@
+import json
+import time
+import asyncio
+from pathlib import Path
+from datetime import datetime
+from code_analysis import mutates_frame
+
+
+def read_questions(path) -> list:
+    """Questions from a text file, one per line (empty lines and lines starting with
+    # are skipped), or from a JSON list."""
+    text = Path(path).read_text(encoding="utf-8")
+    if Path(path).suffix == ".json":
+        return [str(q) for q in json.loads(text)]
+    return [
+        line.strip()
+        for line in text.splitlines()
+        if line.strip() and not line.lstrip().startswith("#")
+    ]
+
+
+class RateLimiter:
+    """Space the requests so no more than `per_minute` start in any minute."""
+
+    def __init__(self, per_minute=None) -> None:
+        self.interval = 60 / per_minute if per_minute else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class BatchRunner:
+    """Answer a list of questions in one go.
+
+    The model is asked about all the questions at the same time (at most
+    `concurrency` requests in flight, `per_minute` started per minute), against the
+    profile of the data before the batch. The code then runs one question at a time,
+    in their order (the sample, the history and the pyplot figures of the agent are
+    not thread safe): code that may change `dff` runs on the agent, the code that
+    only reads runs on a snapshot and leaves the agent as it was.
+
+    Args:
+        agent (DfBaseAgent): agent holding the data
+        concurrency (int): requests to the model in flight
+        per_minute (int): requests started per minute, None for no limit
+    """
+
+    def __init__(self, agent, concurrency=8, per_minute=None) -> None:
+        self.agent = agent
+        self.concurrency = concurrency
+        self.per_minute = per_minute
+
+    async def _draft(self, index, question, semaphore, limiter, drafts):
+        async with semaphore:
+            await limiter.wait()
+            start = time.perf_counter()
+            draft = {"response": None}
+            try:
+                draft["response"] = await self.agent.draft_async(question)
+            except Exception as e:
+                draft["error"] = repr(e)
+            draft["draft_seconds"] = time.perf_counter() - start
+            drafts[index] = draft
+
+    async def draft_all(self, questions) -> dict:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.per_minute)
+        drafts = {}
+        await asyncio.gather(
+            *(
+                self._draft(i, q, semaphore, limiter, drafts)
+                for i, q in enumerate(questions)
+            )
+        )
+        return drafts
+
+    def _run(self, question, response, snapshot):
+        start = time.perf_counter()
+        result = self.agent.execute(question, response, snapshot=snapshot)
+        return result, time.perf_counter() - start
+
+    def execute_all(self, questions, drafts) -> list:
+        items = [
+            {"question": q, "index": i, **drafts[i]} for i, q in enumerate(questions)
+        ]
+        # the duckdb tables have no snapshots
+        snapshots = self.agent.dataset is None
+
+        for item in items:
+            response = item["response"]
+            if response is None:
+                continue
+            reads_only = snapshots and (
+                response["answer"] == "no code" or not mutates_frame(response["answer"])
+            )
+            item["result"], item["run_seconds"] = self._run(
+                item["question"], response, reads_only
+            )
+
+        return items
+
+    def run(self, questions) -> dict:
+        start = time.perf_counter()
+        drafts = asyncio.run(self.draft_all(questions))
+        drafted = time.perf_counter()
+        items = self.execute_all(questions, drafts)
+        end = time.perf_counter()
+
+        return {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "model": self.agent.model,
+            "questions": len(questions),
+            "draft_seconds": drafted - start,
+            "run_seconds": end - drafted,
+            "wall_seconds": end - start,
+            # what asking one question after the other would have taken
+            "sequential_seconds": sum(
+                item.get("draft_seconds", 0) + item.get("run_seconds", 0)
+                for item in items
+            ),
+            "items": items,
+        }
+
+
+def write_report(report, directory) -> Path:
+    """Write report.json, report.md and the figures (plotly JSON, PNG) to the
+    directory."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    entries = []
+    lines = [
+        f"# Batch report {report['date']}",
+        "",
+        f"{report['questions']} questions with {report['model']} in "
+        f"{report['wall_seconds']:.1f}s (one after the other: "
+        f"{report['sequential_seconds']:.1f}s)",
+        "",
+    ]
+
+    for item in report["items"]:
+        number = item["index"] + 1
+        response = item.get("response") or {}
+        code_run = (item.get("result") or {}).get("code_run", {})
+
+        figures = []
+        for k, figure in enumerate(code_run.get("figures", []), start=1):
+            if figure["kind"] == "plotly":
+                name = f"q{number:03d}-{k}.json"
+                (directory / name).write_text(figure["figure"].to_json())
+            else:
+                name = f"q{number:03d}-{k}.png"
+                (directory / name).write_bytes(figure["image"])
+            figures.append(name)
+
+        entry = {
+            "number": number,
+            "question": item["question"],
+            "code": response.get("answer"),
+            "explanation": response.get("explanation"),
+            "output": code_run.get("output"),
+            "exception": code_run.get("exception", item.get("error")),
+            "figures": figures,
+            "draft_seconds": item.get("draft_seconds"),
+            "run_seconds": item.get("run_seconds"),
+        }
+        entries.append(entry)
+
+        lines += [f"## {number}. {entry['question']}", ""]
+        if not response:
+            lines += ["The response could not be read.", ""]
+            continue
+        if entry["code"] and entry["code"] != "no code":
+            lines += ["```python", entry["code"], "```", ""]
+        if entry["output"]:
+            lines += ["```", entry["output"].rstrip(), "```", ""]
+        if entry["exception"]:
+            lines += [f"**Error:** `{entry['exception']}`", ""]
+        lines += [f"Figure: [{name}]({name})" for name in figures]
+        lines += [
+            "",
+            entry["explanation"] or "",
+            "",
+            f"_Model {entry['draft_seconds'] or 0:.2f}s, run "
+            f"{entry['run_seconds'] or 0:.2f}s_",
+            "",
+        ]
+
+    summary = {k: v for k, v in report.items() if k != "items"}
+    with open(directory / "report.json", "w") as f:
+        json.dump({**summary, "items": entries}, f, indent=2, default=str)
+    (directory / "report.md").write_text("\n".join(lines), encoding="utf-8")
+    return directory
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+CACHE_DIR = "./app/cache"
+RESPONSE_DB = "responses.sqlite"
+
+
+def fingerprint(*parts) -> str:
+    """Stable sha256 hex digest of the given parts."""
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, (str, bytes)):
+            part = json.dumps(part, sort_keys=True, default=str)
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(part)
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class LRUCache:
+    """Thread safe in-memory LRU cache with optional TTL and hit/miss counters."""
+
+    def __init__(self, maxsize=256, ttl=None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, created = item
+                if self.ttl is None or time.time() - created <= self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        # like `get`, without counting a hit or a miss or touching the order
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False
+            if self.ttl is not None and time.time() - item[1] > self.ttl:
+                del self._data[key]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class ResponseCache:
+    """Two tier cache for raw LLM responses.
+
+    The first tier is an in-memory LRU, the second one a sqlite file that survives
+    restarts of the CLI and of the Streamlit app. Entries expire after `ttl` seconds
+    and the disk tier keeps at most `max_entries` rows (least recently used go first).
+
+    Args:
+        path (str): sqlite file for the disk tier. None keeps the cache in memory only.
+        maxsize (int): number of entries kept in memory.
+        max_entries (int): number of entries kept on disk.
+        ttl (float): seconds after which an entry is stale. None never expires.
+        enabled (bool): when False every lookup is a miss and nothing is stored.
+    """
+
+    def __init__(
+        self,
+        path=Path(CACHE_DIR, RESPONSE_DB),
+        maxsize=256,
+        max_entries=5000,
+        ttl=7 * 24 * 3600,
+        enabled=True,
+    ) -> None:
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def key(model, system_instruction, question, schema, history="") -> str:
+        """Build the cache key from the model, the system prompt hash, the question
+        text and the schema fingerprint (plus the history when it is sent)."""
+        return fingerprint(
+            model,
+            fingerprint(system_instruction),
+            question.strip(),
+            fingerprint(schema),
+            fingerprint(history) if history else "",
+        )
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        value = self._disk_get(key)
+        if value is not None:
+            self.memory.set(key, value)
+            self.hits += 1
+            self.disk_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value: str) -> None:
+        if not self.enabled:
+            return
+        self.memory.set(key, value)
+        self._disk_set(key, value)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "memory_size": len(self.memory),
+            "disk_size": self._disk_size(),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _disk_get(self, key):
+        if self._conn is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def _disk_set(self, key, value):
+        if self._conn is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def _disk_size(self):
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+_default_cache = None
+
+
+def default_cache() -> ResponseCache:
+    """Process wide response cache shared by the CLI and the Streamlit sessions."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResponseCache(
+            ttl=float(os.environ.get("DATA_CHAT_CACHE_TTL", 7 * 24 * 3600))
+        )
+    return _default_cache
@@ -0,0 +1,233 @@
+import re
+import time
+import keyword
+import threading
+from pathlib import Path
+from collections import OrderedDict
+import pandas as pd
+from pandas.api import types
+from ingest import detect_format, sniff_delimiter
+from executor import exec_globals
+from datastore import dataset_store
+from code_analysis import names_used
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+CATALOG_INSTRUCTION = """
+    # More tables:
+
+    - **Besides "dff", the environment has the tables listed under "tables" in the additional information. Each one is a pandas DataFrame with the name given there.
+    - **Only their columns and a few example values are given. Row counts starting with ~ are estimated.
+    - **Use them only when the question needs them, for example to join or compare them with "dff".
+    - **Do not change these tables. To keep a result, for example a join, assign it to dff.
+    """
+
+
+def table_name(path) -> str:
+    """Python name of the table of a file: student-mat.csv -> student_mat."""
+    stem = Path(str(path)).name.split(".")[0]
+    name = re.sub(r"\W+", "_", stem).strip("_").lower() or "table"
+    if name[0].isdigit() or keyword.iskeyword(name):
+        name = "t_" + name
+    return name
+
+
+def _kind(series) -> str:
+    if types.is_bool_dtype(series):
+        return "boolean"
+    if types.is_numeric_dtype(series):
+        return "numeric"
+    if types.is_datetime64_any_dtype(series):
+        return "datetime"
+    return "text"
+
+
+def _summary(path, sample_rows) -> dict:
+    """Rows and columns of the file from its first rows (and the metadata of
+    Parquet files), without loading it."""
+    fmt, compression = detect_format(path)
+    rows = None
+
+    if fmt == "csv":
+        sample = pd.read_csv(
+            path,
+            nrows=sample_rows,
+            compression=compression,
+            sep=sniff_delimiter(path, compression),
+        )
+        if compression is None and len(sample) == sample_rows:
+            # from the bytes per line of the sample
+            with open(path, "rb") as f:
+                head = f.read(2**20)
+            lines = max(head.count(b"\n"), 1)
+            rows = "~{}".format(
+                int(Path(path).stat().st_size / (len(head) / lines)) - 1
+            )
+        elif compression is None:
+            rows = len(sample)
+    elif fmt == "parquet":
+        parquet = pq.ParquetFile(path)
+        rows = parquet.metadata.num_rows
+        batch = next(parquet.iter_batches(batch_size=sample_rows), None)
+        # an empty file has no batch, only the columns
+        if batch is None:
+            batch = parquet.schema_arrow.empty_table()
+        sample = batch.to_pandas()
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        if reader.num_record_batches == 0:
+            batch = reader.schema.empty_table()
+        else:
+            batch = reader.get_batch(0)
+        sample = batch.slice(0, sample_rows).to_pandas()
+        rows = batch.num_rows
+        if reader.num_record_batches > 1:
+            rows = f"~{batch.num_rows * reader.num_record_batches}"
+
+    columns = {}
+    for col in sample.columns:
+        series = sample[col]
+        text = f"{series.dtype} {_kind(series)}"
+        examples = series.dropna().astype(str).unique()[:3]
+        if len(examples):
+            text += " e.g. " + "|".join(examples)
+        columns[col] = text
+
+    return {"file": Path(path).name, "rows": rows, "columns": columns}
+
+
+class DatasetCatalog:
+    """Named tables the generated code can use next to `dff`, loaded only when the
+    code needs them.
+
+    A registered table costs a summary of its columns, read from its first rows; the
+    model gets the summaries, not the data. A table is loaded the first time a
+    script reads its name (see `namespace`), through the process wide
+    `datastore.DatasetStore`, so sessions with the same files share them. The
+    loaded tables are kept until they take more than `memory_mb`, then the least
+    recently used ones are dropped and loaded again when a script needs them.
+
+    Args:
+        tables (dict | list): {name: path} or paths, named by `table_name`
+        memory_mb (float): budget of the tables kept loaded
+        sample_rows (int): rows read for the summary of a table
+    """
+
+    def __init__(self, tables=None, memory_mb=1024, sample_rows=200) -> None:
+        self.memory_mb = memory_mb
+        self.sample_rows = sample_rows
+        # name -> {"path", "summary", "key", "frame", "bytes", "lock"}, oldest use first
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+        if isinstance(tables, dict):
+            tables = tables.items()
+        else:
+            tables = [(None, path) for path in tables or ()]
+        for name, path in tables:
+            self.register(path, name)
+
+    def register(self, path, name=None) -> str:
+        """Add a table, only its summary is read.
+
+        Returns:
+            str: the name of the table in the code
+        """
+        name = name or table_name(path)
+        if not name.isidentifier() or name == "dff" or name in exec_globals():
+            raise ValueError(f"{name} can not be the name of a table")
+        if name in self._tables:
+            raise ValueError(f"There is already a table called {name}")
+        if not Path(path).exists():
+            raise FileNotFoundError(f"The file {path} is not there")
+
+        self._tables[name] = {
+            "path": Path(path),
+            "summary": _summary(path, self.sample_rows),
+            "key": None,
+            "frame": None,
+            "bytes": 0,
+            "lock": threading.Lock(),
+        }
+        return name
+
+    def names(self) -> list:
+        return list(self._tables)
+
+    def instruction(self) -> str:
+        return CATALOG_INSTRUCTION
+
+    def summaries(self) -> dict:
+        return {name: entry["summary"] for name, entry in self._tables.items()}
+
+    def load(self, name) -> pd.DataFrame:
+        """The table, loaded if it is not."""
+        entry = self._tables[name]
+        with entry["lock"]:
+            with self._lock:
+                frame = entry["frame"]
+                self._tables.move_to_end(name)
+                if frame is not None:
+                    self.hits += 1
+                    return frame
+
+            start = time.perf_counter()
+            store = dataset_store()
+            if entry["key"] is None:
+                entry["key"] = store.put(entry["path"])
+            frame = store.acquire(entry["key"])
+
+            with self._lock:
+                entry["frame"] = frame
+                entry["bytes"] = int(store.report(entry["key"])["memory_mb"] * 2**20)
+                self.loads += 1
+                self.load_seconds += time.perf_counter() - start
+
+        self._evict(keep=name)
+        return frame
+
+    def namespace(self, code) -> dict:
+        """The tables the code reads, by name, for `executor.run_code`."""
+        used = names_used(code)
+        return {name: self.load(name) for name in list(self._tables) if name in used}
+
+    def _evict(self, keep=None) -> None:
+        """Drop the loaded tables, least recently used first, until the budget is
+        met. The store spills them once no session holds them."""
+        with self._lock:
+            loaded = [
+                (name, entry)
+                for name, entry in self._tables.items()
+                if entry["frame"] is not None
+            ]
+            memory = sum(entry["bytes"] for _, entry in loaded)
+            for name, entry in loaded:
+                if memory <= self.memory_mb * 2**20:
+                    break
+                if name == keep:
+                    continue
+                entry["frame"] = None
+                memory -= entry["bytes"]
+                self.evictions += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            loaded = [e for e in self._tables.values() if e["frame"] is not None]
+            return {
+                "tables": len(self._tables),
+                "loaded": len(loaded),
+                "memory_mb": sum(e["bytes"] for e in loaded) / 2**20,
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "load_seconds": self.load_seconds,
+            }
@@ -0,0 +1,391 @@
+import re
+import time
+import random
+import asyncio
+import threading
+import contextvars
+import weakref
+from email.utils import parsedate_to_datetime
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+from google.api_core.retry import Retry
+from google.api_core.retry_async import AsyncRetry
+from caching import fingerprint
+
+RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504)
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+GOOGLE_RETRY_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+)
+
+# counts of the requests made by the current thread or task, see `take_call_stats`
+_calls = contextvars.ContextVar("provider_calls", default=None)
+
+
+def take_call_stats() -> dict:
+    """Counts (requests, retries, new and reused connections, rate limit waits) of
+    the provider requests made in this thread or task since the last call."""
+    calls = _calls.get()
+    _calls.set(None)
+    return calls or {}
+
+
+def parse_duration(text):
+    """Seconds of a duration like 20ms, 1s or 6m0s (the x-ratelimit-reset headers)."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", text or "")
+    if not parts:
+        return None
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def header_delay(headers):
+    """Seconds the provider asks to wait before the next request, None if it does
+    not say."""
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    resets = [
+        parse_duration(headers.get(name))
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class RetryPolicy:
+    """When and how long to wait before a failed request is tried again.
+
+    Rate limits (429), server errors (5xx) and dropped connections are retried at
+    most `max_retries` times. The wait is the one the provider asks for in the
+    headers, otherwise a random exponential backoff (full jitter), never longer than
+    `max_delay`.
+
+    Args:
+        max_retries (int): retries of one request
+        base_delay (float): seconds of the first backoff
+        max_delay (float): longest wait
+        deadline (float): seconds a Gemini request may take with its retries
+    """
+
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=30.0, deadline=120.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def delay(self, attempt, headers=None) -> float:
+        hinted = header_delay(headers) if headers is not None else None
+        if hinted is None:
+            return self.backoff(attempt)
+        return min(self.max_delay, hinted)
+
+
+class _RateGate:
+    """Hold the requests of a key while the provider says its limit is used up
+    (x-ratelimit-remaining-* is 0), until the limit resets."""
+
+    def __init__(self) -> None:
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, headers) -> None:
+        exhausted = [
+            kind
+            for kind in ("requests", "tokens")
+            if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+        ]
+        if not exhausted:
+            return
+        reset = max(
+            parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or 0.0
+            for kind in exhausted
+        )
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + reset)
+
+    def wait(self) -> float:
+        with self._lock:
+            return max(0.0, self._not_before - time.monotonic())
+
+
+class _RetryTransport(httpx.BaseTransport):
+    """Keep-alive connection pool with retries, for the sync OpenAI client."""
+
+    def __init__(self, registry, limits) -> None:
+        self._registry = registry
+        self._transport = httpx.HTTPTransport(limits=limits)
+        self.gate = _RateGate()
+
+    def handle_request(self, request):
+        policy = self._registry.policy
+        attempt = 0
+        while True:
+            wait = self.gate.wait()
+            if wait:
+                self._registry.record("rate_limit_waits")
+                time.sleep(wait)
+
+            connected = []
+
+            def trace(event, info):
+                if event == "connection.connect_tcp.complete":
+                    connected.append(event)
+
+            request.extensions = {**request.extensions, "trace": trace}
+            try:
+                response = self._transport.handle_request(request)
+            except RETRY_ERRORS:
+                if attempt >= policy.max_retries:
+                    raise
+                delay = policy.delay(attempt)
+            else:
+                self._registry.record_request(bool(connected))
+                self.gate.update(response.headers)
+                if (
+                    response.status_code not in RETRY_STATUS
+                    or attempt >= policy.max_retries
+                ):
+                    return response
+                delay = policy.delay(attempt, response.headers)
+                # read the error body, the connection goes back to the pool
+                response.read()
+                response.close()
+
+            self._registry.record("retries")
+            attempt += 1
+            time.sleep(delay)
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """`_RetryTransport` for the async OpenAI client."""
+
+    def __init__(self, registry, limits, gate) -> None:
+        self._registry = registry
+        self._transport = httpx.AsyncHTTPTransport(limits=limits)
+        self.gate = gate
+
+    async def handle_async_request(self, request):
+        policy = self._registry.policy
+        attempt = 0
+        while True:
+            wait = self.gate.wait()
+            if wait:
+                self._registry.record("rate_limit_waits")
+                await asyncio.sleep(wait)
+
+            connected = []
+
+            async def trace(event, info):
+                if event == "connection.connect_tcp.complete":
+                    connected.append(event)
+
+            request.extensions = {**request.extensions, "trace": trace}
+            try:
+                response = await self._transport.handle_async_request(request)
+            except RETRY_ERRORS:
+                if attempt >= policy.max_retries:
+                    raise
+                delay = policy.delay(attempt)
+            else:
+                self._registry.record_request(bool(connected))
+                self.gate.update(response.headers)
+                if (
+                    response.status_code not in RETRY_STATUS
+                    or attempt >= policy.max_retries
+                ):
+                    return response
+                delay = policy.delay(attempt, response.headers)
+                await response.aread()
+                await response.aclose()
+
+            self._registry.record("retries")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ClientSet:
+    """The clients of one provider and key: a sync client, and an async client per
+    event loop (their connections belong to the loop that opened them)."""
+
+    def __init__(self, client, make_async, close=None) -> None:
+        self.client = client
+        self._make_async = make_async
+        self._close = close
+        self._async = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async.get(loop)
+            if client is None:
+                client = self._async[loop] = self._make_async()
+        return client
+
+    def close(self) -> None:
+        if self._close is not None:
+            self._close()
+
+
+class ClientRegistry:
+    """Provider clients shared by all the agents of the process.
+
+    There is one set of clients per provider and key (keys are only kept as sha256
+    hashes), so the sessions of a key reuse the same keep-alive connections and the
+    same rate limit state, and sessions with different keys never share a client.
+    Retries follow `policy`; `stats` counts the requests, the retries and how many
+    requests opened a connection or reused one.
+
+    Args:
+        policy (RetryPolicy): when to retry
+        pool_size (int): connections kept open per key
+    """
+
+    def __init__(self, policy=None, pool_size=20) -> None:
+        self.policy = policy or RetryPolicy()
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=60,
+        )
+        self._clients = {}
+        self._stats = {
+            "requests": 0,
+            "new_connections": 0,
+            "reused_connections": 0,
+            "retries": 0,
+            "rate_limit_waits": 0,
+        }
+        self._lock = threading.Lock()
+
+    def record(self, name, value=1) -> None:
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + value
+        calls = _calls.get()
+        if calls is None:
+            calls = {}
+            _calls.set(calls)
+        calls[name] = calls.get(name, 0) + value
+
+    def record_request(self, new_connection) -> None:
+        self.record("requests")
+        self.record("new_connections" if new_connection else "reused_connections")
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {"clients": len(self._clients), **self._stats}
+
+    def google_retry(self, asynchronous=False):
+        """api_core retry of one Gemini request. The clients talk gRPC, the errors
+        carry no headers: the backoff is the jittered exponential one of api_core."""
+        policy = self.policy
+        attempts = []
+
+        def predicate(error):
+            if not isinstance(error, GOOGLE_RETRY_ERRORS):
+                return False
+            if len(attempts) >= policy.max_retries:
+                return False
+            attempts.append(error)
+            self.record("retries")
+            return True
+
+        retry = AsyncRetry if asynchronous else Retry
+        return retry(
+            predicate=predicate,
+            initial=policy.base_delay,
+            maximum=policy.max_delay,
+            timeout=policy.deadline,
+        )
+
+    def _get(self, provider, api_key, build):
+        key = fingerprint(provider, api_key)
+        with self._lock:
+            clients = self._clients.get(key)
+            if clients is None:
+                clients = self._clients[key] = build(api_key)
+        return clients
+
+    def openai(self, api_key) -> ClientSet:
+        """OpenAI clients of the key. The SDK retries are off, the transport does
+        them."""
+
+        def build(api_key):
+            transport = _RetryTransport(self, self.limits)
+            client = OpenAI(
+                api_key=api_key,
+                max_retries=0,
+                http_client=httpx.Client(transport=transport),
+            )
+
+            def make_async():
+                # the same rate limit state as the sync client
+                transport_async = _AsyncRetryTransport(
+                    self, self.limits, transport.gate
+                )
+                return AsyncOpenAI(
+                    api_key=api_key,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(transport=transport_async),
+                )
+
+            return ClientSet(client, make_async, client.close)
+
+        return self._get("openai", api_key, build)
+
+    def gemini(self, api_key) -> ClientSet:
+        """Gemini clients of the key, instead of the process wide `genai.configure`."""
+
+        def build(api_key):
+            options = {"api_key": api_key}
+            return ClientSet(
+                glm.GenerativeServiceClient(client_options=options),
+                lambda: glm.GenerativeServiceAsyncClient(client_options=options),
+            )
+
+        return self._get("gemini", api_key, build)
+
+    def close(self) -> None:
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+_registry = None
+
+
+def client_registry() -> ClientRegistry:
+    """Process wide registry, shared by the CLI and the Streamlit sessions."""
+    global _registry
+    if _registry is None:
+        _registry = ClientRegistry()
+    return _registry
@@ -0,0 +1,178 @@
+import ast
+
+# methods that change the object they are called on
+MUTATING_METHODS = {
+    "pop",
+    "insert",
+    "update",
+    "append",
+    "extend",
+    "clear",
+    "remove",
+    "setdefault",
+    "popitem",
+    "sort",
+    "reverse",
+}
+
+# calls that write outside of the namespace, their result can not be replayed
+IO_CALLS = {
+    "open",
+    "savefig",
+    "write_image",
+    "write_html",
+    "write_json",
+    "to_csv",
+    "to_excel",
+    "to_parquet",
+    "to_feather",
+    "to_pickle",
+    "to_json",
+    "to_sql",
+    "to_file",
+    "to_hdf",
+}
+
+
+# pandas methods that draw with pyplot
+PYPLOT_METHODS = {
+    "plot",
+    "hist",
+    "boxplot",
+    "scatter_matrix",
+    "bar",
+    "barh",
+    "pie",
+    "kde",
+    "density",
+    "area",
+    "hexbin",
+}
+# modules that draw with pyplot
+PYPLOT_MODULES = {"matplotlib", "seaborn", "pandas.plotting"}
+
+
+def parse(code):
+    try:
+        return ast.parse(code)
+    except SyntaxError:
+        return None
+
+
+def names_used(code) -> set:
+    """Names the code reads, like the tables of a catalog it touches."""
+    tree = parse(code)
+    if tree is None:
+        return set()
+    return {
+        node.id
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
+    }
+
+
+def _call_name(node):
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def mutates_frame(code) -> bool:
+    """Tell if the code may change `dff`, either by binding a new object to the name
+    or by changing it in place. The check is conservative: any item or attribute
+    assignment, any inplace=True and any call of a mutating method counts, because
+    the object changed might be an alias of `dff`."""
+
+    tree = parse(code)
+    if tree is None:
+        return True
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Delete)):
+            targets = (
+                node.targets
+                if isinstance(node, (ast.Assign, ast.Delete))
+                else [node.target]
+            )
+            for target in targets:
+                for sub in ast.walk(target):
+                    if isinstance(sub, (ast.Subscript, ast.Attribute)):
+                        return True
+                    if isinstance(sub, ast.Name) and sub.id == "dff":
+                        return True
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            return True
+        elif isinstance(node, (ast.For, ast.comprehension)):
+            if any(
+                isinstance(n, ast.Name) and n.id == "dff" for n in ast.walk(node.target)
+            ):
+                return True
+        elif isinstance(node, ast.NamedExpr) and node.target.id == "dff":
+            return True
+        elif isinstance(node, ast.Call):
+            if _call_name(node) in MUTATING_METHODS:
+                return True
+            for kw in node.keywords:
+                if kw.arg == "inplace" and not (
+                    isinstance(kw.value, ast.Constant) and not kw.value.value
+                ):
+                    return True
+
+    return False
+
+
+def uses_pyplot(code) -> bool:
+    """Tell if the code may open pyplot figures: `plt`, matplotlib or seaborn, or
+    the plotting methods of pandas. Conservative, unparsable code counts."""
+
+    tree = parse(code)
+    if tree is None:
+        return True
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "plt":
+            return True
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = (
+                [alias.name for alias in node.names]
+                if isinstance(node, ast.Import)
+                else [node.module or ""]
+            )
+            if any(
+                module.split(".")[0] in PYPLOT_MODULES or module in PYPLOT_MODULES
+                for module in modules
+            ):
+                return True
+        if (
+            isinstance(node, ast.Call)
+            and _call_name(node) in PYPLOT_METHODS
+            # px.bar, go.Pie... are plotly
+            and not (
+                isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name)
+                and node.func.value.id in ("px", "go")
+            )
+        ):
+            return True
+    return False
+
+
+def has_side_effects(code) -> bool:
+    """Tell if the code writes files. Shown figures are captured with the output."""
+
+    tree = parse(code)
+    if tree is None:
+        return True
+
+    return any(
+        isinstance(node, ast.Call) and _call_name(node) in IO_CALLS
+        for node in ast.walk(tree)
+    )
+
+
+def is_pure(code) -> bool:
+    """A pure run only prints and makes figures: it can be replayed from its captured
+    output as long as the dataframe did not change."""
+    return not mutates_frame(code) and not has_side_effects(code)
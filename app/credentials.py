@@ -0,0 +1,84 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from caching import fingerprint
+from functions import check_api_key
+
+# only definitive answers are cached, transient errors are retried on the next call
+CACHEABLE = ("valid_key", "invalid_key")
+
+
+class KeyValidator:
+    """Validate API keys once per key and keep the verdict for `ttl` seconds.
+
+    The check runs on a background thread so the caller (the Streamlit script) never
+    waits for the provider. Keys are only kept as sha256 hashes.
+
+    Args:
+        ttl (float): seconds a verdict is trusted before the key is checked again.
+        max_workers (int): number of concurrent checks.
+    """
+
+    def __init__(self, ttl=3600, max_workers=2) -> None:
+        self.ttl = ttl
+        self._verdicts = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="key-check"
+        )
+
+    def status(self, api_key: str, which: str):
+        """Return the verdict for the key or None while the check is running.
+        The first call for an unknown key starts the check."""
+
+        if api_key == "":
+            return "empty_key"
+
+        key = fingerprint(which, api_key)
+
+        with self._lock:
+            verdict = self._verdicts.get(key)
+            if verdict is not None and time.time() - verdict[1] <= self.ttl:
+                return verdict[0]
+
+            future = self._pending.get(key)
+            if future is None:
+                self._pending[key] = self._pool.submit(
+                    self._validate, key, api_key, which
+                )
+                return None
+
+            if not future.done():
+                return None
+
+            del self._pending[key]
+
+        return future.result()
+
+    def invalidate(self, api_key: str, which: str) -> None:
+        with self._lock:
+            self._verdicts.pop(fingerprint(which, api_key), None)
+
+    def _validate(self, key, api_key, which):
+        try:
+            verdict = check_api_key(api_key=api_key, which=which)
+        except Exception as e:
+            verdict = f"There was an error: {e}"
+
+        if verdict in CACHEABLE:
+            with self._lock:
+                self._verdicts[key] = (verdict, time.time())
+
+        return verdict
+
+
+_validator = None
+
+
+def key_validator() -> KeyValidator:
+    """Process wide validator, shared by all the Streamlit sessions."""
+    global _validator
+    if _validator is None:
+        _validator = KeyValidator()
+    return _validator
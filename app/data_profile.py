@@ -0,0 +1,145 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+from pandas.api import types
+from snapshots import changed_columns
+
+
+def _short(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return value
+
+
+class DatasetProfile:
+    """Compact description of the dataframe that is sent to the model with every
+    question instead of the bare column names and dtypes.
+
+    For each column it keeps the dtype, the kind (numeric, boolean, datetime,
+    categorical or text), the missing values, the number of unique values, the range
+    and a few example values. Beyond `sample_rows` rows the statistics come from a
+    sample and are marked with "~". Columns left when
+    `time_budget` runs out only get their dtype and are completed on the next update.
+
+    Args:
+        df (pd.DataFrame): the dataframe to describe.
+        sample_rows (int): rows above which a sample is used.
+        max_examples (int): example values kept per column.
+        time_budget (float): seconds one update may take.
+    """
+
+    def __init__(self, df, sample_rows=100_000, max_examples=3, time_budget=2.0):
+        self.sample_rows = sample_rows
+        self.max_examples = max_examples
+        self.time_budget = time_budget
+        self.columns = {}
+        self.rows = 0
+        self._frame = None
+        self.update(df)
+
+    def update(self, df, columns=None) -> list:
+        """Refresh the profile for the columns that changed since the last update.
+
+        Args:
+            df (pd.DataFrame): current dataframe
+            columns (list): columns to refresh. By default the ones whose data is not
+                shared with the frame seen on the previous update.
+
+        Returns:
+            list: the refreshed columns
+        """
+        if columns is None:
+            columns = changed_columns(self._frame, df)
+        # columns left out by the time budget of the previous update
+        columns = [
+            col
+            for col in dict.fromkeys(list(columns) + self.pending)
+            if col in df.columns
+        ]
+
+        self.rows = len(df)
+        self.columns = {
+            col: None if col in columns else self.columns.get(col) for col in df.columns
+        }
+        self._frame = df.copy(deep=False)
+
+        if not columns:
+            return []
+
+        # every pass over the data is inside the time budget, column by column, so
+        # a wide frame is profiled over several updates
+        start = time.perf_counter()
+        sampled = len(df) > self.sample_rows
+        if sampled:
+            rng = np.random.default_rng(0)
+            rows = np.sort(rng.choice(len(df), self.sample_rows, replace=False))
+
+        done = []
+        approx = "~" if sampled else ""
+        for col in columns:
+            if time.perf_counter() - start > self.time_budget:
+                break
+            sample = df[col].iloc[rows] if sampled else df[col]
+            nulls = int(sample.isna().sum())
+            if sampled:
+                nulls = round(nulls * len(df) / len(sample))
+            unique = int(sample.nunique(dropna=True))
+
+            info = self._describe(sample, unique)
+            info["nulls"] = f"{approx}{nulls}"
+            info["unique"] = f"{approx}{unique}"
+            if (
+                types.is_numeric_dtype(sample) or types.is_datetime64_any_dtype(sample)
+            ) and not types.is_bool_dtype(sample):
+                info["min"] = f"{approx}{_short(sample.min())}"
+                info["max"] = _short(sample.max())
+            self.columns[col] = info
+            done.append(col)
+
+        return done
+
+    @property
+    def pending(self) -> list:
+        """Columns the time budget left with only their dtype."""
+        return [col for col, info in self.columns.items() if info is None]
+
+    def _describe(self, sample, unique):
+        dtype = sample.dtype
+        info = {"dtype": str(dtype)}
+
+        if types.is_bool_dtype(dtype):
+            info["kind"] = "boolean"
+        elif types.is_numeric_dtype(dtype):
+            info["kind"] = "numeric"
+        elif types.is_datetime64_any_dtype(dtype):
+            info["kind"] = "datetime"
+        elif isinstance(dtype, pd.CategoricalDtype) or unique <= max(
+            20, 0.05 * len(sample)
+        ):
+            info["kind"] = "categorical"
+        else:
+            info["kind"] = "text"
+
+        examples = sample.dropna().unique()[: self.max_examples]
+        info["examples"] = [str(v)[:30] for v in examples]
+
+        return info
+
+    def to_prompt(self) -> str:
+        """One line of text per column, as compact as possible."""
+        columns = {}
+        for col, info in self.columns.items():
+            if info is None:
+                columns[col] = str(self._frame[col].dtype)
+                continue
+            text = "{} {} nulls={} unique={}".format(
+                info["dtype"], info["kind"], info["nulls"], info["unique"]
+            )
+            if "min" in info:
+                text += f" range={info['min']}..{info['max']}"
+            if info["kind"] in ("categorical", "text", "boolean"):
+                text += " e.g. " + "|".join(info["examples"])
+            columns[col] = text
+
+        return json.dumps({"rows": self.rows, "columns": columns}, default=str)
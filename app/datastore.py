@@ -0,0 +1,201 @@
+import os
+import time
+import hashlib
+import threading
+import weakref
+from pathlib import Path
+from collections import OrderedDict
+import pandas as pd
+from ingest import load_table
+
+SPILL_DIR = "./app/cache/datasets"
+
+
+def content_hash(source, chunk_size=8 * 2**20) -> str:
+    """sha256 of the bytes of a path or of a file object (like a Streamlit
+    upload)."""
+    h = hashlib.sha256()
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            while block := f.read(chunk_size):
+                h.update(block)
+        return h.hexdigest()
+
+    if hasattr(source, "getbuffer"):
+        h.update(source.getbuffer())
+    else:
+        source.seek(0)
+        while block := source.read(chunk_size):
+            h.update(block)
+        source.seek(0)
+    return h.hexdigest()
+
+
+class DatasetStore:
+    """Loaded tables shared by all the sessions of the process.
+
+    An upload is keyed by the hash of its content, so the same file is loaded once
+    however many sessions upload it. The store keeps the base frame and every
+    session gets a shallow copy: with copy-on-write (enabled in `executor`) a
+    session's changes only cost the columns it changes, the base is never written.
+
+    The copies handed out are counted; a dataset whose copies are all gone may be
+    evicted, least recently used first, when the base frames take more than
+    `memory_mb`. Evicted frames are spilled to Parquet in `spill_dir` and read
+    back (memory mapped) on the next `acquire`.
+
+    Args:
+        memory_mb (float): budget of the base frames kept in memory
+        spill_dir (str): folder of the spilled frames
+    """
+
+    def __init__(self, memory_mb=4096, spill_dir=SPILL_DIR) -> None:
+        self.memory_mb = memory_mb
+        self.spill_dir = Path(spill_dir)
+        # key -> {"frame", "report", "bytes", "refs", "path"}, oldest use first
+        self._datasets = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.restores = 0
+
+    def put(self, source, name=None) -> str:
+        """Load the table unless a table with the same content is already there.
+
+        Returns:
+            str: the key of the dataset, for `acquire`
+        """
+        key = content_hash(source)
+
+        with self._lock:
+            lock = self._loading.setdefault(key, threading.Lock())
+        # two sessions uploading the same file wait for one load
+        with lock:
+            with self._lock:
+                if key in self._datasets:
+                    self._loading.pop(key, None)
+                    self.hits += 1
+                    self._datasets.move_to_end(key)
+                    return key
+                self.misses += 1
+
+            df, report = load_table(source, name=name)
+            with self._lock:
+                self._datasets[key] = {
+                    "frame": df,
+                    "report": report,
+                    "bytes": int(report["memory_mb"] * 2**20),
+                    "refs": 0,
+                    "path": None,
+                }
+                self._loading.pop(key, None)
+            # not the new one, it is about to be acquired
+            self._evict(keep=key)
+        return key
+
+    def acquire(self, key) -> pd.DataFrame:
+        """A copy of the dataset for one session. The dataset counts as used until
+        the copy is garbage collected."""
+        with self._lock:
+            entry = self._datasets[key]
+            self._datasets.move_to_end(key)
+            entry["refs"] += 1
+            frame = entry["frame"]
+
+        if frame is None:
+            frame = self._restore(key, entry)
+
+        df = frame.copy(deep=False)
+        weakref.finalize(df, self.release, key)
+        return df
+
+    def release(self, key) -> None:
+        with self._lock:
+            entry = self._datasets.get(key)
+            if entry is not None:
+                entry["refs"] = max(0, entry["refs"] - 1)
+        self._evict()
+
+    def report(self, key) -> dict:
+        """The load report of the dataset (see `ingest.load_table`)."""
+        return self._datasets[key]["report"]
+
+    def _restore(self, key, entry):
+        start = time.perf_counter()
+        frame = pd.read_parquet(entry["path"], engine="pyarrow", memory_map=True)
+        with self._lock:
+            if entry["frame"] is None:
+                entry["frame"] = frame
+                self.restores += 1
+            frame = entry["frame"]
+        entry["report"]["restore_seconds"] = time.perf_counter() - start
+        self._evict(keep=key)
+        return frame
+
+    def _memory(self) -> int:
+        return sum(
+            entry["bytes"]
+            for entry in self._datasets.values()
+            if entry["frame"] is not None
+        )
+
+    def _evict(self, keep=None) -> None:
+        """Spill the unused datasets, oldest use first, until the budget is met."""
+        while True:
+            with self._lock:
+                if self._memory() <= self.memory_mb * 2**20:
+                    return
+                victim = next(
+                    (
+                        (key, entry)
+                        for key, entry in self._datasets.items()
+                        if entry["frame"] is not None
+                        and entry["refs"] == 0
+                        and key != keep
+                    ),
+                    None,
+                )
+            if victim is None:
+                # everything in memory is used by a session
+                return
+            key, entry = victim
+            if entry["path"] is None:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                path = self.spill_dir / f"{key}.parquet"
+                entry["frame"].to_parquet(path, engine="pyarrow", index=True)
+                entry["path"] = path
+            with self._lock:
+                if entry["refs"] == 0:
+                    entry["frame"] = None
+                    self.spills += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            entries = list(self._datasets.values())
+            return {
+                "datasets": len(entries),
+                "in_memory": sum(entry["frame"] is not None for entry in entries),
+                "spilled": sum(entry["frame"] is None for entry in entries),
+                "sessions": sum(entry["refs"] for entry in entries),
+                "memory_mb": self._memory() / 2**20,
+                "hits": self.hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "restores": self.restores,
+            }
+
+
+_store = None
+
+
+def dataset_store() -> DatasetStore:
+    """Process wide store, shared by the Streamlit sessions."""
+    global _store
+    if _store is None:
+        _store = DatasetStore(
+            memory_mb=float(os.environ.get("DATA_CHAT_STORE_MB", 4096))
+        )
+    return _store
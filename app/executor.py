@@ -0,0 +1,512 @@
+import io
+import os
+import sys
+import time
+import pickle
+import threading
+import weakref
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import pandas as pd
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from wordcloud import WordCloud
+from caching import LRUCache, fingerprint
+from code_analysis import mutates_frame, uses_pyplot
+
+# shallow copies of dff share memory until one of them writes (see snapshots)
+pd.set_option("mode.copy_on_write", True)
+
+# compiled scripts, shared by all the runs of the process
+_compiled = LRUCache(maxsize=256)
+
+# figures shown by the run of the current thread, every session runs in its own
+_capture = threading.local()
+# pyplot figures are global to the process: one run using pyplot at a time opens
+# and collects them, concurrent ones would take or close the figures of each other
+_pyplot_lock = threading.RLock()
+_plotly_show = go.Figure.show
+
+
+def _show(fig, *args, **kwargs):
+    shown = getattr(_capture, "shown", None)
+    if shown is None:
+        # not inside run_code, show it as plotly would
+        return _plotly_show(fig, *args, **kwargs)
+    shown.append(fig)
+
+
+go.Figure.show = _show
+
+
+class _StdoutRouter(io.TextIOBase):
+    """sys.stdout that sends what a run prints to the buffer of its thread, so runs
+    of concurrent sessions do not mix their output (redirect_stdout swaps the
+    stdout of the whole process)."""
+
+    def __init__(self, default) -> None:
+        self.default = default
+
+    def _target(self):
+        return getattr(_capture, "stdout", None) or self.default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def writable(self) -> bool:
+        return True
+
+
+def exec_globals() -> dict:
+    """Packages available to the generated code."""
+    return {
+        "pd": pd,
+        "np": np,
+        "px": px,
+        "go": go,
+        "plt": plt,
+        "WordCloud": WordCloud,
+    }
+
+
+def compile_code(code):
+    """Compile the script once and reuse the code object when it runs again."""
+    key = fingerprint(code)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = compile(code, "<generated>", "exec")
+        _compiled.set(key, compiled)
+    return compiled
+
+
+def compile_stats() -> dict:
+    return _compiled.stats
+
+
+def _png(obj) -> bytes:
+    buffer = io.BytesIO()
+    if isinstance(obj, Figure):
+        obj.savefig(buffer, format="png", bbox_inches="tight")
+    else:
+        obj.to_image().save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def collect_figures(shown, namespace, fignums=()) -> list:
+    """Figures made by a run: the plotly figures it showed, then the plotly,
+    matplotlib and WordCloud objects left in its namespace and the pyplot figures
+    it opened. Matplotlib figures and word clouds are rendered to PNG.
+
+    Returns:
+        list: {"kind": "plotly", "figure": go.Figure} | {"kind": "image", "image": bytes}
+    """
+    opened = [plt.figure(num) for num in fignums]
+    figures = []
+    seen = set()
+
+    for obj in [*shown, *namespace.values(), *opened]:
+        if id(obj) in seen:
+            continue
+        if isinstance(obj, go.Figure):
+            figures.append({"kind": "plotly", "figure": obj})
+        elif isinstance(obj, Figure) or (
+            isinstance(obj, WordCloud) and hasattr(obj, "layout_")
+        ):
+            figures.append({"kind": "image", "image": _png(obj)})
+        else:
+            continue
+        seen.add(id(obj))
+
+    return figures
+
+
+def run_code(code, dff, namespace=None):
+    """Run the code with `dff` in the namespace and capture what it prints and the
+    figures it makes (see `collect_figures`), in memory.
+
+    Args:
+        code (str): python code
+        dff (pd.DataFrame): the dataframe of the session
+        namespace (dict): extra names for the code, like the `sql` function of the
+            out-of-core backend
+
+    Returns:
+        tuple: ({"output": str, "figures": list} | {"exception": str}, dff after
+            the run). "figures" is there only when the code made some.
+    """
+    if not isinstance(sys.stdout, _StdoutRouter):
+        sys.stdout = _StdoutRouter(sys.stdout)
+
+    if uses_pyplot(code):
+        with _pyplot_lock:
+            return _run_code(code, dff, namespace, pyplot=True)
+    # the other runs do not touch the figures of pyplot and run concurrently
+    return _run_code(code, dff, namespace, pyplot=False)
+
+
+def _run_code(code, dff, namespace, pyplot):
+    fignums = set(plt.get_fignums()) if pyplot else set()
+    _capture.shown = []
+    try:
+        output_capture = io.StringIO()
+
+        local_namespace = {"dff": dff}
+
+        _capture.stdout = output_capture
+        try:
+            exec(
+                compile_code(code), exec_globals() | (namespace or {}), local_namespace
+            )
+        finally:
+            _capture.stdout = None
+
+        captured_output = output_capture.getvalue()
+        result = {"output": captured_output}
+
+        figures = collect_figures(
+            _capture.shown,
+            local_namespace,
+            [num for num in plt.get_fignums() if num not in fignums] if pyplot else [],
+        )
+        if figures:
+            result["figures"] = figures
+        return result, local_namespace["dff"]
+
+    # any exception is printed and the user can ask another question
+    except Exception as e:
+        print(e)
+        return {"exception": repr(e)}, dff
+
+    finally:
+        _capture.shown = None
+        # pyplot keeps every open figure alive
+        if pyplot:
+            for num in plt.get_fignums():
+                if num not in fignums:
+                    plt.close(num)
+
+
+def dump_frame(df) -> dict:
+    """Put the data buffers of the frame in a shared memory block.
+
+    The frame is pickled with protocol 5 so the column arrays are kept out of band
+    and copied once into shared memory instead of going through the pipe. The
+    receiver owns the block and unlinks it in `load_frame`.
+    """
+    buffers = []
+    payload = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+
+    shm = SharedMemory(create=True, size=max(sum(r.nbytes for r in raws), 1))
+    # the block outlives this process, the receiver is responsible for it
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+    offsets = []
+    pos = 0
+    for raw in raws:
+        shm.buf[pos : pos + raw.nbytes] = raw
+        offsets.append((pos, raw.nbytes))
+        pos += raw.nbytes
+    shm.close()
+
+    return {"pickle": payload, "shm": shm.name, "offsets": offsets}
+
+
+def load_frame(message: dict):
+    shm = SharedMemory(name=message["shm"])
+    try:
+        buffers = [bytearray(shm.buf[a : a + n]) for a, n in message["offsets"]]
+        return pickle.loads(message["pickle"], buffers=buffers)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _unlink(name) -> None:
+    """Free a block of `dump_frame` the receiver did not get to read."""
+    try:
+        SharedMemory(name=name).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _worker_main(conn):
+    dff = None
+    conn.send({"ready": True})
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message["op"] == "stop":
+            break
+
+        if message["op"] == "load":
+            dff = load_frame(message["frame"])
+            continue
+
+        # a scratch run gets its own frame, the one of the session is kept
+        scratch = message.get("frame") is not None
+        before = load_frame(message["frame"]) if scratch else dff
+        tables = {name: load_frame(frame) for name, frame in message["tables"].items()}
+        result, after = run_code(message["code"], before, tables)
+        plt.close("all")
+        if not scratch:
+            dff = after
+
+        reply = {"result": result}
+        # a frame the code did not touch is not shipped back
+        if "output" in result and (
+            after is not before or mutates_frame(message["code"])
+        ):
+            reply["frame"] = dump_frame(after)
+        conn.send(reply)
+
+
+def _rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        # not linux, the memory limit is not enforced
+        return 0
+
+
+class _Worker:
+
+    def __init__(self, ctx) -> None:
+        self._ctx = ctx
+        self._sent = None
+        self._start()
+
+    def _start(self):
+        self.conn, child = self._ctx.Pipe()
+        self.process = self._ctx.Process(
+            target=_worker_main, args=(child,), daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.version = None
+        self.ready = False
+
+    def wait_ready(self):
+        # the clock of a run starts once the worker has imported the packages
+        if not self.ready:
+            self.conn.recv()
+            self.ready = True
+
+    def restart(self):
+        self.kill()
+        self._start()
+
+    def load(self, df, version):
+        frame = dump_frame(df)
+        self.conn.send({"op": "load", "frame": frame})
+        self.version = version
+        self._sent = frame["shm"]
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        # a frame the worker did not get to read would stay in shared memory
+        if self._sent is not None:
+            _unlink(self._sent)
+            self._sent = None
+
+    def stop(self):
+        try:
+            self.conn.send({"op": "stop"})
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+def _stop_workers(workers) -> None:
+    for worker in workers:
+        worker.stop()
+    workers.clear()
+
+
+class ExecutionEngine:
+    """Run generated code in a pool of warm worker processes.
+
+    The workers import the analysis packages once and keep the session's dataframe
+    between runs, so a run only ships the code. A run that goes over the wall clock
+    limit or the memory limit, or that is cancelled, kills its worker and a fresh one
+    takes its place; the dataframe of the session is left untouched. The mutated
+    `dff` comes back through shared memory. The workers stop with `close`, or when
+    the engine is garbage collected (a Streamlit session that ended).
+
+    Args:
+        df (pd.DataFrame): the dataframe of the session.
+        workers (int): number of warm processes.
+        timeout (float): wall clock limit of a run, in seconds.
+        memory_limit_mb (float): resident memory limit of a worker. None disables it.
+    """
+
+    def __init__(self, df=None, workers=1, timeout=60, memory_limit_mb=None) -> None:
+        methods = mp.get_all_start_methods()
+        if "forkserver" in methods:
+            self._ctx = mp.get_context("forkserver")
+            # the fork server imports the packages once, every worker starts warm
+            self._ctx.set_forkserver_preload(["executor"])
+        else:
+            self._ctx = mp.get_context("spawn")
+
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self._workers = [_Worker(self._ctx) for _ in range(workers)]
+        self._idle = list(self._workers)
+        # the callback holds the workers, not the engine
+        self._finalizer = weakref.finalize(self, _stop_workers, self._workers)
+        self._busy = set()
+        self._cancelled = set()
+        self._lock = threading.Condition()
+        self._df = None
+        self._version = 0
+
+        if df is not None:
+            self.load(df)
+
+    @property
+    def df(self):
+        return self._df
+
+    def load(self, df) -> None:
+        """Make `df` the dataframe of the session and send it to the idle workers."""
+        with self._lock:
+            self._df = df
+            self._version += 1
+            for worker in self._idle:
+                worker.load(df, self._version)
+
+    def run(self, code, dff=None, tables=None, scratch=False):
+        """Run the code in a worker.
+
+        Args:
+            code (str): python code
+            dff (pd.DataFrame): dataframe to run against. When it is not the one the
+                engine holds, it is loaded first.
+            tables (dict): more frames for the code, by name (see
+                `catalog.DatasetCatalog`). They are sent with every run.
+            scratch (bool): run on `dff` sent with the code (a sample, a snapshot)
+                and drop it after; the frame of the session is not touched
+
+        Returns:
+            tuple: ({"output": str} | {"exception": str}, dff after the run)
+        """
+        if not scratch and dff is not None and dff is not self._df:
+            self.load(dff)
+
+        worker = self._acquire()
+        sent = []
+        try:
+            if not scratch and worker.version != self._version:
+                worker.load(self._df, self._version)
+
+            worker.wait_ready()
+            message = {
+                "op": "run",
+                "code": code,
+                "tables": {
+                    name: dump_frame(frame) for name, frame in (tables or {}).items()
+                },
+            }
+            sent = list(message["tables"].values())
+            if scratch:
+                message["frame"] = dump_frame(dff)
+                sent.append(message["frame"])
+            worker.conn.send(message)
+            reply = self._wait(worker)
+
+            if "error" in reply:
+                return {"exception": reply["error"]}, dff if scratch else self._df
+
+            if scratch:
+                after = load_frame(reply["frame"]) if "frame" in reply else dff
+                return reply["result"], after
+
+            if "frame" in reply:
+                with self._lock:
+                    self._df = load_frame(reply["frame"])
+                    self._version += 1
+                    worker.version = self._version
+            elif "exception" in reply["result"]:
+                # the run failed half way, the worker copy can not be trusted
+                worker.version = None
+
+            return reply["result"], self._df
+        except Exception:
+            worker.restart()
+            raise
+        finally:
+            # the worker unlinks the frames it read, not the ones of a killed run
+            for frame in sent:
+                _unlink(frame["shm"])
+            self._release(worker)
+
+    def cancel(self) -> None:
+        """Stop all the runs in progress."""
+        with self._lock:
+            self._cancelled.update(self._busy)
+
+    def close(self) -> None:
+        with self._lock:
+            self._finalizer()
+            self._idle = []
+
+    def _acquire(self):
+        with self._lock:
+            while not self._idle:
+                self._lock.wait()
+            worker = self._idle.pop()
+            self._busy.add(worker)
+            return worker
+
+    def _release(self, worker):
+        with self._lock:
+            self._busy.discard(worker)
+            self._cancelled.discard(worker)
+            if worker in self._workers:
+                self._idle.append(worker)
+            self._lock.notify()
+
+    def _wait(self, worker):
+        start = time.perf_counter()
+
+        while not worker.conn.poll(0.05):
+            error = None
+            if worker in self._cancelled:
+                error = "CancelledError('The run was cancelled')"
+            elif time.perf_counter() - start > self.timeout:
+                error = (
+                    f"TimeoutError('The code ran for more than {self.timeout} seconds')"
+                )
+            elif not worker.process.is_alive():
+                error = "RuntimeError('The worker process died')"
+            elif (
+                self.memory_limit_mb
+                and _rss_mb(worker.process.pid) > self.memory_limit_mb
+            ):
+                error = (
+                    f"MemoryError('The code used more than {self.memory_limit_mb} MB')"
+                )
+
+            if error is not None:
+                worker.restart()
+                return {"error": error}
+
+        return worker.conn.recv()
@@ -0,0 +1,413 @@
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+# per point arrays that follow the x and y values when points are dropped
+POINT_ARRAYS = ("customdata", "text", "hovertext", "ids")
+# bars of a histogram of text values, the others are summed in one bar
+MAX_CATEGORIES = 50
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets downsampling of a line.
+
+    Keeps the first and last points and, from every bucket, the point that makes the
+    largest triangle with the point kept before and the average of the next bucket,
+    so peaks and the shape of the line survive.
+
+    Args:
+        x (np.ndarray): numeric x values, sorted
+        y (np.ndarray): numeric y values
+        threshold (int): number of points to keep
+
+    Returns:
+        np.ndarray: positions of the points kept
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    # average of every bucket, the next bucket's average is the third vertex
+    sizes = np.diff(np.append(edges, n))
+    avg_x = np.add.reduceat(x, edges) / sizes
+    avg_y = np.add.reduceat(y, edges) / sizes
+
+    kept = np.empty(threshold, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        bx, by = x[start:stop], y[start:stop]
+        area = np.abs(
+            (x[a] - avg_x[i + 1]) * (by - y[a]) - (x[a] - bx) * (avg_y[i + 1] - y[a])
+        )
+        a = start + int(area.argmax())
+        kept[i + 1] = a
+
+    return kept
+
+
+def _numeric(values):
+    """Numbers for the arithmetic of the reduction, None when they are not numbers."""
+    values = np.asarray(values)
+    if values.dtype.kind in "iufb":
+        return values.astype(float)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ns]").astype(np.int64).astype(float)
+    try:
+        return pd.to_datetime(values).asi8.astype(float)
+    except (TypeError, ValueError):
+        return None
+
+
+def _trace_dict(trace) -> dict:
+    """Properties of the trace. `to_plotly_json` deep copies the data, which takes
+    seconds for a million dates, so the arrays are shared when plotly allows it; the
+    reduction only ever replaces them."""
+    props = getattr(trace, "_props", None)
+    return dict(props) if isinstance(props, dict) else trace.to_plotly_json()
+
+
+def _points(trace) -> int:
+    if trace.get("z") is not None:
+        return int(np.size(trace["z"]))
+    return max(
+        (len(trace.get(axis)) for axis in ("x", "y") if trace.get(axis) is not None),
+        default=0,
+    )
+
+
+def _take(trace, positions, n):
+    """Keep the points at `positions` in x, y and every per point array."""
+    for key in ("x", "y", *POINT_ARRAYS):
+        values = trace.get(key)
+        if values is not None and np.ndim(values) and len(values) == n:
+            trace[key] = np.asarray(values)[positions]
+    for parent in ("marker", "line"):
+        if trace.get(parent):
+            trace[parent] = dict(trace[parent])
+            for key, values in trace[parent].items():
+                if np.ndim(values) and len(values) == n:
+                    trace[parent][key] = np.asarray(values)[positions]
+    return trace
+
+
+def _to_gl(trace):
+    trace["type"] = "scattergl"
+    trace.pop("cliponaxis", None)
+    return trace
+
+
+def _reduce_line(trace, budget):
+    n = _points(trace)
+    x = (
+        _numeric(trace["x"])
+        if trace.get("x") is not None
+        else np.arange(n, dtype=float)
+    )
+    y = _numeric(trace["y"]) if trace.get("y") is not None else None
+    if x is None or y is None or np.isnan(y).any() or (np.diff(x) < 0).any():
+        # unsorted or missing values, keep every n-th point
+        positions = np.linspace(0, n - 1, budget).astype(int)
+        method = "decimation"
+    else:
+        positions = lttb(x, y, budget)
+        method = "lttb"
+    return _to_gl(_take(trace, positions, n)), method
+
+
+def _reduce_markers(trace, budget, alone, seed=0):
+    n = _points(trace)
+    x = _numeric(trace["x"]) if trace.get("x") is not None else None
+    y = _numeric(trace["y"]) if trace.get("y") is not None else None
+
+    if alone and x is not None and y is not None:
+        # a single cloud of points, the density shows it best
+        valid = ~(np.isnan(x) | np.isnan(y))
+        bins = int(min(200, max(20, np.sqrt(budget))))
+        counts, x_edges, y_edges = np.histogram2d(x[valid], y[valid], bins=bins)
+        z = counts.T.astype(object)
+        z[counts.T == 0] = None
+        heatmap = {
+            "type": "heatmap",
+            "x": (x_edges[:-1] + x_edges[1:]) / 2,
+            "y": (y_edges[:-1] + y_edges[1:]) / 2,
+            "z": z,
+            "colorscale": "Viridis",
+            "colorbar": {"title": {"text": "count"}},
+            "hovertemplate": "x=%{x}<br>y=%{y}<br>count=%{z}<extra></extra>",
+            "name": trace.get("name"),
+            "xaxis": trace.get("xaxis"),
+            "yaxis": trace.get("yaxis"),
+        }
+        if np.asarray(trace["x"]).dtype.kind not in "iufb":
+            heatmap["x"] = pd.to_datetime(heatmap["x"])
+        if np.asarray(trace["y"]).dtype.kind not in "iufb":
+            heatmap["y"] = pd.to_datetime(heatmap["y"])
+        return heatmap, "heatmap"
+
+    positions = np.sort(np.random.default_rng(seed).choice(n, budget, replace=False))
+    return _to_gl(_take(trace, positions, n)), "sampling"
+
+
+def _box_stats(values):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return [np.nan] * 6
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    lower = values[values >= q1 - 1.5 * iqr].min()
+    upper = values[values <= q3 + 1.5 * iqr].max()
+    return [q1, median, q3, lower, upper, values.mean()]
+
+
+def _horizontal(trace, value_axis):
+    """True for a horizontal box or histogram. Without `orientation` plotly draws
+    it vertical, or horizontal when only the other axis is given. None when there
+    are no values."""
+    if trace.get("orientation") in ("h", "v"):
+        horizontal = trace["orientation"] == "h"
+    elif trace.get(value_axis) is not None:
+        horizontal = False
+    else:
+        horizontal = True
+    other = {"x": "y", "y": "x"}[value_axis]
+    if trace.get(other if horizontal else value_axis) is None:
+        return None
+    return horizontal
+
+
+def _reduce_box(trace):
+    horizontal = _horizontal(trace, "y")
+    if horizontal is None:
+        return None, None
+    value_axis, group_axis = ("x", "y") if horizontal else ("y", "x")
+    values = _numeric(trace[value_axis])
+    if values is None:
+        return None, None
+
+    groups = trace.get(group_axis)
+    if groups is None:
+        names, stats = [trace.get(f"{group_axis}0", trace.get("name") or "")], [
+            _box_stats(values)
+        ]
+    else:
+        codes, names = pd.factorize(pd.Series(groups), sort=True)
+        stats = [_box_stats(values[codes == i]) for i in range(len(names))]
+
+    stats = np.array(stats, dtype=float).T
+    box = {
+        key: trace.get(key)
+        for key in (
+            "name",
+            "legendgroup",
+            "offsetgroup",
+            "alignmentgroup",
+            "showlegend",
+            "marker",
+            "orientation",
+            "xaxis",
+            "yaxis",
+        )
+        if trace.get(key) is not None
+    }
+    box.update(
+        type="box",
+        q1=stats[0],
+        median=stats[1],
+        q3=stats[2],
+        lowerfence=stats[3],
+        upperfence=stats[4],
+        mean=stats[5],
+        boxpoints=False,
+        orientation="h" if horizontal else "v",
+    )
+    box[group_axis] = list(names)
+    return box, "box statistics"
+
+
+def _reduce_histogram(trace):
+    horizontal = _horizontal(trace, "x")
+    if horizontal is None:
+        return None, None
+    axis, count_axis = ("y", "x") if horizontal else ("x", "y")
+    if (
+        trace.get(count_axis) is not None
+        or trace.get("histnorm")
+        or trace.get("histfunc")
+    ):
+        # weighted or normalized, the browser has to compute it
+        return None, None
+
+    values = np.asarray(trace[axis])
+    dates = values.dtype.kind == "M" or pd.api.types.infer_dtype(
+        values, skipna=True
+    ) in ("datetime64", "datetime", "date")
+    if values.dtype.kind in "iufb" or dates:
+        numbers = _numeric(values)[~pd.isna(values)]
+        nbins = trace.get(f"nbins{axis}") or "auto"
+        heights, edges = np.histogram(numbers, bins=nbins)
+        centers, width = (edges[:-1] + edges[1:]) / 2, np.diff(edges)
+        if dates:
+            # nanoseconds back to dates, plotly takes the widths in milliseconds
+            centers = pd.to_datetime(centers.astype(np.int64))
+            width = width / 1e6
+    else:
+        counts = pd.Series(values).value_counts()
+        if len(counts) > MAX_CATEGORIES:
+            # the most frequent values, the rest in one bar
+            rest = counts.iloc[MAX_CATEGORIES - 1 :]
+            counts = counts.iloc[: MAX_CATEGORIES - 1]
+            counts.index = counts.index.astype(str)
+            counts[f"({len(rest):,} other values)"] = rest.sum()
+        centers, heights, width = counts.index.to_numpy(), counts.to_numpy(), None
+
+    if len(heights) >= len(values):
+        # as many bars as values, nothing to gain
+        return None, None
+
+    bar = {
+        key: trace.get(key)
+        for key in (
+            "name",
+            "legendgroup",
+            "offsetgroup",
+            "alignmentgroup",
+            "showlegend",
+            "marker",
+            "orientation",
+            "xaxis",
+            "yaxis",
+        )
+        if trace.get(key) is not None
+    }
+    bar.update(type="bar", width=width, orientation="h" if horizontal else "v")
+    bar[axis], bar[count_axis] = centers, heights
+    return bar, "binning"
+
+
+def reduce_figure(fig, max_points=50_000):
+    """Make a plotly figure light enough for the browser.
+
+    Traces above their share of the point budget are reduced: lines with LTTB,
+    a single cloud of markers to a density heatmap (several clouds are sampled),
+    box plots to precomputed statistics and histograms to bars. Reduced scatter
+    traces use WebGL. A note on the chart tells what was done.
+
+    Args:
+        fig (go.Figure): the figure, it is not modified
+        max_points (int): points the whole figure may send to the browser
+
+    Returns:
+        tuple: (figure to show, report or None when nothing was reduced). The report
+            has points_before, points_after, methods and seconds.
+    """
+    start = time.perf_counter()
+    traces = [_trace_dict(trace) for trace in fig.data]
+    points = [_points(trace) for trace in traces]
+    if not traces or sum(points) <= max_points:
+        return fig, None
+
+    budget = max(1000, max_points // len(traces))
+    panels = pd.Series(
+        [(trace.get("xaxis"), trace.get("yaxis")) for trace in traces]
+    ).value_counts()
+
+    reduced, methods = [], []
+    for trace, n in zip(traces, points):
+        kind, method = trace.get("type", "scatter"), None
+        if n > budget:
+            if kind in ("scatter", "scattergl"):
+                # without a mode plotly draws 20 points or more as lines
+                mode = trace.get("mode") or ("lines" if n >= 20 else "markers")
+                if "lines" in mode:
+                    trace, method = _reduce_line(trace, budget)
+                else:
+                    alone = panels[(trace.get("xaxis"), trace.get("yaxis"))] == 1
+                    trace, method = _reduce_markers(trace, budget, alone)
+            elif kind == "box":
+                box, method = _reduce_box(trace)
+                trace = box or trace
+            elif kind == "histogram":
+                bar, method = _reduce_histogram(trace)
+                trace = bar or trace
+        reduced.append(trace)
+        if method:
+            methods.append(method)
+
+    if not methods:
+        return fig, None
+
+    new = go.Figure(data=reduced, layout=fig.layout, skip_invalid=True)
+    after = sum(_points(_trace_dict(trace)) for trace in new.data)
+    new.add_annotation(
+        text=f"Reduced for display: {sum(points):,} to {after:,} points "
+        f"({', '.join(sorted(set(methods)))})",
+        xref="paper",
+        yref="paper",
+        x=0,
+        y=1.06,
+        xanchor="left",
+        showarrow=False,
+        font={"size": 11, "color": "gray"},
+    )
+    report = {
+        "points_before": sum(points),
+        "points_after": after,
+        "methods": sorted(set(methods)),
+        "seconds": time.perf_counter() - start,
+    }
+    return new, report
+
+
+def payload(fig) -> dict:
+    """Size of the figure JSON sent to the browser and the time to build it."""
+    start = time.perf_counter()
+    size = len(fig.to_json())
+    return {"bytes": size, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = ArgumentParser(
+        prog="figures", description="Payload of large figures before and after"
+    )
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--max-points", type=int, default=50_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n = args.points
+    df = pd.DataFrame(
+        {
+            "time": pd.date_range("2020-01-01", periods=n, freq="s"),
+            "value": rng.normal(0, 1, n).cumsum(),
+            "other": rng.normal(0, 1, n),
+            "group": rng.choice(["a", "b", "c"], n),
+        }
+    )
+    figures = {
+        "line": px.line(df, x="time", y="value"),
+        "scatter": px.scatter(df, x="value", y="other"),
+        "scatter by group": px.scatter(df, x="value", y="other", color="group"),
+        "box": px.box(df, x="group", y="other"),
+        "histogram": px.histogram(df, x="other"),
+    }
+    for name, fig in figures.items():
+        before = payload(fig)
+        small, report = reduce_figure(fig, args.max_points)
+        after = payload(small)
+        print(
+            f"{name}: {before['bytes'] / 2**20:.1f} MB in {before['seconds']:.2f}s -> "
+            f"{after['bytes'] / 2**20:.2f} MB in {after['seconds']:.2f}s "
+            f"(reduction {report['seconds'] if report else 0:.2f}s, "
+            f"{', '.join(report['methods']) if report else 'none'})"
+        )
+
+
+if __name__ == "__main__":
+    main()
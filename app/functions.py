@@ -4,8 +4,9 @@ import inspect
 from typing import Literal
 from pathlib import Path
 import pandas as pd
-from openai import OpenAI
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from ingest import load_table
+from clients import client_registry
 
 
 def print_colored(text, color, end="\n"):
@@ -32,25 +33,21 @@ def clean_answer(x: str) -> str:
 
 
 def read_table(pth):
-    pth = Path(pth)
-
-    if pth.suffix == ".csv":
-        if pth.exists():
-            df = pd.read_csv(pth)
-        else:
-            raise FileExistsError(f"The file {pth} is not there")
-    else:
-        raise ValueError(f"The file {pth} is not csv")
+    """Load a csv (plain, .gz or .zst), parquet or feather file through the ingestion
+    pipeline, see `ingest.load_table`."""
+    df, _ = load_table(Path(pth))
 
     return df
 
 
 def check_api_key(api_key: str, which: Literal["openai", "gemini"]) -> str:
-    """Agent to check if the API key is valid. Make a a simple request to the model and
-    depending on the answer it is determined if the key is valid.
+    """Agent to check if the API key is valid. Make the cheapest authenticated request
+    to the provider (list the models, no tokens generated) and depending on the answer
+    it is determined if the key is valid.
 
     Args:
-        api_key (str): api key for gemini
+        api_key (str): api key for openai or gemini
+        which (str): openai | gemini
 
     Returns:
         str: empty_key | valid_key | invalid_key | error
@@ -60,31 +57,26 @@ def check_api_key(api_key: str, which: Literal["openai", "gemini"]) -> str:
         return "empty_key"
 
     if which == "openai":
-        client = OpenAI(api_key=api_key)
+        # the pooled client, the agent of this key reuses the connection
+        client = client_registry().openai(api_key).client.with_options(timeout=10)
         try:
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": "Tell me joke"}],
-            )
+            client.models.list()
             return "valid_key"
         except Exception as e:
-            if e.status_code == 401:
+            if getattr(e, "status_code", None) == 401:
                 return "invalid_key"
             else:
                 return f"There was an error: {e}"
 
     elif which == "gemini":
-        genai.configure(api_key=api_key)
-
-        client = genai.GenerativeModel(
-            "gemini-1.5-flash",
-        )
+        # a client of its own, genai.configure would change the key of every session
+        client = glm.ModelServiceClient(client_options={"api_key": api_key})
 
         try:
-            resp = client.generate_content("Tell me a joke")
+            next(iter(client.list_models(page_size=1)), None)
             return "valid_key"
         except Exception as e:
-            if e.reason == "API_KEY_INVALID":
+            if "API_KEY_INVALID" in str(getattr(e, "reason", None) or e):
                 return "invalid_key"
             else:
                 return f"There was an error: {e}"
@@ -109,31 +101,3 @@ def process_json(jsn):
     # )
 
     return jsn
-
-
-def replace_figure(text):
-
-    main_pattern = r"fig\.show\([^)]*\)"
-    with_space_pattern = r"[ ]{0,}fig\.show\([^)]*\)"
-    space_pattern = r"[ ]{0,}"
-
-    sp = re.search(with_space_pattern, text)
-
-    if sp is None:
-        return text
-
-    sp = sp.span()
-    short_text = text[sp[0] : sp[1]]
-
-    sp = re.search(space_pattern, short_text).span()
-    space = short_text[sp[0] : sp[1]]
-
-    replacement = (
-        "with open('./app/plots/temp_fig.json', 'w') as f:\n"
-        + space
-        + "        f.write(fig.to_json(pretty=True))"
-    )
-
-    text = re.sub(main_pattern, replacement, text)
-
-    return text
@@ -0,0 +1,161 @@
+import ast
+import json
+from caching import fingerprint
+from code_analysis import mutates_frame, parse
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except ImportError:
+    _encoding = None
+
+
+def count_tokens(text) -> int:
+    """Tokens of the text with tiktoken when it is installed, otherwise estimated at
+    four characters per token."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def _shorten(text, limit=80) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[: limit - 3] + "..."
+
+
+def schema_columns(schema) -> list:
+    """Column names of a profile JSON (see `DatasetProfile.to_prompt`)."""
+    try:
+        return list(json.loads(schema).get("columns", {}))
+    except (ValueError, AttributeError):
+        return []
+
+
+def summarize_code(code) -> str:
+    """One line telling what the code did to `dff`, from the statements that assign
+    to it; read only code is only a question."""
+    if not mutates_frame(code):
+        return "read only"
+
+    tree = parse(code)
+    if tree is None:
+        return "changed dff"
+
+    steps = []
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Assign, ast.AugAssign)):
+            continue
+        for target in getattr(node, "targets", [getattr(node, "target", None)]):
+            if isinstance(target, ast.Name) and target.id == "dff":
+                steps.append("dff = " + _shorten(ast.unparse(node.value), 60))
+            elif (
+                isinstance(target, ast.Subscript)
+                and isinstance(target.value, ast.Name)
+                and target.value.id == "dff"
+            ):
+                steps.append(f"set column {_shorten(ast.unparse(target.slice), 40)}")
+
+    return "; ".join(steps) if steps else "changed dff"
+
+
+class ConversationHistory:
+    """History of the conversation sent with every question, kept under a token
+    budget so the prompt does not grow with the session.
+
+    The last `recent_turns` turns are sent as they were: question and code. The
+    profile of the data is sent with the question already, so a turn only mentions
+    its columns when they differ from the current ones. Older turns are compacted to
+    one line, the changes they made to `dff` first; when even the summaries are over
+    the budget, the oldest are dropped and counted.
+
+    Args:
+        max_tokens (int): budget of the rendered history.
+        recent_turns (int): turns kept verbatim while they fit in the budget.
+    """
+
+    def __init__(self, max_tokens=1500, recent_turns=4) -> None:
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.turns = []
+
+    def add(self, question, schema, code) -> None:
+        self.turns.append(
+            {
+                "question": question,
+                "code": code,
+                "schema": fingerprint(schema),
+                "columns": schema_columns(schema),
+                "summary": None,
+            }
+        )
+
+    def clear(self) -> None:
+        self.turns = []
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def _verbatim(self, turn, schema) -> dict:
+        item = {"question": turn["question"], "code": turn["code"]}
+        if turn["schema"] != schema:
+            item["columns then"] = turn["columns"]
+        return item
+
+    def _summary(self, turn) -> str:
+        if turn["summary"] is None:
+            if turn["code"] == "no code":
+                turn["summary"] = "no code"
+            else:
+                turn["summary"] = summarize_code(turn["code"])
+        return f"{_shorten(turn['question'])} -> {turn['summary']}"
+
+    def render(self, schema="") -> str:
+        """The history as JSON, within `max_tokens`.
+
+        Args:
+            schema (str): profile sent with the current question
+        """
+        if not self.turns:
+            return ""
+
+        current = fingerprint(schema)
+        recent = min(self.recent_turns, len(self.turns))
+
+        while True:
+            older = self.turns[: len(self.turns) - recent]
+            # the changes made to dff explain its current state, keep them longest
+            summaries = [(self._summary(t), t["summary"]) for t in older]
+            changes = [
+                s for s, kind in summaries if kind not in ("read only", "no code")
+            ]
+            questions = [s for s, kind in summaries if kind in ("read only", "no code")]
+
+            dropped = 0
+            while True:
+                rendered = {}
+                if dropped:
+                    rendered["omitted"] = f"{dropped} earlier turns"
+                if changes:
+                    rendered["earlier changes to dff"] = changes
+                if questions:
+                    rendered["earlier questions"] = questions
+                rendered["recent turns"] = [
+                    self._verbatim(t, current) for t in self.turns[len(older) :]
+                ]
+                text = json.dumps(rendered)
+                if count_tokens(text) <= self.max_tokens or not (changes or questions):
+                    break
+                if questions:
+                    questions.pop(0)
+                else:
+                    changes.pop(0)
+                dropped += 1
+
+            if count_tokens(text) <= self.max_tokens or recent == 0:
+                return text
+            # the recent turns alone are over the budget, compact one more
+            recent -= 1
+
+    def tokens(self, schema="") -> int:
+        return count_tokens(self.render(schema))
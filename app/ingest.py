@@ -0,0 +1,239 @@
+import csv
+import gzip
+import time
+from pathlib import Path
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    feather = None
+    CSV_ENGINE = "c"
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+}
+# file types accepted by the uploader
+UPLOAD_TYPES = ["csv", "gz", "zst", "zstd", "parquet", "pq", "feather", "arrow"]
+
+
+def detect_format(name) -> tuple:
+    """Return (format, compression) from the file name, like data.csv.zst."""
+    suffixes = [s.lower() for s in Path(str(name)).suffixes]
+    compression = None
+    if suffixes and suffixes[-1] in COMPRESSIONS:
+        compression = COMPRESSIONS[suffixes.pop()]
+
+    if not suffixes or suffixes[-1] not in FORMATS:
+        raise ValueError(
+            f"The file {name} is not csv (optionally .gz / .zst), parquet or feather"
+        )
+
+    return FORMATS[suffixes[-1]], compression
+
+
+def _read_head(f, compression, size) -> bytes:
+    """The first `size` bytes of the data in `f`, decompressed."""
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f).read(size)
+    if compression == "zstd":
+        if zstandard is None:
+            return b""
+        reader = zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+        head = b""
+        while len(head) < size:
+            chunk = reader.read(size - len(head))
+            if not chunk:
+                break
+            head += chunk
+        return head
+    return f.read(size)
+
+
+def sniff_delimiter(source, compression) -> str:
+    """Guess the delimiter from the first lines, the bundled student-mat.csv uses ;"""
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            head = _read_head(f, compression, 65536)
+    else:
+        try:
+            head = _read_head(source, compression, 65536)
+        finally:
+            source.seek(0)
+
+    lines = head.decode("utf-8", errors="ignore").splitlines()[:20]
+    try:
+        return csv.Sniffer().sniff("\n".join(lines), delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
+
+def frame_memory(df) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def optimize_frame(df, category_ratio=0.5):
+    """Shrink the frame without changing the values.
+
+    Floats go to float32 only when no value changes, strings become categoricals
+    when they repeat a lot and Arrow backed strings otherwise. Integers are kept:
+    in a small type the sums and products of the generated code overflow.
+
+    Args:
+        df (pd.DataFrame): frame to shrink, it is not modified
+        category_ratio (float): maximum unique values / rows for a categorical
+
+    Returns:
+        pd.DataFrame: the optimized frame
+    """
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        kind = series.dtype.kind
+
+        if kind == "f":
+            small = series.astype(np.float32)
+            if np.array_equal(
+                small.to_numpy(np.float64), series.to_numpy(), equal_nan=True
+            ):
+                series = small
+        elif kind == "O" and len(series):
+            unique = series.nunique(dropna=True)
+            strings = pd.api.types.infer_dtype(series, skipna=True) == "string"
+            if strings and unique / len(series) <= category_ratio:
+                series = series.astype("category")
+            elif strings and CSV_ENGINE == "pyarrow":
+                series = series.astype("string[pyarrow]")
+
+        columns[col] = series
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+def load_table(source, name=None, optimize=True) -> tuple:
+    """Load a table with the fastest reader available for its format.
+
+    Args:
+        source: a path or a file object (like a Streamlit upload)
+        name (str): file name, used for the format when `source` has none
+        optimize (bool): shrink the dtypes after loading (see `optimize_frame`)
+
+    Returns:
+        tuple: (pd.DataFrame, report with the load time and the memory before and
+            after the dtype optimization)
+    """
+    name = name or getattr(source, "name", source)
+    fmt, compression = detect_format(name)
+
+    if isinstance(source, (str, Path)) and not Path(source).exists():
+        raise FileNotFoundError(f"The file {source} is not there")
+
+    start = time.perf_counter()
+
+    if fmt == "csv":
+        engine = CSV_ENGINE
+        df = pd.read_csv(
+            source,
+            engine=engine,
+            compression=compression,
+            sep=sniff_delimiter(source, compression),
+        )
+    elif fmt == "parquet":
+        engine = "pyarrow"
+        df = pd.read_parquet(source, engine="pyarrow", memory_map=True)
+    else:
+        engine = "pyarrow"
+        if feather is None:
+            df = pd.read_feather(source)
+        else:
+            df = feather.read_table(source, memory_map=True).to_pandas()
+
+    loaded = time.perf_counter()
+    report = {
+        "source": str(name),
+        "format": fmt,
+        "compression": compression,
+        "engine": engine,
+        "rows": len(df),
+        "columns": df.shape[1],
+        "load_seconds": loaded - start,
+    }
+
+    if optimize:
+        report["memory_before_mb"] = frame_memory(df) / 2**20
+        df = optimize_frame(df)
+        report["optimize_seconds"] = time.perf_counter() - loaded
+
+    report["memory_mb"] = frame_memory(df) / 2**20
+
+    return df, report
+
+
+def format_report(report) -> str:
+    text = "{source}: {rows} rows x {columns} columns in {load_seconds:.2f}s ({engine})".format(
+        **report
+    )
+    if "memory_before_mb" in report:
+        text += ", memory {memory_before_mb:.2f} MB -> {memory_mb:.2f} MB".format(
+            **report
+        )
+    return text
+
+
+def synthetic_csv(path, rows, chunk=1_000_000, seed=0):
+    """Write a csv with numeric, low and high cardinality columns, for benchmarks."""
+    rng = np.random.default_rng(seed)
+    groups = np.array(["group A", "group B", "group C", "group D", "group E"])
+
+    with open(path, "w") as f:
+        for start in range(0, rows, chunk):
+            n = min(chunk, rows - start)
+            pd.DataFrame(
+                {
+                    "id": np.arange(start, start + n),
+                    "group": groups[rng.integers(0, len(groups), n)],
+                    "flag": rng.integers(0, 2, n).astype(bool),
+                    "score": rng.integers(0, 101, n),
+                    "value": rng.normal(50, 15, n).round(2),
+                    "label": np.char.add("item_", rng.integers(0, n, n).astype(str)),
+                }
+            ).to_csv(f, header=start == 0, index=False)
+    return path
+
+
+def main():
+    parser = ArgumentParser(prog="ingest", description="Load tables and report")
+    parser.add_argument("files", nargs="*", help="Tables to load")
+    parser.add_argument(
+        "--synthetic", type=int, help="Also write and load a synthetic csv of N rows"
+    )
+    args = parser.parse_args()
+
+    files = list(args.files)
+    Path("./app/cache").mkdir(parents=True, exist_ok=True)
+    if args.synthetic:
+        files.append(
+            synthetic_csv(f"./app/cache/synthetic-{args.synthetic}.csv", args.synthetic)
+        )
+
+    for file in files:
+        _, report = load_table(file)
+        print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
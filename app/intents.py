@@ -0,0 +1,354 @@
+import re
+
+# request words, they say nothing about what is asked
+STOPWORDS = {
+    "a", "all", "an", "and", "any", "are", "be", "by", "can", "could",
+    "data", "dataframe", "dataset", "df", "dff", "display", "do", "does", "each",
+    "every", "for", "frame", "from", "get", "give", "have", "has", "how", "i", "in",
+    "is", "it", "its", "list", "me", "my", "of", "on", "one", "other", "please",
+    "print", "separate", "show", "table", "tell", "that", "the", "their", "them",
+    "there", "these", "they", "this", "to", "under", "we", "what",
+    "which", "with", "you", "line", "below", "make", "see",
+    "want", "would", "like", "know", "find", "about",
+}  # fmt: skip
+
+# words of questions that change the data, draw or model: always for the model
+BLOCKERS = {
+    "add", "chart", "clean", "convert", "create", "delete", "draw", "drop", "encode",
+    "encoding", "fill", "filter", "graph", "group", "histogram", "impute", "join",
+    "merge", "model", "normalize", "plot", "predict", "regression", "remove",
+    "rename", "replace", "save", "scale", "set", "split", "standardize", "test",
+    "transform", "visualize", "where", "without", "except", "previous", "last",
+    "before", "after", "again", "change",
+}  # fmt: skip
+
+# words that restrict the columns: numeric or text
+QUALIFIERS = {
+    "numeric": "numeric",
+    "numerical": "numeric",
+    "object": "text",
+    "categorical": "text",
+    "category": "text",
+    "text": "text",
+    "string": "text",
+    "qualitative": "text",
+    "quantitative": "numeric",
+}
+
+COUNT_WORDS = {"many", "number", "count", "total", "how"}
+# the words of the columns, known to the families that take columns
+COLUMN_WORDS = ("column", "variable", "feature", "field", "attribute")
+
+
+def normalize(word) -> str:
+    """Lower case, without a plural s (values -> value, uniques -> unique)."""
+    word = word.lower()
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    return word
+
+
+def tokenize(text) -> list:
+    return [normalize(word) for word in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+def _words(*words) -> set:
+    return {normalize(word) for word in words}
+
+
+class Intent:
+    """A family of questions with a deterministic answer.
+
+    Args:
+        name (str): name of the family, in the counters
+        required (list): groups of words, the question needs one word of every group
+        words (set): other words the question may use
+        template (callable): (selection, match) -> code. `selection` is the
+            expression of the columns asked for
+        slots (bool): the question may name columns
+    """
+
+    def __init__(self, name, required, words=(), template=None, slots=True) -> None:
+        self.name = name
+        self.required = [_words(*group) for group in required]
+        self.words = _words(*words).union(*self.required)
+        if slots:
+            self.words |= _words(*COLUMN_WORDS)
+        self.template = template
+        self.slots = slots
+
+
+def _guarded(selection, body) -> str:
+    # an empty selection (no numeric columns...) is said, not raised
+    return (
+        f"selected = {selection}\n"
+        "if selected.shape[1] == 0:\n"
+        "    print('There are no columns of that kind in the dataframe')\n"
+        "else:\n" + "".join(f"    {line}\n" for line in body.splitlines())
+    )
+
+
+def _names(selection, match):
+    return _guarded(selection, "print('\\n'.join(map(str, selected.columns)))")
+
+
+def _types(selection, match):
+    return _guarded(selection, "print(selected.dtypes.to_string())")
+
+
+def _head(selection, match):
+    rows = match["number"] or (1 if match["one_row"] else 5)
+    return _guarded(selection, f"print(selected.head({rows}).to_string())")
+
+
+def _shape(selection, match):
+    return "print(f'The dataframe has {dff.shape[0]} rows and {dff.shape[1]} columns')"
+
+
+def _missing(selection, match):
+    return _guarded(
+        selection,
+        "missing = selected.isna().sum().sort_values(ascending=False)\n"
+        "print(pd.DataFrame({'missing': missing, "
+        "'percent': (missing / max(len(selected), 1) * 100).round(2)}).to_string())",
+    )
+
+
+def _unique(selection, match):
+    if match["columns"] and not match["counted"]:
+        # the values themselves
+        return _guarded(
+            selection,
+            "for col in selected.columns:\n"
+            "    values = selected[col].dropna().unique()\n"
+            "    more = f' ... ({len(values)} values)' if len(values) > 50 else ''\n"
+            "    print(f'{col}: ' + ', '.join(map(str, values[:50])) + more)",
+        )
+    return _guarded(
+        selection, "print(selected.nunique().sort_values(ascending=False).to_string())"
+    )
+
+
+def _describe(selection, match):
+    include = "" if match["qualifier"] == "numeric" else "include='all'"
+    return _guarded(selection, f"print(selected.describe({include}).to_string())")
+
+
+def _correlation(selection, match):
+    return _guarded(
+        f"{selection}.select_dtypes('number')",
+        "print(selected.corr().round(3).to_string())",
+    )
+
+
+INTENTS = [
+    Intent(
+        "column_names",
+        [(*COLUMN_WORDS, "name", "header")],
+        ("name", "header", "available"),
+        _names,
+    ),
+    Intent(
+        "dtypes",
+        [("type", "dtype", "datatype", "kind")],
+        ("data", "kind", "format"),
+        _types,
+    ),
+    Intent(
+        "head",
+        [("first", "head", "top", "preview")],
+        ("row", "record", "few", "some", "observation"),
+        _head,
+        # "the first column" is not a question about rows
+        slots=False,
+    ),
+    Intent(
+        "shape",
+        [
+            ("row", "record", "observation", "shape", "size", "dimension", "column"),
+            ("many", "number", "count", "shape", "size", "dimension", "total"),
+        ],
+        ("row", "column", "record", "observation", "big", "large"),
+        _shape,
+        slots=False,
+    ),
+    Intent(
+        "missing_values",
+        [("missing", "null", "nan", "na", "empty", "blank", "none")],
+        ("value", "count", "many", "number", "sort", "sorted", "them", "order"),
+        _missing,
+    ),
+    Intent(
+        "unique_values",
+        [("unique", "distinct", "cardinality", "nunique", "different")],
+        ("value", "count", "many", "number", "sort", "sorted", "order", "level"),
+        _unique,
+    ),
+    Intent(
+        "describe",
+        [("describe", "description", "summary", "summarize", "statistic", "stats")],
+        ("descriptive", "basic", "main", "summary", "statistic"),
+        _describe,
+    ),
+    Intent(
+        "correlation",
+        [("correlation", "corr", "correlated", "correlate")],
+        ("matrix", "between", "coefficient", "pearson"),
+        _correlation,
+    ),
+]
+
+
+class IntentMatcher:
+    """Answer the common questions about the dataframe without the model.
+
+    A question is matched against the families of `INTENTS` (column names, types,
+    first rows, size, missing values, unique values, description, correlation). The
+    columns it names are filled in from the current schema, "numeric" and
+    "object"/"categorical" restrict the columns to one kind. The confidence is the
+    share of the words of the question (without the request words) that the
+    family knows; up to `threshold`, with a word next to "column" that is not a
+    column, or with a word that asks to change, plot or model the data, the
+    question goes to the model.
+
+    The answer is vetted code from the template of the family, vectorized and
+    read only, that goes through the same checks and run as the code of the model.
+
+    Args:
+        threshold (float): the confidence has to be above it to answer locally
+        intents (list): the families, `INTENTS` by default
+    """
+
+    def __init__(self, threshold=0.8, intents=None) -> None:
+        self.threshold = threshold
+        self.intents = intents if intents is not None else INTENTS
+
+    def _columns(self, tokens, columns, keywords):
+        """The columns named in the question, longest names first, and the positions
+        of their words."""
+        found, used = [], set()
+        names = sorted(
+            ((tokenize(str(col)), col) for col in columns),
+            key=lambda item: -len(item[0]),
+        )
+        for words, col in names:
+            # a column called like a word of the question family is the word
+            if not words or (len(words) == 1 and words[0] in keywords):
+                continue
+            for start in range(len(tokens) - len(words) + 1):
+                span = set(range(start, start + len(words)))
+                if tokens[start : start + len(words)] == words and not span & used:
+                    found.append(col)
+                    used |= span
+                    break
+        order = {col: i for i, col in enumerate(columns)}
+        return sorted(found, key=order.get), used
+
+    def _score(self, intent, tokens, columns):
+        if not all(group & set(tokens) for group in intent.required):
+            return None
+
+        found, used = (
+            self._columns(tokens, columns, intent.words)
+            if intent.slots
+            else ([], set())
+        )
+        content = [
+            (i, token)
+            for i, token in enumerate(tokens)
+            if token not in STOPWORDS or token in intent.words
+        ]
+        known = {
+            i
+            for i, token in content
+            if i in used
+            or token in intent.words
+            or token.isdigit()
+            or (intent.slots and QUALIFIERS.get(token))
+        }
+        confidence = len(known) / len(content) if content else 0.0
+        column_words = _words(*COLUMN_WORDS)
+        if intent.slots and any(
+            i not in known
+            and {tokens[j] for j in (i - 1, i + 1) if 0 <= j < len(tokens)}
+            & column_words
+            for i, _ in content
+        ):
+            # "the sex column" names a column the data does not have
+            confidence = 0.0
+        qualifiers = {QUALIFIERS[t] for t in tokens if QUALIFIERS.get(t)}
+        numbers = [int(t) for t in tokens if t.isdigit()]
+        return {
+            "intent": intent.name,
+            "confidence": confidence,
+            "columns": found,
+            "qualifier": qualifiers.pop() if len(qualifiers) == 1 else None,
+            "number": numbers[0] if numbers else None,
+            "counted": bool(COUNT_WORDS & set(tokens)),
+            "specific": len(intent.required),
+        }
+
+    def match(self, question, columns, tables=()) -> dict:
+        """The best family for the question, None when the model should answer.
+
+        Args:
+            question (str): question of the user
+            columns (list): columns of `dff`
+            tables (list): other names the code can use (see `catalog`), a question
+                about them goes to the model
+
+        Returns:
+            dict: {"intent", "confidence", "columns", "answer", "explanation"}
+        """
+        words = [w.lower() for w in re.findall(r"[A-Za-z0-9]+", question)]
+        tokens = [normalize(w) for w in words]
+        if not tokens or BLOCKERS & set(tokens):
+            return None
+        text = " ".join(tokens)
+        if any(" ".join(tokenize(name)) in text for name in tables):
+            return None
+
+        scores = [
+            score
+            for score in (
+                self._score(intent, tokens, columns) for intent in self.intents
+            )
+            if score is not None
+        ]
+        if not scores:
+            return None
+        best = max(scores, key=lambda s: (s["confidence"], s["specific"]))
+        if best["confidence"] <= self.threshold:
+            return None
+
+        # "the first row" is one row, "the first rows" a few
+        best["one_row"] = "row" in words and "rows" not in words
+        intent = next(i for i in self.intents if i.name == best["intent"])
+        if best["columns"]:
+            selection = f"dff[{best['columns']!r}]"
+        elif best["qualifier"] == "numeric":
+            selection = "dff.select_dtypes('number')"
+        elif best["qualifier"] == "text":
+            selection = "dff.select_dtypes(exclude=['number', 'bool', 'datetime'])"
+        else:
+            selection = "dff"
+
+        return {
+            "intent": best["intent"],
+            "confidence": best["confidence"],
+            "columns": best["columns"],
+            "answer": intent.template(selection, best),
+            "explanation": f"Answered locally with the {best['intent']} template, "
+            "the model was not asked.",
+        }
+
+
+_matcher = None
+
+
+def default_matcher() -> IntentMatcher:
+    """Process wide matcher, the intents hold no state."""
+    global _matcher
+    if _matcher is None:
+        _matcher = IntentMatcher()
+    return _matcher
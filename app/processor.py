@@ -1,19 +1,228 @@
+import os
 from argparse import ArgumentParser
-from functions import read_table
+from ingest import load_table, format_report
+from backends import DuckDbDataset
 from reason_agents import DfOaCodeAgent
+from caching import default_cache
+from executor import ExecutionEngine
+from telemetry import Telemetry, JsonlSink, PrometheusSink
+from clients import client_registry
+from batch import BatchRunner, read_questions, write_report
+from sessions import save_session, load_session, session_path
+from catalog import DatasetCatalog
+from intents import default_matcher
 
 parser = ArgumentParser(prog="Data Chat")
-parser.add_argument("filename", help="The path for CSV file")
+parser.add_argument(
+    "filename", help="The path for CSV (.csv, .csv.gz, .csv.zst), parquet or feather"
+)
 parser.add_argument("api_key", help="OpenAI api key")
 parser.add_argument("-m", "--model", help="Default is gpt-4o-mini")
+parser.add_argument(
+    "--no-cache", action="store_true", help="Always ask the model, skip the cache"
+)
+parser.add_argument(
+    "--no-local",
+    action="store_true",
+    help="Ask the model the common questions too (column names, types...)",
+)
+parser.add_argument(
+    "--no-vectorize",
+    action="store_true",
+    help="Run the loops of the generated code as they are",
+)
+parser.add_argument(
+    "--stream", action="store_true", help="Print the code while it is generated"
+)
+parser.add_argument(
+    "--isolated",
+    action="store_true",
+    help="Run the generated code in a separate worker process",
+)
+parser.add_argument(
+    "--timeout", type=float, default=60, help="Seconds a script may run (isolated)"
+)
+parser.add_argument(
+    "--memory-limit", type=float, help="MB of memory a script may use (isolated)"
+)
+parser.add_argument(
+    "--backend",
+    choices=("pandas", "duckdb"),
+    default="pandas",
+    help="duckdb keeps the data on disk, for files larger than the memory",
+)
+parser.add_argument(
+    "--execution",
+    choices=("full", "sample_first", "confirm"),
+    default="full",
+    help="Run the code on a sample first; confirm asks before the full run",
+)
+parser.add_argument(
+    "--telemetry", help="Append the timings and token counts to this JSONL file"
+)
+parser.add_argument(
+    "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+)
+parser.add_argument(
+    "--session",
+    help="Resume the session saved under this name (instead of loading the file) "
+    "and save it there on exit and with :save",
+)
+parser.add_argument(
+    "--tables",
+    nargs="+",
+    help="More tables the code can use next to the file, named after the files "
+    "(student-mat.csv is student_mat). They are loaded when a question needs them",
+)
+parser.add_argument(
+    "--batch",
+    help="Answer the questions of this file (one per line, or a JSON list) and exit",
+)
+parser.add_argument(
+    "--concurrency", type=int, default=8, help="Requests to the model at once (batch)"
+)
+parser.add_argument(
+    "--requests-per-minute", type=int, help="Rate limit of the provider (batch)"
+)
+parser.add_argument(
+    "--report", help="Folder of the batch report, default ./app/cache/reports/<date>"
+)
 args = parser.parse_args()
 # USE a short description of the table before asking.
 
 
-def cycle_message(dff) -> None:
+def stream_answer(cda, question):
+    """Print the generated code as it arrives and return the final response."""
+    resp = None
+    field = None
+    for event in cda.generate_content_stream(question):
+        if event["type"] == "delta":
+            if event["field"] != field:
+                field = event["field"]
+                print(f"\n[{field}]")
+            print(event["text"], end="", flush=True)
+        else:
+            resp = event["result"]
+    print()
+    return resp
+
+
+def version_command(cda, command) -> None:
+    """:undo | :redo | :versions | :checkout <position>"""
+    name, _, arg = command[1:].partition(" ")
+
+    if cda.snapshots is None:
+        print("Versions are not kept with the duckdb backend")
+        return
+
+    if name == "undo":
+        cda.undo()
+    elif name == "redo":
+        cda.redo()
+    elif name == "checkout" and arg.strip().lstrip("-").isdigit():
+        try:
+            cda.checkout(int(arg))
+        except IndexError as e:
+            print(e)
+            return
+    elif name != "versions":
+        print(version_command.__doc__)
+        return
+
+    for v in cda.snapshots.versions():
+        mark = "*" if v["current"] else " "
+        print(
+            f"{mark} {v['position']}: {v['label']} {v['shape']} "
+            f"+{v['own_bytes'] / 2**20:.2f} MB (shared {v['shared_bytes'] / 2**20:.2f} MB)"
+        )
+
+
+def create_agent(dff):
+    """The agent, with the executor and telemetry chosen on the command line."""
+
+    executor = None
+    if args.isolated:
+        executor = ExecutionEngine(
+            timeout=args.timeout, memory_limit_mb=args.memory_limit
+        )
+
+    telemetry = Telemetry()
+    if args.telemetry:
+        telemetry.add_sink(JsonlSink(args.telemetry))
+    if args.metrics_port:
+        prometheus = PrometheusSink()
+        prometheus.serve(args.metrics_port)
+        telemetry.add_sink(prometheus)
+
+    cda = DfOaCodeAgent(
+        dff,
+        api_key=args.api_key,
+        diagnostics=True,
+        cache=None if args.no_cache else default_cache(),
+        executor=executor,
+        execution_mode=args.execution,
+        catalog=DatasetCatalog(args.tables) if args.tables else None,
+        intents=None if args.no_local else default_matcher(),
+        vectorize=not args.no_vectorize,
+        telemetry=telemetry,
+    )
+    return cda, telemetry, executor
+
+
+def run_batch(dff) -> None:
+    """Answer the questions of the --batch file and write the report."""
+
+    questions = read_questions(args.batch)
+    cda, telemetry, executor = create_agent(dff)
+    if cda.execution_mode == "confirm":
+        # nobody to confirm in a batch, the preview is kept in the report
+        cda.execution_mode = "sample_first"
+
+    try:
+        runner = BatchRunner(
+            cda, concurrency=args.concurrency, per_minute=args.requests_per_minute
+        )
+        report = runner.run(questions)
+    finally:
+        if executor is not None:
+            executor.close()
+
+    folder = args.report or os.path.join(
+        ".", "app", "cache", "reports", report["date"].replace(":", "-")
+    )
+    write_report(report, folder)
+    failed = sum(
+        1
+        for item in report["items"]
+        if item["response"] is None or "exception" in item["result"].get("code_run", {})
+    )
+    print(
+        f"{report['questions']} questions in {report['wall_seconds']:.1f}s "
+        f"(one after the other: {report['sequential_seconds']:.1f}s), "
+        f"{failed} failed. Report in {folder}"
+    )
+
+
+def save(cda) -> None:
+    if args.session and cda.dataset is None:
+        try:
+            saved = save_session(session_path(args.session), cda)
+        except Exception as e:
+            print(f"The session could not be saved: {e}")
+            return
+        print(
+            f"Session saved in {session_path(args.session)} "
+            f"({saved['mb']:.1f} MB, {saved['seconds']:.2f}s)"
+        )
+        if saved["as_text"]:
+            print("Saved as text: " + ", ".join(saved["as_text"]))
+
+
+def cycle_message(dff, history=()) -> None:
     """Create a cycle where the user asks a question and the program responds."""
 
-    cda = DfOaCodeAgent(dff, api_key=args.api_key, diagnostics=True)
+    cda, telemetry, executor = create_agent(dff)
+    cda.history.turns = list(history)
 
     try:
         while True:
@@ -23,7 +232,34 @@ def cycle_message(dff) -> None:
             # empty questions are not accepted
             if question == "" or question is None:
                 continue
-            resp = cda.generate_content(question)
+
+            if question == ":save":
+                save(cda)
+                continue
+            if question.startswith(":"):
+                version_command(cda, question)
+                continue
+            if args.stream:
+                resp = stream_answer(cda, question)
+            else:
+                resp = cda.generate_content(question)
+
+            if resp and resp.get("vectorized", {}).get("rewritten"):
+                print(
+                    "Loops rewritten, {:.0f}x faster on the sample".format(
+                        resp["vectorized"]["measured_speedup"]
+                    )
+                )
+            if resp and resp.get("preview"):
+                preview = resp["preview"]
+                print(f"\nPreview on a sample of {resp['sample_rows']} rows:")
+                print(preview.get("output", preview.get("exception")))
+                if resp.get("pending"):
+                    if input("Run on the full data? [y/N] ").lower().startswith("y"):
+                        resp = cda.run_pending()
+                    else:
+                        cda.pending = None
+                        continue
 
             # print(resp)
             # breakpoint()
@@ -45,13 +281,44 @@ def cycle_message(dff) -> None:
             else:
                 print("\nNo response was returned\n")
     except KeyboardInterrupt:
+        save(cda)
+        if cda.cache is not None:
+            print(f"\nCache: {cda.cache.stats}")
+        print(f"\nMemo: {cda.memo_stats}")
+        for stage in telemetry.summary():
+            print(
+                "{stage}: {count} runs, p50 {p50:.3f}s, p95 {p95:.3f}s".format(**stage)
+            )
+        print(telemetry.totals())
+        print(f"Connections: {client_registry().stats}")
         print("\nBye bye!")
+    finally:
+        if executor is not None:
+            executor.close()
 
 
 def main():
+    if args.session is not None and not args.session.strip():
+        parser.error("--session needs a name")
     # create data
-    dff = read_table(args.filename)
-    cycle_message(dff)
+    history = []
+    if args.session and (session_path(args.session) / "session.json").exists():
+        session = load_session(session_path(args.session))
+        dff, history = session["frame"], session["history"]
+        print(
+            f"Session {args.session} of {session['saved']}: {dff.shape} with "
+            f"{len(history)} questions, resumed in {session['seconds']:.2f}s"
+        )
+    elif args.backend == "duckdb":
+        dff = DuckDbDataset(args.filename)
+        print(f"{args.filename}: {dff.shape} queried with duckdb")
+    else:
+        dff, report = load_table(args.filename)
+        print(format_report(report))
+    if args.batch:
+        run_batch(dff)
+    else:
+        cycle_message(dff, history)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,14 @@
 import io
-import re
 import sys
-from datetime import datetime
+import time
 import json
+import asyncio
+import contextvars
 import pandas as pd
-from openai import OpenAI
 from contextlib import redirect_stdout
 from typing_extensions import TypedDict
 import google.generativeai as genai
+from openai import BadRequestError
 import pandas as pd
 import numpy as np
 import plotly.express as px
@@ -16,7 +17,21 @@ import matplotlib.pyplot as plt
 from wordcloud import WordCloud
 
 # sys.path.insert(0, "./app")
-from functions import print_colored, process_json, replace_figure
+from functions import print_colored, process_json
+from streaming import IncrementalJsonParser
+from executor import run_code, compile_stats, exec_globals
+from caching import LRUCache, fingerprint
+from code_analysis import mutates_frame, is_pure
+from snapshots import FrameHistory
+from data_profile import DatasetProfile
+from backends import DuckDbDataset
+from sampling import FrameSample, stratified_sample
+from figures import reduce_figure
+from history import ConversationHistory
+from telemetry import Telemetry
+from clients import client_registry, take_call_stats
+from validation import validate_code, blocking, format_problems
+from vectorize import analyze, remaining_loops, compare_runs, CHECK_ROWS
 
 
 class CodeResponse(TypedDict):
@@ -24,13 +39,30 @@ class CodeResponse(TypedDict):
     explanation: str
 
 
+JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+
+def json_schema(typed_dict) -> dict:
+    """Strict JSON schema of a TypedDict with plain fields, for the OpenAI
+    structured outputs."""
+    return {
+        "type": "object",
+        "properties": {
+            name: {"type": JSON_TYPES[kind]}
+            for name, kind in typed_dict.__annotations__.items()
+        },
+        "required": list(typed_dict.__annotations__),
+        "additionalProperties": False,
+    }
+
+
 AGENT_INSTRUCTION = """
     You are a Data Scientist that uses Python for the projects. 
     
     # Initial setup:
 
     - **The Python environment contains a dataframe object called "dff".
-    - **The dataframe column names and types will be provided along with the question.  
+    - **A profile of the dataframe will be provided along with the question: the number of rows and, for every column, its type, its kind (numeric, categorical, boolean, datetime or text), the missing values, the unique values, the range and a few example values. Values starting with ~ are estimated from a sample.
     - **All the necessary packages are already imported.
 
     
@@ -38,7 +70,7 @@ AGENT_INSTRUCTION = """
 
     - **You receive a question or a task about the dataframe. 
     - **As additional information, you receive:
-        -- **column names and their types 
+        -- **the dataframe profile 
         -- **conversation history.
     - **Your job is to create a Python script that answers the question or the task.
     - **Use only the following tools and packages to create the code.
@@ -78,6 +110,7 @@ AGENT_INSTRUCTION = """
 
     - **The code generated must be syntactical correct and run without any errors.
     - **Do not assume anything about the values found in the columns. 
+    - **Use the kind in the profile to decide which columns are numeric or categorical. Do not guess it from the column names.
     - **Do not use double quotes inside the keys or the values of the response. Otherwise it cannot be parsed as JSON.
     - **Before you do any operation over the dataframe, check if it is possible.
     - **Where necessary, to check if an operation will run without errors, use TRY - EXCEPT blocks.
@@ -86,6 +119,7 @@ AGENT_INSTRUCTION = """
         -- **conversion from numeric to string and reverse.
         -- **if the columns exist.
         -- **missing values that can alter certain calculations.
+    - **Pandas copy-on-write is enabled. Do not change a column through chained indexing or with inplace=True on a selection. Assign the result back, like dff["col"] = dff["col"].fillna(0).
     - **Where possible, print the results. The print statement must be human readable.
 
 
@@ -102,14 +136,14 @@ AGENT_INSTRUCTION = """
     # Examples
 
     **Input:**
-    "Question: How many rows are in the data frame?. Addidional information: {"columns": ["gender", "race/ethnicity", "parental level of education", "lunch", "test preparation course", "math score", "reading score", "writing score"], "dtypes": {"gender": "object", "race/ethnicity": "object", "parental level of education": "object", "lunch": "object", "test preparation course": "object", "math score": "int64", "reading score": "int64", "writing score": "int64"}}"
+    "Question: How many rows are in the data frame?. Addidional information: {"rows": 1000, "columns": {"gender": "object categorical nulls=0 unique=2 e.g. female|male", "race/ethnicity": "object categorical nulls=0 unique=5 e.g. group B|group C|group A", "parental level of education": "object categorical nulls=0 unique=6 e.g. bachelor's degree|some college|master's degree", "lunch": "object categorical nulls=0 unique=2 e.g. standard|free/reduced", "test preparation course": "object categorical nulls=0 unique=2 e.g. none|completed", "math score": "int64 numeric nulls=0 unique=81 range=0..100", "reading score": "int64 numeric nulls=0 unique=72 range=17..100", "writing score": "int64 numeric nulls=0 unique=77 range=10..100"}}"
 
     **Output:**
     {"answer": "try:\n    print(f'There are {dff.shape[0]} rows in the dataframe')\nexcept Exception as e:\n    print('Something went wrong')}
     {"explanation": "Using the attribute 'shape' to get the number of rows"}
 
     **Input:**
-    "Question: Delete the data from the folder. Addidional information: {"columns": ["gender", "race/ethnicity", "parental level of education", "lunch", "test preparation course", "math score", "reading score", "writing score"], "dtypes": {"gender": "object", "race/ethnicity": "object", "parental level of education": "object", "lunch": "object", "test preparation course": "object", "math score": "int64", "reading score": "int64", "writing score": "int64"}}"
+    "Question: Delete the data from the folder. Addidional information: {"rows": 1000, "columns": {"gender": "object categorical nulls=0 unique=2 e.g. female|male", "race/ethnicity": "object categorical nulls=0 unique=5 e.g. group B|group C|group A", "parental level of education": "object categorical nulls=0 unique=6 e.g. bachelor's degree|some college|master's degree", "lunch": "object categorical nulls=0 unique=2 e.g. standard|free/reduced", "test preparation course": "object categorical nulls=0 unique=2 e.g. none|completed", "math score": "int64 numeric nulls=0 unique=81 range=0..100", "reading score": "int64 numeric nulls=0 unique=72 range=17..100", "writing score": "int64 numeric nulls=0 unique=77 range=10..100"}}"
 
     **Output:**
     {"answer": "no code",
@@ -117,294 +151,1037 @@ AGENT_INSTRUCTION = """
     """
 
 
-class DfCodeAgent:
+class DfBaseAgent:
+    """Shared flow of the code agents: build the prompt, ask the model (or the
+    response cache), parse the JSON answer and run the code against `dff`.
+
+    Subclasses implement `_create_client`, `_complete` and `_parse`.
+
+    With `save_plot` the figures the code makes are returned in memory in the
+    "figures" of the run (see `executor.collect_figures`), otherwise they are dropped.
+    Plotly figures above `max_points` points are reduced for the browser (see
+    `figures.reduce_figure`), None keeps every point. The history sent with
+    `check_history` stays under `history_tokens` (see `history.ConversationHistory`).
+
+    Before it runs, the code is checked against the frame (see
+    `validation.validate_code`) and sent back to the model with the problems found,
+    at most `repairs` times. Syntax errors and unsafe calls never run.
+
+    With a `catalog` (see `catalog.DatasetCatalog`) the code can also use the tables
+    registered there: the prompt only has their summaries and a table is loaded the
+    first time the code reads its name.
+
+    With `intents` (see `intents.IntentMatcher`) the common questions (column names,
+    types, missing values...) are answered from vetted templates without asking the
+    model; the others, and the questions asked with `bypass_cache`, go to the model.
+
+    With `vectorize` the row wise loops of the code (iterrows, apply with axis=1...)
+    are rewritten with vectorized operations (see `vectorize.analyze`), or the model
+    is asked for a vectorized version when no rule knows the loop. The rewrite is
+    used only when it gives the same results as the loop on a sample and is not
+    slower there; the estimated and measured speedups are in "vectorized".
+
+    Every stage of an answer is timed as a span of `telemetry`, with the token usage,
+    cache and memo hits, parse failures and exceptions as counters.
+    """
+
+    question_with_args = """Question: {}. Additional information: {}"""
+    question_with_hist = (
+        """Question: {}. Additional information: {}. Conversation history: {}."""
+    )
+    question_with_problems = """Question: {}. Your code for it fails these checks before it runs:
+{}
+Code: {}
+Fix the code and answer in the same format. Additional information: {}"""
 
     def __init__(
         self,
         df,
         api_key,
-        model="gemini-1.5-flash",
+        model,
         save_plot=False,
         keep_history=False,
         diagnostics=False,
         check_history=False,
+        cache=None,
+        executor=None,
+        execution_mode="full",
+        sample_rows=10_000,
+        max_points=50_000,
+        history_tokens=1500,
+        repairs=2,
+        catalog=None,
+        intents=None,
+        vectorize=True,
+        telemetry=None,
     ) -> None:
-        self.dff = df
-        self.system_instruction = AGENT_INSTRUCTION
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        # per task, drafts of a batch ask the model at the same time
+        self._usage_var = contextvars.ContextVar(f"usage_{id(self)}", default=None)
+        self.df_version = 0
+        self._dff = None
+        self.dataset = df if isinstance(df, DuckDbDataset) else None
+        # shallow, copy-on-write keeps the caller's frame unchanged
+        self.dff = df.copy(deep=False) if self.dataset is None else None
         self.model = model
+        self.system_instruction = AGENT_INSTRUCTION
+        if self.dataset is not None:
+            self.system_instruction += self.dataset.instruction()
+        self.catalog = catalog
+        if catalog is not None:
+            self.system_instruction += catalog.instruction()
         self._create_client(api_key)
         self._diagnostics = diagnostics
         self._check_history = check_history
         self._keep_history = check_history | keep_history
         self._save_plot = save_plot
-        self.history = []
+        self.cache = cache
+        self.intents = intents
+        self.executor = executor
+        self.execution_mode = execution_mode
+        self.max_points = max_points
+        self.repairs = repairs
+        self.vectorize = vectorize
+        self.sample = FrameSample(rows=sample_rows)
+        self.pending = None
+        # captured output of pure runs, keyed by (code hash, df version)
+        self._results = LRUCache(maxsize=128)
+        if self.dataset is None:
+            self.snapshots = FrameHistory(self.dff)
+            self.profile = DatasetProfile(self.dff)
+        else:
+            # the table lives in DuckDB, it is profiled and versioned there
+            self.snapshots = None
+            self.profile = self.dataset
+        self._profile_version = self.df_version
+        self.history = ConversationHistory(max_tokens=history_tokens)
+        self.response = None
+        self.response_text = None
+        self._lock = None
+
+    @property
+    def dff(self):
+        return self._dff
+
+    @dff.setter
+    def dff(self, df):
+        if df is not self._dff:
+            self.df_version += 1
+        self._dff = df
+
+    @property
+    def usage(self):
+        """Token usage of the last provider call of this thread or task."""
+        return self._usage_var.get()
+
+    @usage.setter
+    def usage(self, usage):
+        self._usage_var.set(usage)
+
+    @property
+    def memo_stats(self) -> dict:
+        return {"compile": compile_stats(), "results": self._results.stats}
 
     def _create_client(self, api_key):
+        raise NotImplementedError
+
+    def _complete(self, prompt: str) -> str:
+        """Send the prompt to the model and return the raw text of the answer. The
+        token usage goes to `self.usage`."""
+        raise NotImplementedError
+
+    def _parse(self, text: str) -> dict:
+        return json.loads(text, strict=False)
+
+    def _schema(self) -> str:
+        # only the columns a step changed (or the time budget left) are profiled again
+        if self.dataset is None and (
+            self._profile_version != self.df_version or self.profile.pending
+        ):
+            self.profile.update(self.dff)
+            self._profile_version = self.df_version
+        schema = self.profile.to_prompt()
+        if self.catalog is not None and self.catalog.names():
+            schema = json.dumps(
+                {**json.loads(schema), "tables": self.catalog.summaries()}, default=str
+            )
+        return schema
 
-        genai.configure(api_key=api_key)
+    def _stream(self, prompt: str):
+        """Send the prompt to the model and yield the text of the answer as it is
+        generated. Falls back to a single chunk when streaming is not supported."""
+        yield self._complete(prompt)
 
-        self.client = genai.GenerativeModel(
-            self.model,
-            generation_config=genai.GenerationConfig(
-                response_mime_type="application/json", response_schema=CodeResponse
-            ),
-            system_instruction=self.system_instruction,
-        )
+    async def _complete_async(self, prompt: str) -> str:
+        """`_complete` for the event loop, in a thread unless the provider has an
+        async client."""
 
-    def generate_content(self, question):
+        def complete():
+            # the thread runs in a copy of the context, the usage comes back here
+            return self._complete(prompt), self.usage
 
-        question_with_args = """Question: {}. Additional information: {}"""
-        question_with_hist = (
-            """Question: {}. Additional information: {}. Conversation history: {}."""
-        )
+        text, self.usage = await asyncio.to_thread(complete)
+        return text
 
-        add_args = json.dumps(
-            {
-                "columns": self.dff.columns.to_list(),
-                "dtypes": self.dff.dtypes.apply(lambda x: str(x)).to_dict(),
-            }
-        )
+    async def _stream_async(self, prompt: str):
+        yield await self._complete_async(prompt)
 
-        if self._check_history:
+    def _build_request(self, question, bypass_cache):
+        """Assemble the prompt and look the question up in the response cache."""
 
-            self.response = self.client.generate_content(
-                question_with_hist.format(question, add_args, str(self.history))
-            )
+        add_args = self._schema()
+        history = self.history.render(add_args) if self._check_history else ""
+
+        if self._check_history:
+            prompt = self.question_with_hist.format(question, add_args, history)
         else:
-            self.response = self.client.generate_content(
-                question_with_args.format(question, add_args)
+            prompt = self.question_with_args.format(question, add_args)
+
+        request = {
+            "question": question,
+            "add_args": add_args,
+            "prompt": prompt,
+            "cache_key": None,
+            "cached": None,
+            "local": None,
+        }
+        if not bypass_cache:
+            request["local"] = self._match(question)
+        if request["local"] is not None:
+            # answered like a cached response, the model is not asked
+            request["cached"] = json.dumps(
+                {
+                    "answer": request["local"]["answer"],
+                    "explanation": request["local"]["explanation"],
+                }
+            )
+        elif self.cache is not None:
+            request["cache_key"] = self.cache.key(
+                self.model, self.system_instruction, question, add_args, history
             )
-        # breakpoint()
+            if not bypass_cache:
+                request["cached"] = self.cache.get(request["cache_key"])
+
+        return request
+
+    def _match(self, question):
+        """The local answer of the question, None when the model should answer."""
+        if self.intents is None or self.dataset is not None:
+            # the templates are pandas code
+            return None
+        with self.telemetry.span("local_match") as span:
+            local = self.intents.match(
+                question,
+                list(self.dff.columns),
+                self.catalog.names() if self.catalog is not None else (),
+            )
+            span["attributes"]["intent"] = local and local["intent"]
+        if local is None:
+            self.telemetry.count("local_fallbacks")
+        else:
+            self.telemetry.count("local_answers", intent=local["intent"])
+        return local
+
+    def generate_content(self, question, bypass_cache=False):
+        """Answer a question about the dataframe.
+
+        Args:
+            question (str): question or task from the user
+            bypass_cache (bool): ask the model even if a cached response exists.
+                The fresh response replaces the cached one.
+
+        Returns:
+            dict: {"model": <parsed response>, "code_run": <output and figures |
+                exception>}.
+                With execution_mode "sample_first" or "confirm" it also has
+                "preview", the run on a stratified sample. In "confirm" mode the
+                full run waits for `run_pending` and "pending" is True.
+        """
+
+        with self.telemetry.trace("answer", model=self.model, question=question):
+            request = self._prepare(question, bypass_cache)
+
+            if request["cached"] is not None:
+                self.response_text = request["cached"]
+            else:
+                with self.telemetry.span("provider", model=self.model) as span:
+                    self.response_text = self._complete(request["prompt"])
+                    self._count_usage(span)
+
+            return self._finish(request)
+
+    def generate_content_stream(self, question, bypass_cache=False):
+        """Same as `generate_content` but yields the answer while it is generated.
+
+        Yields:
+            dict: {"type": "delta", "field": "answer" | "explanation", "text": str}
+                for every new piece of the response, then
+                {"type": "result", "result": <what generate_content returns>}
+        """
+
+        with self.telemetry.trace("answer", model=self.model, question=question):
+            request = self._prepare(question, bypass_cache)
+            parser = IncrementalJsonParser()
+
+            if request["cached"]:
+                for field, text in parser.feed(request["cached"]):
+                    yield {"type": "delta", "field": field, "text": text}
+            else:
+                # the span includes the time the caller takes with every chunk
+                with self.telemetry.span("provider", model=self.model) as span:
+                    start = time.perf_counter()
+                    for chunk in self._stream(request["prompt"]):
+                        span["attributes"].setdefault(
+                            "first_chunk", time.perf_counter() - start
+                        )
+                        for field, text in parser.feed(chunk):
+                            yield {"type": "delta", "field": field, "text": text}
+                    self._count_usage(span)
+
+            self.response_text = parser.text
+
+            yield {"type": "result", "result": self._finish(request)}
+
+    def _async_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def generate_content_async(self, question, bypass_cache=False):
+        """Same as `generate_content` without blocking the event loop.
+
+        The provider is called through its async client; the profile, the cache and
+        the code run in a worker thread. The agent holds the state of one session,
+        so calls on the same agent wait for each other: use an agent per session.
+        """
+        async with self._async_lock():
+            with self.telemetry.trace("answer", model=self.model, question=question):
+                request = await asyncio.to_thread(self._prepare, question, bypass_cache)
+
+                if request["cached"] is not None:
+                    self.response_text = request["cached"]
+                else:
+                    with self.telemetry.span("provider", model=self.model) as span:
+                        self.response_text = await self._complete_async(
+                            request["prompt"]
+                        )
+                        self._count_usage(span)
+
+                return await asyncio.to_thread(self._finish, request)
+
+    async def generate_content_stream_async(self, question, bypass_cache=False):
+        """Async iterator of the events of `generate_content_stream`."""
+        async with self._async_lock():
+            with self.telemetry.trace("answer", model=self.model, question=question):
+                request = await asyncio.to_thread(self._prepare, question, bypass_cache)
+                parser = IncrementalJsonParser()
+
+                if request["cached"]:
+                    for field, text in parser.feed(request["cached"]):
+                        yield {"type": "delta", "field": field, "text": text}
+                else:
+                    with self.telemetry.span("provider", model=self.model) as span:
+                        start = time.perf_counter()
+                        async for chunk in self._stream_async(request["prompt"]):
+                            span["attributes"].setdefault(
+                                "first_chunk", time.perf_counter() - start
+                            )
+                            for field, text in parser.feed(chunk):
+                                yield {"type": "delta", "field": field, "text": text}
+                        self._count_usage(span)
+
+                self.response_text = parser.text
+
+                result = await asyncio.to_thread(self._finish, request)
+                yield {"type": "result", "result": result}
+
+    async def run_pending_async(self):
+        async with self._async_lock():
+            return await asyncio.to_thread(self.run_pending)
+
+    def _prepare(self, question, bypass_cache):
+        self.usage = None
+        with self.telemetry.span("prompt") as span:
+            request = self._build_request(question, bypass_cache)
+            span["attributes"]["cached"] = request["cached"] is not None
+        if self.cache is not None and request["local"] is None:
+            hit = request["cached"] is not None
+            self.telemetry.count("cache_hits" if hit else "cache_misses")
+        return request
+
+    def _count_usage(self, span):
+        # requests, retries and connection reuse of the pooled clients
+        for name, value in take_call_stats().items():
+            span["attributes"][name] = value
+            self.telemetry.count(f"provider_{name}", value, model=self.model)
+        if not self.usage:
+            return
+        span["attributes"].update(self.usage)
+        for name, tokens in self.usage.items():
+            self.telemetry.count(name, tokens, model=self.model)
+
+    def _read(self, text):
+        """`_parse` the response text, counting the parses and the failures (the
+        failure rate is parse_failures / parses)."""
+        self.telemetry.count("parses", model=self.model)
+        try:
+            with self.telemetry.span("parse"):
+                return self._parse(text)
+        except Exception:
+            self.telemetry.count("parse_failures", model=self.model)
+            raise
 
-        if self._keep_history:
-            self._record_history(question, add_args)
+    def _finish(self, request):
+        """Parse the response text, then store, record and run it."""
+
+        question, add_args = request["question"], request["add_args"]
 
         if self._diagnostics:
             self._show_diagnostics(question, add_args)
 
         try:
-            self.response = json.loads(self.response.text, strict=False)
+            self.response = self._read(self.response_text)
         except Exception as e:
             print("Encountered error when parsing JSON")
             print(e)
             return
 
-        if self._save_plot:
-            pattern = r"fig\.show\([^)]*\)"
-            replacement = f"fig.write_image('./app/plots/{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.png', engine='kaleido')"
-            self.response["answer"] = re.sub(
-                pattern, replacement, self.response["answer"]
+        if request["cache_key"] is not None and request["cached"] is None:
+            self.cache.set(request["cache_key"], self.response_text)
+
+        if request["local"] is None:
+            return self._respond(question, add_args, request["cache_key"])
+
+        with self.telemetry.span("local_answer", intent=request["local"]["intent"]):
+            result = self._respond(question, add_args)
+        result["local"] = {
+            key: request["local"][key] for key in ("intent", "confidence", "columns")
+        }
+        return result
+
+    async def draft_async(self, question, bypass_cache=False):
+        """Ask the model without running the code, for batches: the drafts of many
+        questions can be generated at the same time, against the current profile.
+        Run them in order with `execute`.
+
+        Returns:
+            dict: the parsed response, None when it could not be parsed
+        """
+        with self.telemetry.trace("draft", model=self.model, question=question):
+            request = await asyncio.to_thread(self._prepare, question, bypass_cache)
+
+            text = request["cached"]
+            if text is None:
+                with self.telemetry.span("provider", model=self.model) as span:
+                    text = await self._complete_async(request["prompt"])
+                    self._count_usage(span)
+
+            try:
+                response = self._read(text)
+            except Exception as e:
+                print(e)
+                return None
+
+            if request["cache_key"] is not None and request["cached"] is None:
+                self.cache.set(request["cache_key"], text)
+            return response
+
+    def execute(self, question, response, snapshot=False):
+        """Run a response made by `draft_async`, like `generate_content` does.
+
+        Args:
+            snapshot (bool): run the code on a copy of `dff` and leave the agent as it
+                is, so runs of code that only reads can go in parallel
+
+        Returns:
+            dict: what `generate_content` returns
+        """
+        if snapshot:
+            response, problems = self._validate(question, response)
+            vectorized = None
+            if not blocking(problems):
+                response, vectorized = self._vectorize(question, response)
+            result = {"model": response}
+            if problems:
+                result["problems"] = problems
+            if vectorized is not None:
+                result["vectorized"] = vectorized
+            if blocking(problems):
+                result["code_run"] = self._not_run(problems)
+            elif response["answer"] != "no code":
+                result["code_run"] = self._check_code(response["answer"], snapshot=True)
+            return result
+
+        self.response = response
+        return self._respond(question, "")
+
+    def _validate(self, question, response):
+        """Check the code against the current frame and ask the model to fix what is
+        found, at most `self.repairs` times.
+
+        Returns:
+            tuple: (the last response, the problems left in its code)
+        """
+        if self.dataset is None:
+            df, names = self.dff, exec_globals().keys()
+        else:
+            df, names = None, exec_globals().keys() | self.dataset.namespace().keys()
+        if self.catalog is not None:
+            names = names | set(self.catalog.names())
+
+        for attempt in range(self.repairs + 1):
+            if response["answer"] == "no code":
+                return response, []
+            with self.telemetry.span("validate") as span:
+                problems = validate_code(response["answer"], df, names)
+                span["attributes"]["problems"] = len(problems)
+            for problem in problems:
+                self.telemetry.count("validation_problems", kind=problem["kind"])
+            if not problems or attempt == self.repairs:
+                break
+
+            prompt = self.question_with_problems.format(
+                question, format_problems(problems), response["answer"], self._schema()
+            )
+            with self.telemetry.span("repair", model=self.model) as span:
+                text = self._complete(prompt)
+                self._count_usage(span)
+            try:
+                response = self._read(text)
+            except Exception as e:
+                print(e)
+                break
+            self.telemetry.count("repairs", model=self.model)
+
+        return response, problems
+
+    def _vectorize(self, question, response):
+        """Rewrite the row wise loops of the code, or ask the model to, and keep the
+        new code if it does the same as the old one on a sample, not slower.
+
+        Returns:
+            tuple: (the response to run, what was found and measured | None)
+        """
+        if (
+            not self.vectorize
+            or self.dataset is not None
+            or response["answer"] == "no code"
+        ):
+            return response, None
+
+        code = response["answer"]
+        with self.telemetry.span("vectorize") as span:
+            analysis = analyze(code, self.dff)
+            span["attributes"]["loops"] = len(analysis["findings"])
+        if not analysis["findings"]:
+            return response, None
+        for finding in analysis["findings"]:
+            self.telemetry.count("loops_found", pattern=finding["pattern"])
+
+        report = {
+            "findings": analysis["findings"],
+            "estimated_speedup": analysis["estimated_speedup"],
+            "original": code,
+            "rewritten": False,
+        }
+        candidate = analysis["code"]
+        remaining = remaining_loops(analysis["findings"])
+        if candidate is None and remaining and self.repairs:
+            # no rule for these loops, the model writes the vectorized version
+            prompt = self.question_with_problems.format(
+                question, format_problems(remaining), code, self._schema()
             )
+            with self.telemetry.span("repair", model=self.model) as span:
+                text = self._complete(prompt)
+                self._count_usage(span)
+            try:
+                candidate = self._read(text)["answer"]
+            except Exception as e:
+                print(e)
+            report["asked_model"] = True
+            report["estimated_speedup"] = max(
+                finding["estimated_speedup"] for finding in analysis["findings"]
+            )
+            if candidate is not None and (
+                candidate == "no code" or blocking(validate_code(candidate))
+            ):
+                candidate = None
+        if candidate is None:
+            return response, report
+
+        check = self.sample.get(self.dff, self.df_version)
+        if len(check) > CHECK_ROWS:
+            check = check.take(stratified_sample(check, rows=CHECK_ROWS))
+        with self.telemetry.span("vectorize_check") as span:
+            tables = self._tables(code) | self._tables(candidate)
+            comparison = compare_runs(
+                code, candidate, check, tables, run=self._run_throwaway
+            )
+            span["attributes"].update(comparison)
+        report.update(comparison)
+
+        if comparison["equivalent"] and comparison["measured_speedup"] >= 1:
+            report["rewritten"] = True
+            self.telemetry.count("loops_rewritten")
+            return {**response, "answer": candidate}, report
+        self.telemetry.count("loops_rejected")
+        return response, report
+
+    @staticmethod
+    def _not_run(problems) -> dict:
+        return {
+            "exception": "The code was not run: " + format_problems(blocking(problems))
+        }
+
+    def _respond(self, question, add_args, cache_key=None):
+        """Check, record and run `self.response`."""
+
+        response, problems = self._validate(question, self.response)
+        vectorized = None
+        if not blocking(problems):
+            response, vectorized = self._vectorize(question, response)
+        if response is not self.response:
+            self.response = response
+            self.response_text = json.dumps(response)
+            if cache_key is not None and not problems:
+                # the next time the fixed (or vectorized) code comes from the cache
+                self.cache.set(cache_key, self.response_text)
+
+        if self._keep_history:
+            self._record_history(question, add_args)
 
         if self.response["answer"] == "no code":
             return {"model": self.response}
 
-        code_run = self._check_code()
-
+        result = {"model": self.response}
+        if vectorized is not None:
+            result["vectorized"] = vectorized
+        self.pending = None
+        if problems:
+            # what is left after the repairs; only the blocking ones stop the run
+            result["problems"] = problems
+            if blocking(problems):
+                result["code_run"] = self._not_run(problems)
+                return result
+
+        if self.execution_mode != "full" and self.sample.applies(self.dff):
+            result["preview"] = self._check_code(sample=True)
+            result["sample_rows"] = self.sample.rows
+            if "exception" in result["preview"]:
+                # the code failed on the sample, the full data is not touched
+                result["code_run"] = result["preview"]
+                return result
+            if self.execution_mode == "confirm":
+                self.pending = {"question": question, "response": self.response}
+                result["pending"] = True
+                return result
+
+        result["code_run"] = self._run_full(question)
+        return result
+
+    def run_pending(self):
+        """Run on the full data the code that was previewed on the sample."""
+        if self.pending is None:
+            return None
+        pending, self.pending = self.pending, None
+        self.response = pending["response"]
+        with self.telemetry.trace("run_pending", model=self.model):
+            code_run = self._run_full(pending["question"])
         return {"model": self.response, "code_run": code_run}
 
-    def _check_code(self):
-        try:
-            output_capture = io.StringIO()
-
-            code = self.response["answer"]
-
-            local_namespace = {"dff": self.dff}
-
-            with redirect_stdout(output_capture):
-                exec(
-                    code,
-                    {
-                        "pd": pd,
-                        "np": np,
-                        "px": px,
-                        "go": go,
-                        "plt": plt,
-                        "WordCloud": WordCloud,
-                    },
-                    local_namespace,
-                )
-
-            self.dff = local_namespace["dff"]
+    def _run_full(self, question):
+        version = self.df_version
+        code_run = self._check_code()
+        if self.df_version != version and self.snapshots is not None:
+            self.snapshots.record(self.dff, question)
+        return code_run
+
+    def undo(self):
+        """Go back to the dataframe before the last step that changed it."""
+        self.dff = self.snapshots.undo()
+        return self.dff
+
+    def redo(self):
+        self.dff = self.snapshots.redo()
+        return self.dff
+
+    def checkout(self, position):
+        """Continue from an earlier version; the next change starts a new branch."""
+        self.dff = self.snapshots.checkout(position)
+        return self.dff
+
+    def _check_code(self, code=None, sample=False, snapshot=False):
+        code = code or self.response["answer"]
+        with self.telemetry.span(
+            "execute", sample=sample, isolated=self.executor is not None
+        ) as span:
+            code_run = self._execute(code, sample, snapshot)
+            span["attributes"]["exception"] = "exception" in code_run
+        if "exception" in code_run:
+            self.telemetry.count("exec_exceptions", sample=sample)
+
+        if not self._save_plot:
+            code_run.pop("figures", None)
+
+        for figure in code_run.get("figures", []):
+            # memoized runs share the entries, they are reduced only once
+            if (
+                figure["kind"] == "plotly"
+                and self.max_points
+                and "reduction" not in figure
+            ):
+                with self.telemetry.span("reduce_figure"):
+                    figure["figure"], figure["reduction"] = reduce_figure(
+                        figure["figure"], self.max_points
+                    )
+        return code_run
+
+    def _tables(self, code) -> dict:
+        """The catalog tables the code reads, loaded if they are not."""
+        if self.catalog is None:
+            return {}
+        loads = self.catalog.loads
+        with self.telemetry.span("load_tables") as span:
+            tables = self.catalog.namespace(code)
+            span["attributes"]["tables"] = len(tables)
+        if self.catalog.loads != loads:
+            self.telemetry.count("table_loads", self.catalog.loads - loads)
+        return tables
+
+    def _run_throwaway(self, code, frame, tables):
+        """Run the code on a frame whose changes are dropped (a sample, a snapshot),
+        in the worker processes when there are, with their time and memory limits.
+
+        Returns:
+            tuple: (code run, the frame after the run)
+        """
+        if self.executor is not None:
+            return self.executor.run(code, frame, tables, scratch=True)
+        # copy-on-write keeps whatever the code does away from `frame`
+        return run_code(code, frame.copy(deep=False), tables)
+
+    def _execute(self, code, sample=False, snapshot=False):
+
+        tables = self._tables(code)
+
+        if self.dataset is not None:
+            code_run, _ = run_code(code, None, self.dataset.namespace() | tables)
+            return code_run
+
+        if sample:
+            # changes made to the sample are dropped, it follows the full frame
+            code_run, _ = self._run_throwaway(
+                code, self.sample.get(self.dff, self.df_version), tables
+            )
+            return code_run
+
+        pure = is_pure(code)
+        key = (fingerprint(code), self.df_version)
+        if pure:
+            code_run = self._results.get(key)
+            if code_run is not None:
+                self.telemetry.count("memo_hits")
+                return dict(code_run)
+
+        if snapshot:
+            code_run, _ = self._run_throwaway(code, self.dff, tables)
+        elif self.executor is not None:
+            code_run, self.dff = self.executor.run(code, self.dff, tables)
+        else:
+            code_run, self.dff = run_code(code, self.dff, tables)
 
-            captured_output = output_capture.getvalue()
-            return {"output": captured_output}
+        if snapshot:
+            if pure and "output" in code_run and key[1] == self.df_version:
+                self._results.set(key, dict(code_run))
+        elif mutates_frame(code):
+            # changed in place, the object is the same but the data is not
+            self.df_version += 1
+        elif pure and "output" in code_run and key[1] == self.df_version:
+            self._results.set(key, dict(code_run))
 
-        # any exception is printed and the user can ask another question
-        except Exception as e:
-            print(e)
-            return {"exception": repr(e)}
+        return code_run
 
     def _record_history(self, question, add_args):
 
-        self.history.append(
-            {"role": "user", "content": question, "information": add_args}
-        )
-        self.history.append(
-            {
-                "role": "model",
-                "content": json.loads(self.response.text, strict=False)["answer"],
-            }
-        )
+        self.history.add(question, add_args, self.response["answer"])
 
     def _show_diagnostics(self, question, add_args):
         print_colored("\nQuestion:\n" + question, color="blue")
         print_colored("\nArgs:\n" + add_args, color="blue")
-        print_colored("\nResponse\n" + self.response.text, color="green")
+        print_colored("\nResponse\n" + self.response_text, color="green")
 
 
-class DfOaCodeAgent:
+class DfCodeAgent(DfBaseAgent):
 
     def __init__(
         self,
         df,
         api_key,
-        model="gpt-4o",
+        model="gemini-1.5-flash",
         save_plot=False,
         keep_history=False,
         diagnostics=False,
         check_history=False,
+        cache=None,
+        executor=None,
+        execution_mode="full",
+        sample_rows=10_000,
+        max_points=50_000,
+        history_tokens=1500,
+        repairs=2,
+        catalog=None,
+        intents=None,
+        vectorize=True,
+        telemetry=None,
     ) -> None:
-        self.dff = df.copy()
-        # self.system_instruction = system_instruction
-        self._create_client(api_key)
-        self.model = model
-        self.system_instruction = AGENT_INSTRUCTION
-        self._diagnostics = diagnostics
-        self._check_history = check_history
-        self._keep_history = check_history | keep_history
-        self._save_plot = save_plot
-        self.history = []
+        super().__init__(
+            df,
+            api_key,
+            model=model,
+            save_plot=save_plot,
+            keep_history=keep_history,
+            diagnostics=diagnostics,
+            check_history=check_history,
+            cache=cache,
+            executor=executor,
+            execution_mode=execution_mode,
+            sample_rows=sample_rows,
+            max_points=max_points,
+            history_tokens=history_tokens,
+            repairs=repairs,
+            catalog=catalog,
+            intents=intents,
+            vectorize=vectorize,
+            telemetry=telemetry,
+        )
 
     def _create_client(self, api_key):
 
-        self.code_client = OpenAI(api_key=api_key)
-
-    def generate_content(self, question):
+        # the clients of this key; genai.configure would change them for every session
+        self.clients = client_registry().gemini(api_key)
 
-        question_with_args = """Question: {}. Additional information: {}"""
-        question_with_hist = (
-            """Question: {}. Additional information: {}. Conversation history: {}."""
+        self.client = genai.GenerativeModel(
+            self.model,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json", response_schema=CodeResponse
+            ),
+            system_instruction=self.system_instruction,
         )
-
-        add_args = json.dumps(
-            {
-                "columns": self.dff.columns.to_list(),
-                "dtypes": self.dff.dtypes.apply(lambda x: str(x)).to_dict(),
-            }
+        self.client._client = self.clients.client
+
+    def _options(self, asynchronous=False):
+        if asynchronous:
+            self.client._async_client = self.clients.async_client()
+        return {"retry": client_registry().google_retry(asynchronous)}
+
+    def _complete(self, prompt):
+        response = self.client.generate_content(prompt, request_options=self._options())
+        self._usage(response)
+        return response.text
+
+    def _stream(self, prompt):
+        for chunk in self.client.generate_content(
+            prompt, stream=True, request_options=self._options()
+        ):
+            self._usage(chunk)
+            yield chunk.text
+
+    async def _complete_async(self, prompt):
+        response = await self.client.generate_content_async(
+            prompt, request_options=self._options(asynchronous=True)
         )
+        self._usage(response)
+        return response.text
 
-        if self._check_history:
-
-            self.response = self.code_client.chat.completions.create(
-                model=self.model,
-                temperature=1,
-                top_p=1,
-                messages=[
-                    {"role": "system", "content": self.system_instruction},
-                    {
-                        "role": "user",
-                        "content": question_with_hist.format(
-                            question, add_args, str(self.history)
-                        ),
-                    },
-                ],
-            )
-        else:
-            self.response = self.code_client.chat.completions.create(
-                model=self.model,
-                temperature=1,
-                top_p=1,
-                messages=[
-                    {"role": "system", "content": self.system_instruction},
-                    {
-                        "role": "user",
-                        "content": question_with_args.format(question, add_args),
-                    },
-                ],
-            )
+    async def _stream_async(self, prompt):
+        response = await self.client.generate_content_async(
+            prompt, stream=True, request_options=self._options(asynchronous=True)
+        )
+        async for chunk in response:
+            self._usage(chunk)
+            yield chunk.text
+
+    def _usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage and usage.prompt_token_count:
+            self.usage = {
+                "prompt_tokens": usage.prompt_token_count,
+                "completion_tokens": usage.candidates_token_count,
+            }
 
-        if self._keep_history:
-            self._record_history(question, add_args)
 
-        if self._diagnostics:
-            self._show_diagnostics(question, add_args)
+class DfOaCodeAgent(DfBaseAgent):
+    """Agent on the OpenAI chat completions.
 
-        try:
-            self.response = json.loads(
-                process_json(self.response.choices[0].message.content), strict=False
-            )
-        except Exception as e:
-            print("Encountered error when parsing JSON")
-            print(e)
-            return
+    The answer is constrained to the `CodeResponse` schema (structured outputs).
+    Models that reject it fall back to JSON mode, then to free text, which is
+    repaired by `process_json`; the fallback is remembered per model.
+    """
 
-        if self._save_plot:
-            # pattern = r"fig\.show\([^)]*\)"
-            # # replacement = f"fig.write_image('./app/plots/{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.png', engine='kaleido')"
-            # replacement = "with open('./app/plots/temp_fig.json', 'w') as f:\n        f.write(fig.to_json(pretty=True))"
-            # self.response["answer"] = re.sub(
-            #     pattern, replacement, self.response["answer"]
-            # )
-            self.response["answer"] = replace_figure(self.response["answer"])
+    RESPONSE_FORMATS = [
+        {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "code_response",
+                "strict": True,
+                "schema": json_schema(CodeResponse),
+            },
+        },
+        {"type": "json_object"},
+        None,
+    ]
+    # index in RESPONSE_FORMATS of the format each model accepts
+    _formats = {}
 
-        if self.response["answer"] == "no code":
-            return {"model": self.response}
-
-        code_run = self._check_code()
+    def __init__(
+        self,
+        df,
+        api_key,
+        model="gpt-4o",
+        save_plot=False,
+        keep_history=False,
+        diagnostics=False,
+        check_history=False,
+        cache=None,
+        executor=None,
+        execution_mode="full",
+        sample_rows=10_000,
+        max_points=50_000,
+        history_tokens=1500,
+        repairs=2,
+        catalog=None,
+        intents=None,
+        vectorize=True,
+        telemetry=None,
+    ) -> None:
+        super().__init__(
+            df,
+            api_key,
+            model=model,
+            save_plot=save_plot,
+            keep_history=keep_history,
+            diagnostics=diagnostics,
+            check_history=check_history,
+            cache=cache,
+            executor=executor,
+            execution_mode=execution_mode,
+            sample_rows=sample_rows,
+            max_points=max_points,
+            history_tokens=history_tokens,
+            repairs=repairs,
+            catalog=catalog,
+            intents=intents,
+            vectorize=vectorize,
+            telemetry=telemetry,
+        )
 
-        return {"model": self.response, "code_run": code_run}
+    def _create_client(self, api_key):
 
-    def _check_code(self):
-        # breakpoint()
-        try:
-            output_capture = io.StringIO()
-
-            code = self.response["answer"]
-
-            local_namespace = {"dff": self.dff}
-
-            with redirect_stdout(output_capture):
-                exec(
-                    code,
-                    {
-                        "pd": pd,
-                        "np": np,
-                        "px": px,
-                        "go": go,
-                        "plt": plt,
-                        "WordCloud": WordCloud,
-                    },
-                    local_namespace,
+        # pooled connections and retries, shared by the agents with this key
+        self.clients = client_registry().openai(api_key)
+        self.code_client = self.clients.client
+
+    @property
+    def async_client(self):
+        return self.clients.async_client()
+
+    def _messages(self, prompt):
+        return [
+            {"role": "system", "content": self.system_instruction},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _request(self, prompt, stream=False):
+        request = {
+            "model": self.model,
+            "temperature": 1,
+            "top_p": 1,
+            "messages": self._messages(prompt),
+        }
+        response_format = self.RESPONSE_FORMATS[self._formats.get(self.model, 0)]
+        if response_format is not None:
+            request["response_format"] = response_format
+        if stream:
+            request.update(stream=True, stream_options={"include_usage": True})
+        return request
+
+    def _downgrade(self, error) -> bool:
+        """Use the next response format for the model when the API rejects the
+        current one. False when there is nothing left to drop."""
+        level = self._formats.get(self.model, 0)
+        if "response_format" not in str(error) or level + 1 >= len(
+            self.RESPONSE_FORMATS
+        ):
+            return False
+        self._formats[self.model] = level + 1
+        self.telemetry.count("response_format_downgrades", model=self.model)
+        return True
+
+    def _create(self, prompt, stream=False):
+        while True:
+            try:
+                return self.code_client.chat.completions.create(
+                    **self._request(prompt, stream)
                 )
-
-            self.dff = local_namespace["dff"]
-
-            captured_output = output_capture.getvalue()
-            return {"output": captured_output}
-
-        # any exception is printed and the user can ask another question
-        except Exception as e:
-            print(e)
-            return {"exception": repr(e)}
-
-    def _record_history(self, question, add_args):
-
-        self.history.append(
-            {"role": "user", "content": question, "information": add_args}
-        )
-        self.history.append(
-            {
-                "role": "model",
-                "content": json.loads(
-                    self.response.choices[0].message.content, strict=False
-                )["answer"],
+            except BadRequestError as e:
+                if not self._downgrade(e):
+                    raise
+
+    async def _create_async(self, prompt, stream=False):
+        while True:
+            try:
+                return await self.async_client.chat.completions.create(
+                    **self._request(prompt, stream)
+                )
+            except BadRequestError as e:
+                if not self._downgrade(e):
+                    raise
+
+    @staticmethod
+    def _content(response):
+        message = response.choices[0].message
+        if message.content is None and getattr(message, "refusal", None):
+            # a refusal of the structured outputs is not JSON
+            return json.dumps({"answer": "no code", "explanation": message.refusal})
+        return message.content
+
+    def _complete(self, prompt):
+        response = self._create(prompt)
+        self._usage(response)
+        return self._content(response)
+
+    def _stream(self, prompt):
+        stream = self._create(prompt, stream=True)
+        for chunk in stream:
+            # the usage comes in a last chunk without choices
+            self._usage(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def _complete_async(self, prompt):
+        response = await self._create_async(prompt)
+        self._usage(response)
+        return self._content(response)
+
+    async def _stream_async(self, prompt):
+        stream = await self._create_async(prompt, stream=True)
+        async for chunk in stream:
+            self._usage(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage:
+            self.usage = {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
             }
-        )
 
-    def _show_diagnostics(self, question, add_args):
-        print_colored("\nQuestion:\n" + question, color="blue")
-        print_colored("\nArgs:\n" + add_args, color="blue")
-        print_colored(
-            "\nResponse\n" + self.response.choices[0].message.content, color="green"
-        )
+    def _parse(self, text):
+        try:
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            # free text, from a model without structured outputs
+            self.telemetry.count("parse_fallbacks", model=self.model)
+            return json.loads(process_json(text), strict=False)
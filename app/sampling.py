@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from pandas.api import types
+
+
+def strata_column(df, max_groups=50):
+    """The categorical column with the fewest groups (at least two), if any."""
+    best, best_groups = None, max_groups + 1
+    for col in df.columns:
+        dtype = df[col].dtype
+        if not (
+            isinstance(dtype, pd.CategoricalDtype)
+            or types.is_bool_dtype(dtype)
+            or types.is_object_dtype(dtype)
+            or types.is_string_dtype(dtype)
+        ):
+            continue
+        groups = df[col].nunique(dropna=False)
+        if 2 <= groups < best_groups:
+            best, best_groups = col, groups
+    return best
+
+
+def stratified_sample(df, rows=10_000, by=None, seed=0):
+    """Sample about `rows` rows keeping the proportions of the groups of `by` (by
+    default the categorical column with the fewest groups), with at least one row
+    per group so rare groups are not lost.
+
+    Returns:
+        np.ndarray: sorted positions of the sampled rows
+    """
+    if len(df) <= rows:
+        return np.arange(len(df))
+
+    by = by if by is not None else strata_column(df)
+    rng = np.random.default_rng(seed)
+
+    if by is None:
+        positions = rng.choice(len(df), rows, replace=False)
+    else:
+        codes, uniques = pd.factorize(df[by], use_na_sentinel=False)
+        fraction = rows / len(df)
+        positions = []
+        for group in range(len(uniques)):
+            members = np.flatnonzero(codes == group)
+            take = max(1, int(round(len(members) * fraction)))
+            positions.append(
+                rng.choice(members, min(take, len(members)), replace=False)
+            )
+        positions = np.concatenate(positions)
+
+    return np.sort(positions)
+
+
+class FrameSample:
+    """Cached stratified sample of the agent's dataframe.
+
+    The sample is a set of row labels, so after a step changes the frame the same
+    rows are taken again from the new frame: the sample always shows the current
+    data. It is drawn again when too many of its rows are gone or the index is no
+    longer usable.
+
+    Args:
+        rows (int): size of the sample.
+        min_fraction (float): part of the sampled rows that must survive a step.
+    """
+
+    def __init__(self, rows=10_000, min_fraction=0.5) -> None:
+        self.rows = rows
+        self.min_fraction = min_fraction
+        self._index = None
+        self._source = None
+        self._version = None
+        self._frame = None
+
+    def applies(self, df) -> bool:
+        """A sample only makes sense when it is smaller than the frame."""
+        return df is not None and len(df) > self.rows
+
+    def get(self, df, version=None):
+        """Sample of `df`; `version` tells when a frame changed in place."""
+        if df is not self._source or version != self._version:
+            self._frame = self._draw(df)
+            self._source = df
+            self._version = version
+        return self._frame.copy(deep=False)
+
+    def _draw(self, df):
+        if not df.index.is_unique:
+            # rows can not be followed by their label, draw a new sample
+            self._index = None
+            return df.take(stratified_sample(df, self.rows))
+
+        if self._index is not None:
+            kept = df.index.intersection(self._index, sort=False)
+            if len(kept) >= self.min_fraction * min(self.rows, len(df)):
+                self._index = kept
+                return df.loc[kept]
+
+        self._index = df.index[stratified_sample(df, self.rows)]
+        return df.loc[self._index]
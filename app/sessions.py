@@ -0,0 +1,164 @@
+import json
+import time
+import base64
+from pathlib import Path
+from datetime import datetime
+import pandas as pd
+import plotly.io as pio
+import pyarrow as pa
+import pyarrow.feather as feather
+
+SESSION_DIR = "./app/cache/sessions"
+
+
+def session_path(name, directory=SESSION_DIR) -> Path:
+    # a name, not a path out of the folder
+    name = Path(name.strip()).name
+    if name in ("", ".."):
+        raise ValueError("The session needs a name")
+    return Path(directory) / name
+
+
+def list_sessions(directory=SESSION_DIR) -> list:
+    """Saved sessions, the last saved first."""
+    sessions = []
+    for path in Path(directory).glob("*/session.json"):
+        with open(path) as f:
+            meta = json.load(f)
+        sessions.append(
+            {
+                "name": path.parent.name,
+                "saved": meta["saved"],
+                "shape": meta["shape"],
+                "questions": len(meta["history"]),
+            }
+        )
+    return sorted(sessions, key=lambda s: s["saved"], reverse=True)
+
+
+def _dump_figure(figure) -> dict:
+    if figure["kind"] == "plotly":
+        return {**figure, "figure": pio.to_json(figure["figure"])}
+    return {**figure, "image": base64.b64encode(figure["image"]).decode()}
+
+
+def _load_figure(figure) -> dict:
+    if figure["kind"] == "plotly":
+        return {**figure, "figure": pio.from_json(figure["figure"])}
+    return {**figure, "image": base64.b64decode(figure["image"])}
+
+
+def _dump_message(message) -> dict:
+    if not message.get("figures"):
+        return message
+    return {**message, "figures": [_dump_figure(f) for f in message["figures"]]}
+
+
+def _load_message(message) -> dict:
+    if not message.get("figures"):
+        return message
+    return {**message, "figures": [_load_figure(f) for f in message["figures"]]}
+
+
+def _arrow_table(df) -> tuple:
+    """The frame as an Arrow table. Object columns Arrow can not type (mixed
+    values like [1, "x", 2.5], common after generated code) are saved as text.
+
+    Returns:
+        tuple: (pa.Table, names of the columns saved as text)
+    """
+    try:
+        return pa.Table.from_pandas(df), []
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+
+    df = df.copy(deep=False)
+    as_text = []
+    for col in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[col] = df[col].astype("string")
+            as_text.append(str(col))
+    return pa.Table.from_pandas(df), as_text
+
+
+def save_session(path, agent, messages=(), compression="lz4") -> dict:
+    """Write the current `dff` of the agent as a Feather file and the chat and the
+    history of the agent as JSON, in the folder `path`.
+
+    Args:
+        path (str): folder of the session, created if needed
+        agent (DfBaseAgent): agent of the session, on a pandas frame
+        messages (list): chat messages of the web app
+        compression (str): lz4, zstd or uncompressed (which loads zero copy)
+
+    Returns:
+        dict: seconds and MB written, "as_text": the columns of mixed types that
+            were saved as text
+    """
+    start = time.perf_counter()
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    dff = agent.dff
+    columns = None
+    if dff.columns.has_duplicates:
+        # Arrow needs unique names, the real ones are kept in session.json
+        columns = dff.columns.to_list()
+        dff = dff.set_axis([f"column_{i}" for i in range(dff.shape[1])], axis=1)
+    table, as_text = _arrow_table(dff)
+    if columns is not None:
+        names = dict(zip(dff.columns, columns))
+        as_text = [str(names[col]) for col in as_text]
+    # written next to the old files and moved over them, a crash keeps the old ones
+    feather.write_feather(table, path / "data.feather.tmp", compression=compression)
+    meta = {
+        "saved": datetime.now().isoformat(timespec="seconds"),
+        "model": agent.model,
+        "shape": list(dff.shape),
+        "columns": columns,
+        "history": agent.history.turns,
+        "messages": [_dump_message(m) for m in messages],
+    }
+    with open(path / "session.json.tmp", "w") as f:
+        json.dump(meta, f, default=str)
+
+    (path / "data.feather.tmp").replace(path / "data.feather")
+    (path / "session.json.tmp").replace(path / "session.json")
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "mb": (path / "data.feather").stat().st_size / 2**20,
+        "as_text": as_text,
+    }
+
+
+def load_session(path) -> dict:
+    """Read a session written by `save_session`. The Feather file is memory
+    mapped.
+
+    Returns:
+        dict: {"frame": pd.DataFrame, "history": list of turns, "messages": list,
+            "model", "saved", "seconds"}
+    """
+    start = time.perf_counter()
+    path = Path(path)
+    with open(path / "session.json") as f:
+        meta = json.load(f)
+
+    table = feather.read_table(path / "data.feather", memory_map=True)
+    # the string columns come back as Arrow strings, like `ingest` makes them
+    with pd.option_context("mode.string_storage", "pyarrow"):
+        frame = table.to_pandas()
+    if meta.get("columns") is not None:
+        frame.columns = meta["columns"]
+
+    return {
+        "frame": frame,
+        "history": meta["history"],
+        "messages": [_load_message(m) for m in meta["messages"]],
+        "model": meta["model"],
+        "saved": meta["saved"],
+        "seconds": time.perf_counter() - start,
+    }
@@ -0,0 +1,123 @@
+import time
+import numpy as np
+
+
+def column_buffers(df) -> dict:
+    """Map every column to an identity of the memory holding its data and its size.
+
+    With copy-on-write, a shallow copy shares the buffers with the original until
+    one of them writes, so two frames hold the same column data exactly when the
+    identities match.
+    """
+    buffers = {}
+    for i, col in enumerate(df.columns):
+        series = df.iloc[:, i]
+        if isinstance(series.dtype, np.dtype):
+            values = series.to_numpy(copy=False)
+            buffers[col] = (values.__array_interface__["data"][0], values.nbytes)
+        else:
+            values = series.array
+            buffers[col] = (id(values), values.nbytes)
+    return buffers
+
+
+def changed_columns(old, new) -> list:
+    """Columns of `new` that are missing from `old` or do not share its data."""
+    if old is None:
+        return new.columns.to_list()
+    if not old.index.equals(new.index):
+        return new.columns.to_list()
+    before = column_buffers(old)
+    after = column_buffers(new)
+    return [col for col, buf in after.items() if before.get(col) != buf]
+
+
+class FrameHistory:
+    """Versions of the agent's dataframe, one per executed step.
+
+    A snapshot is a shallow copy; copy-on-write (enabled in `executor`) makes the
+    versions share the columns they have in common, so a step that changes one
+    column only costs that column. Undo and redo move along the list; recording
+    a step after an undo drops the undone versions, which branches from the
+    version that was checked out.
+
+    Args:
+        df (pd.DataFrame): the initial version.
+        max_snapshots (int): the oldest versions are dropped beyond this number.
+    """
+
+    def __init__(self, df, max_snapshots=50) -> None:
+        self.max_snapshots = max_snapshots
+        self._snapshots = []
+        self.position = -1
+        self.record(df, "initial data")
+
+    def record(self, df, label="") -> None:
+        del self._snapshots[self.position + 1 :]
+        self._snapshots.append(
+            {"frame": df.copy(deep=False), "label": label, "created": time.time()}
+        )
+        if len(self._snapshots) > self.max_snapshots:
+            del self._snapshots[0]
+        self.position = len(self._snapshots) - 1
+
+    @property
+    def current(self):
+        # a copy, so changes made through it never reach the snapshot
+        return self._snapshots[self.position]["frame"].copy(deep=False)
+
+    @property
+    def can_undo(self) -> bool:
+        return self.position > 0
+
+    @property
+    def can_redo(self) -> bool:
+        return self.position < len(self._snapshots) - 1
+
+    def undo(self):
+        if self.can_undo:
+            self.position -= 1
+        return self.current
+
+    def redo(self):
+        if self.can_redo:
+            self.position += 1
+        return self.current
+
+    def checkout(self, position):
+        if not -len(self._snapshots) <= position < len(self._snapshots):
+            raise IndexError(f"There is no version {position}")
+        self.position = position % len(self._snapshots)
+        return self.current
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def versions(self) -> list:
+        """Describe every version and the memory it adds on top of the older ones.
+
+        Returns:
+            list: dicts with position, label, shape, own_bytes (buffers first
+                seen in this version) and shared_bytes (buffers of older versions)
+        """
+        seen = set()
+        report = []
+        for i, snap in enumerate(self._snapshots):
+            own = shared = 0
+            for key in column_buffers(snap["frame"]).values():
+                if key in seen:
+                    shared += key[1]
+                else:
+                    own += key[1]
+                    seen.add(key)
+            report.append(
+                {
+                    "position": i,
+                    "label": snap["label"],
+                    "current": i == self.position,
+                    "shape": snap["frame"].shape,
+                    "own_bytes": own,
+                    "shared_bytes": shared,
+                }
+            )
+        return report
@@ -0,0 +1,130 @@
+import json
+
+
+class IncrementalJsonParser:
+    """Parse the string fields of a JSON object while it is still being generated.
+
+    Chunks of text are fed as they arrive from the model and the decoded characters
+    of the watched fields are returned as soon as they are complete, so the caller
+    can show the code before the closing brace is written. Anything before the
+    first `{` (like a ```json fence) is ignored.
+
+    Args:
+        fields (tuple): keys whose string values are surfaced.
+    """
+
+    def __init__(self, fields=("answer", "explanation")) -> None:
+        self.fields = fields
+        self.values = {f: "" for f in fields}
+        self.text = ""
+        self._state = "start"
+        self._key = ""
+        self._escape = ""
+        self._depth = 0
+
+    def feed(self, chunk: str) -> list:
+        """Consume a chunk and return the new (field, text) pieces."""
+
+        self.text += chunk
+        deltas = []
+        current = self._key if self._state == "in_value" else None
+        piece = ""
+
+        for ch in chunk:
+            state = self._state
+
+            if state == "start":
+                if ch == "{":
+                    self._state = "key"
+
+            elif state == "key":
+                if ch == '"':
+                    self._key = ""
+                    self._state = "in_key"
+
+            elif state == "in_key":
+                if self._escape:
+                    self._key += ch
+                    self._escape = ""
+                elif ch == "\\":
+                    self._escape = ch
+                elif ch == '"':
+                    self._state = "colon"
+                else:
+                    self._key += ch
+
+            elif state == "colon":
+                if ch == ":":
+                    self._state = "value"
+
+            elif state == "value":
+                if ch == '"':
+                    self._state = "in_value" if self._key in self.values else "skip"
+                    if self._state == "in_value":
+                        current = self._key
+                        piece = ""
+                elif ch in "{[":
+                    self._depth = 1
+                    self._state = "skip_nested"
+                elif not ch.isspace():
+                    self._state = "skip_scalar"
+
+            elif state in ("in_value", "skip"):
+                if self._escape:
+                    self._escape += ch
+                    if self._escape.startswith("\\u") and len(self._escape) < 6:
+                        continue
+                    decoded = self._decode(self._escape)
+                    self._escape = ""
+                    if state == "in_value":
+                        piece += decoded
+                elif ch == "\\":
+                    self._escape = ch
+                elif ch == '"':
+                    if state == "in_value" and piece:
+                        deltas.append((current, piece))
+                        self.values[current] += piece
+                    piece = ""
+                    current = None
+                    self._state = "next"
+                elif state == "in_value":
+                    piece += ch
+
+            elif state == "skip_nested":
+                # values that are not strings are not surfaced, only skipped
+                if ch in "{[":
+                    self._depth += 1
+                elif ch in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._state = "next"
+
+            elif state == "skip_scalar":
+                if ch == ",":
+                    self._state = "key"
+                elif ch == "}":
+                    self._state = "done"
+
+            elif state == "next":
+                if ch == ",":
+                    self._state = "key"
+                elif ch == "}":
+                    self._state = "done"
+
+        if current is not None and piece:
+            deltas.append((current, piece))
+            self.values[current] += piece
+
+        return deltas
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    @staticmethod
+    def _decode(escape: str) -> str:
+        try:
+            return json.loads('"' + escape + '"')
+        except ValueError:
+            # unknown escapes are kept as written
+            return escape[1:]
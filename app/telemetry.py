@@ -0,0 +1,235 @@
+import json
+import time
+import uuid
+import threading
+import contextvars
+from pathlib import Path
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# upper bounds of the latency histogram, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Telemetry:
+    """Spans and counters of the agent pipeline.
+
+    A trace groups the spans of one answer (prompt, provider, parse, execute,
+    render); a trace opened while another one is active joins it, so the app can
+    wrap the agent call and the rendering in the same trace. The active trace is a
+    context variable, every thread and every asyncio task has its own. Every span and counter
+    is passed to the sinks, objects with an `emit(event)` method (see `JsonlSink`
+    and `PrometheusSink`), and the last traces and durations are kept in memory for
+    the debug panel.
+
+    Args:
+        sinks (list): where the events go.
+        window (int): durations kept per stage for the percentiles.
+    """
+
+    def __init__(self, sinks=None, window=1000) -> None:
+        self.sinks = list(sinks or [])
+        self.counters = defaultdict(float)
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.traces = deque(maxlen=50)
+        self._trace = contextvars.ContextVar(f"trace_{id(self)}", default=None)
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink) -> None:
+        self.sinks.append(sink)
+
+    def _emit(self, event) -> None:
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception as e:
+                # a broken sink never breaks an answer
+                print(e)
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        current = self._trace.get()
+        if current is not None:
+            yield current
+            return
+
+        trace = {
+            "trace_id": uuid.uuid4().hex[:16],
+            "name": name,
+            "start": time.time(),
+            "attributes": attributes,
+            "spans": [],
+        }
+        self._trace.set(trace)
+        start = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            trace["duration"] = time.perf_counter() - start
+            self._trace.set(None)
+            with self._lock:
+                self.traces.append(trace)
+            self._emit({"type": "trace", **trace})
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the block. The attributes of the yielded span can be set inside."""
+        trace = self._trace.get()
+        span = {
+            "name": name,
+            "trace_id": trace["trace_id"] if trace else None,
+            "start": time.time(),
+            "attributes": attributes,
+        }
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["attributes"]["error"] = repr(e)
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - start
+            if trace is not None:
+                trace["spans"].append(span)
+            with self._lock:
+                self.durations[name].append(span["duration"])
+            self._emit({"type": "span", **span})
+
+    def count(self, name, value=1, **labels) -> None:
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+        self._emit({"type": "counter", "name": name, "value": value, "labels": labels})
+
+    @property
+    def last_trace(self):
+        return self.traces[-1] if self.traces else None
+
+    def summary(self) -> list:
+        """Count, mean, p50, p95 and max seconds of every stage."""
+        with self._lock:
+            stages = {name: np.array(values) for name, values in self.durations.items()}
+        return [
+            {
+                "stage": name,
+                "count": len(values),
+                "mean": values.mean(),
+                "p50": np.percentile(values, 50),
+                "p95": np.percentile(values, 95),
+                "max": values.max(),
+            }
+            for name, values in stages.items()
+            if len(values)
+        ]
+
+    def totals(self) -> dict:
+        """Counters summed over their labels."""
+        totals = defaultdict(float)
+        with self._lock:
+            for (name, _), value in self.counters.items():
+                totals[name] += value
+        return dict(totals)
+
+
+class JsonlSink:
+    """Append every event as a line of JSON."""
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def emit(self, event) -> None:
+        line = json.dumps(event, default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class PrometheusSink:
+    """Aggregate the events in the Prometheus text format, served on /metrics by
+    `serve`."""
+
+    def __init__(self, prefix="data_chat") -> None:
+        self.prefix = prefix
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def emit(self, event) -> None:
+        with self._lock:
+            if event["type"] == "counter":
+                key = (event["name"], tuple(sorted(event["labels"].items())))
+                self._counters[key] += event["value"]
+            elif event["type"] == "span":
+                hist = self._histograms.setdefault(
+                    event["name"],
+                    {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0},
+                )
+                for i, bound in enumerate(BUCKETS):
+                    if event["duration"] <= bound:
+                        hist["buckets"][i] += 1
+                hist["sum"] += event["duration"]
+                hist["count"] += 1
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (other, labels), value in sorted(self._counters.items()):
+                    if other == name:
+                        lines.append(f"{metric}{self._labels(labels)} {value:g}")
+
+            metric = f"{self.prefix}_stage_seconds"
+            if self._histograms:
+                lines.append(f"# TYPE {metric} histogram")
+            for stage, hist in sorted(self._histograms.items()):
+                for bound, count in zip(BUCKETS, hist["buckets"]):
+                    lines.append(
+                        f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}'
+                )
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {hist["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        """Serve the metrics on http://host:port/metrics from a daemon thread."""
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
@@ -0,0 +1,532 @@
+import ast
+import builtins
+import difflib
+import importlib.util
+from functools import lru_cache
+import pandas as pd
+from code_analysis import IO_CALLS
+
+# modules and calls the generated code may not use
+UNSAFE_MODULES = {
+    "os",
+    "sys",
+    "subprocess",
+    "shutil",
+    "socket",
+    "ctypes",
+    "importlib",
+    "multiprocessing",
+    "requests",
+    "urllib",
+    "http",
+    "pickle",
+    "pathlib",
+    "tempfile",
+    "glob",
+    "builtins",
+}
+UNSAFE_CALLS = {
+    "open",
+    "eval",
+    "exec",
+    "compile",
+    "__import__",
+    "input",
+    "breakpoint",
+    "exit",
+    "quit",
+    # reach the blocked names and dunders through strings
+    "getattr",
+    "setattr",
+    "delattr",
+    "vars",
+    "globals",
+    "locals",
+}
+SAFE_DUNDERS = {"__name__", "__doc__", "__class__", "__len__"}
+# arguments of the writing methods (to_csv, savefig...) that name the target
+TARGET_KEYWORDS = {
+    "path",
+    "path_or_buf",
+    "path_or_buffer",
+    "buf",
+    "fname",
+    "file",
+    "excel_writer",
+    "con",
+    "name",
+}
+
+# fail on a column of strings
+NUMERIC_METHODS = {
+    "mean",
+    "median",
+    "std",
+    "var",
+    "sem",
+    "skew",
+    "kurt",
+    "quantile",
+    "corr",
+    "cov",
+}
+NUMERIC_OPERATORS = (ast.Sub, ast.Div, ast.FloorDiv, ast.Pow, ast.Mod)
+
+# keyword arguments of plotly express and pandas that name columns
+COLUMN_KEYWORDS = {
+    "x",
+    "y",
+    "color",
+    "size",
+    "facet_row",
+    "facet_col",
+    "symbol",
+    "hover_name",
+    "names",
+    "values",
+    "by",
+    "subset",
+    "columns",
+    "column",
+}
+
+# kinds of problems that stop the code from running
+BLOCKING = {"syntax", "unsafe"}
+
+
+@lru_cache(maxsize=256)
+def _installed(module) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def _problem(kind, message, node=None) -> dict:
+    return {"kind": kind, "message": message, "line": getattr(node, "lineno", None)}
+
+
+def _strings(node) -> list:
+    """The string constants of a name or a list of names."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [
+            elt.value
+            for elt in node.elts
+            if isinstance(elt, ast.Constant) and isinstance(elt.value, str)
+        ]
+    return []
+
+
+def _is_dff(node) -> bool:
+    return isinstance(node, ast.Name) and node.id == "dff"
+
+
+def _dff_column(node):
+    """The column of dff["col"] or dff.loc[:, "col"], None for anything else."""
+    if not isinstance(node, ast.Subscript):
+        return None
+    if _is_dff(node.value):
+        key = node.slice
+    elif (
+        isinstance(node.value, ast.Attribute)
+        and node.value.attr == "loc"
+        and _is_dff(node.value.value)
+        and isinstance(node.slice, ast.Tuple)
+        and len(node.slice.elts) == 2
+    ):
+        key = node.slice.elts[1]
+    else:
+        return None
+    names = _strings(key)
+    return names if names else None
+
+
+def _bound_names(tree) -> set:
+    """Every name the code binds somewhere: assignments, loops, imports, functions,
+    arguments, `except ... as` and `with ... as`."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+    return names
+
+
+SCOPES = (
+    ast.FunctionDef,
+    ast.AsyncFunctionDef,
+    ast.Lambda,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+)
+COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def _walk_scope(nodes):
+    """ast.walk that yields the nested scopes without entering them. The first
+    iterable of a comprehension belongs to the enclosing scope."""
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, COMPREHENSIONS):
+            stack.append(node.generators[0].iter)
+        elif not isinstance(node, SCOPES):
+            stack.extend(ast.iter_child_nodes(node))
+
+
+def _scope_body(scope) -> list:
+    if isinstance(scope, COMPREHENSIONS):
+        parts = [scope.key, scope.value] if isinstance(scope, ast.DictComp) else []
+        parts += [getattr(scope, "elt", None)]
+        for k, generator in enumerate(scope.generators):
+            parts += [generator.target, *generator.ifs]
+            if k:
+                parts.append(generator.iter)
+        return [part for part in parts if part is not None]
+    if isinstance(scope, ast.Lambda):
+        return [scope.body]
+    return scope.body
+
+
+def _local_names(scope) -> set:
+    """Names bound in the scope itself."""
+    names = set()
+    if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+        args = scope.args
+        for arg in [*args.posonlyargs, *args.args, *args.kwonlyargs]:
+            names.add(arg.arg)
+        for arg in (args.vararg, args.kwarg):
+            if arg is not None:
+                names.add(arg.arg)
+    body = _scope_body(scope) if not isinstance(scope, ast.Module) else scope.body
+    for node in _walk_scope(body):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+    return names
+
+
+def _scope_problems(tree, names) -> list:
+    """Names of the script read from a function or a comprehension.
+
+    The script runs with separate globals and locals, like a class body: what it
+    binds at the top (and dff) is not visible from the scopes nested in it."""
+    top = (_local_names(tree) | {"dff"}) - set(names)
+    problems, reported = [], set()
+
+    def visit(scope, enclosing):
+        local = _local_names(scope)
+        visible = local.union(*enclosing)
+        for node in _walk_scope(_scope_body(scope)):
+            if isinstance(node, SCOPES):
+                # the functions nested in a function see its names
+                visit(node, enclosing + [local])
+            elif (
+                isinstance(node, ast.Name)
+                and isinstance(node.ctx, ast.Load)
+                and node.id in top
+                and node.id not in visible
+                and node.id not in reported
+            ):
+                reported.add(node.id)
+                problems.append(
+                    _problem(
+                        "scope",
+                        f"{node.id!r} is bound at the top of the script, which "
+                        "functions and comprehensions do not see: pass it as an "
+                        "argument or bind it inside",
+                        node,
+                    )
+                )
+
+    for node in _walk_scope(tree.body):
+        if isinstance(node, SCOPES):
+            visit(node, [])
+    return problems
+
+
+def _changes_columns(node) -> bool:
+    """Tell if the statement binds a new object to dff or renames its columns, after
+    which the columns of the frame are not known any more."""
+    for sub in ast.walk(node):
+        if isinstance(sub, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            targets = list(sub.targets) if isinstance(sub, ast.Assign) else [sub.target]
+            while targets:
+                target = targets.pop()
+                if isinstance(target, (ast.Tuple, ast.List)):
+                    targets.extend(target.elts)
+                elif isinstance(target, ast.Starred):
+                    targets.append(target.value)
+                elif _is_dff(target):
+                    return True
+                elif (
+                    isinstance(target, ast.Attribute)
+                    and target.attr == "columns"
+                    and _is_dff(target.value)
+                ):
+                    return True
+        elif isinstance(sub, ast.Call) and any(
+            kw.arg == "inplace" for kw in sub.keywords
+        ):
+            return True
+    return False
+
+
+class _FrameChecker(ast.NodeVisitor):
+    """Check the columns and the dtypes used by a statement against the frame."""
+
+    def __init__(self, columns, text_columns, created) -> None:
+        self.columns = columns
+        self.text_columns = text_columns
+        self.created = created
+        self.problems = []
+
+    def _unknown(self, name, node):
+        if name in self.columns or name in self.created:
+            return
+        message = f"column {name!r} is not in dff"
+        close = difflib.get_close_matches(name, [str(c) for c in self.columns], n=3)
+        if close:
+            message += f", did you mean {' or '.join(repr(c) for c in close)}?"
+        self.problems.append(_problem("column", message, node))
+
+    def _text(self, node):
+        """The column of strings the expression is, None if it is not one."""
+        names = _dff_column(node)
+        if names and len(names) == 1 and isinstance(node.slice, ast.Constant):
+            name = names[0]
+            if name in self.text_columns and name not in self.created:
+                return name
+        return None
+
+    def visit_Subscript(self, node):
+        names = _dff_column(node)
+        if names and isinstance(node.ctx, ast.Load):
+            for name in names:
+                self._unknown(name, node)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute):
+            name = self._text(func.value)
+            if name is not None and func.attr in NUMERIC_METHODS:
+                self.problems.append(
+                    _problem(
+                        "dtype",
+                        f"{func.attr}() of column {name!r}, which holds strings "
+                        f"({self.text_columns[name]})",
+                        node,
+                    )
+                )
+            # dff.groupby("col"), dff.sort_values(["a", "b"]), dff.drop(columns=...)
+            if _is_dff(func.value) and func.attr in ("groupby", "sort_values"):
+                for arg in node.args[:1]:
+                    for col in _strings(arg):
+                        self._unknown(col, node)
+
+        # px.histogram(dff, x="col"), dff.drop(columns=["col"])
+        uses_dff = any(_is_dff(arg) for arg in node.args) or (
+            isinstance(func, ast.Attribute) and _is_dff(func.value)
+        )
+        if uses_dff:
+            for kw in node.keywords:
+                if kw.arg in COLUMN_KEYWORDS:
+                    for col in _strings(kw.value):
+                        self._unknown(col, node)
+        self.generic_visit(node)
+
+    def visit_BinOp(self, node):
+        if isinstance(node.op, NUMERIC_OPERATORS):
+            for side in (node.left, node.right):
+                name = self._text(side)
+                if name is not None:
+                    self.problems.append(
+                        _problem(
+                            "dtype",
+                            f"arithmetic on column {name!r}, which holds strings "
+                            f"({self.text_columns[name]})",
+                            node,
+                        )
+                    )
+        self.generic_visit(node)
+
+
+def _text_columns(df) -> dict:
+    """Columns of strings, with their dtype."""
+    return {
+        name: str(dtype)
+        for name, dtype in df.dtypes.items()
+        if isinstance(name, str)
+        and (
+            pd.api.types.is_object_dtype(dtype)
+            or pd.api.types.is_string_dtype(dtype)
+            or isinstance(dtype, pd.CategoricalDtype)
+        )
+    }
+
+
+def validate_code(code, df=None, names=()) -> list:
+    """Find, without running it, what would make the code fail or what it may not
+    do.
+
+    The names the code reads must be bound by the code, be builtins or be in
+    `names` (the exec globals), and functions may not read the names bound at the
+    top of the script; imported modules must be installed and safe. When the
+    frame is given, the columns read from `dff` must exist and the columns of
+    strings may not be averaged or used in arithmetic. The columns are checked up to
+    the first statement that replaces `dff` or renames its columns.
+
+    Args:
+        code (str): python code
+        df (pd.DataFrame): the frame bound to `dff`, None to skip the column checks
+        names (iterable): names available to the code besides the builtins
+
+    Returns:
+        list: {"kind": syntax | unsafe | import | name | scope | column | dtype,
+            "message", "line"} problems, empty when the code looks fine
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [{"kind": "syntax", "message": f"{e.msg}", "line": e.lineno}]
+
+    problems = []
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = (
+                [alias.name for alias in node.names]
+                if isinstance(node, ast.Import)
+                else [node.module or ""]
+            )
+            for module in modules:
+                top = module.split(".")[0]
+                if top in UNSAFE_MODULES:
+                    problems.append(
+                        _problem("unsafe", f"import of {module} is not allowed", node)
+                    )
+                elif top and not _installed(top):
+                    problems.append(
+                        _problem("import", f"module {top} is not installed", node)
+                    )
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in UNSAFE_CALLS:
+                problems.append(
+                    _problem("unsafe", f"{node.func.id}() is not allowed", node)
+                )
+            elif (
+                isinstance(node.func, ast.Attribute)
+                and node.func.attr in IO_CALLS - {"open"}
+                and (node.args or any(k.arg in TARGET_KEYWORDS for k in node.keywords))
+            ):
+                # dff.to_csv() returns the text, with a target it writes a file
+                problems.append(
+                    _problem(
+                        "unsafe",
+                        f"{node.func.attr}() writes outside the session, it is not "
+                        "allowed (without a target it returns the text)",
+                        node,
+                    )
+                )
+            elif (
+                isinstance(node.func, ast.Attribute)
+                and node.func.attr == "open"
+                and isinstance(node.func.value, ast.Name)
+                and node.func.value.id in ("io", "codecs")
+            ):
+                problems.append(
+                    _problem(
+                        "unsafe", f"{node.func.value.id}.open() is not allowed", node
+                    )
+                )
+        elif isinstance(node, ast.Attribute):
+            if node.attr.startswith("__") and node.attr not in SAFE_DUNDERS:
+                problems.append(
+                    _problem("unsafe", f"access to {node.attr} is not allowed", node)
+                )
+
+    known = _bound_names(tree) | set(names) | set(dir(builtins)) | {"dff"}
+    reported = set()
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Name)
+            and isinstance(node.ctx, ast.Load)
+            and node.id not in known
+            and node.id not in reported
+        ):
+            reported.add(node.id)
+            problems.append(
+                _problem(
+                    "name",
+                    f"name {node.id!r} is not defined (missing import?)",
+                    node,
+                )
+            )
+
+    problems += _scope_problems(tree, set(names) | set(dir(builtins)))
+
+    if df is not None:
+        # columns the code creates, wherever it does
+        created = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Store):
+                created.update(_dff_column(node) or [])
+
+        checker = _FrameChecker(set(df.columns), _text_columns(df), created)
+        changed = False
+        for statement in tree.body:
+            if _changes_columns(statement):
+                changed = True
+            if changed:
+                # the functions defined before run after it
+                break
+            checker.visit(statement)
+        if not changed:
+            problems += checker.problems
+        else:
+            # only what ran before the change is certain to fail
+            problems += [
+                p
+                for p in checker.problems
+                if not any(
+                    isinstance(s, (ast.FunctionDef, ast.AsyncFunctionDef))
+                    and s.lineno <= (p["line"] or 0) <= s.end_lineno
+                    for s in tree.body
+                )
+            ]
+
+    return sorted(problems, key=lambda p: p["line"] or 0)
+
+
+def blocking(problems) -> list:
+    """The problems for which the code must not run at all."""
+    return [p for p in problems if p["kind"] in BLOCKING]
+
+
+def format_problems(problems) -> str:
+    """One line per problem, for the repair prompt and the user."""
+    return "\n".join(
+        f"line {p['line']}: {p['message']}" if p["line"] else p["message"]
+        for p in problems
+    )
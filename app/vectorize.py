@@ -0,0 +1,1114 @@
+import re
+import ast
+import copy
+import math
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from code_analysis import parse
+from executor import run_code
+
+# typical speedup of the vectorized version on 100k rows, for the estimate
+PATTERN_SPEEDUP = {
+    "iterrows loop": 100.0,
+    "index loop": 100.0,
+    "apply axis=1": 50.0,
+    "itertuples loop": 10.0,
+    "element apply": 10.0,
+    "value loop": 5.0,
+}
+# rows of the sample the rewritten code is checked on
+CHECK_ROWS = 2000
+# loops the model is asked to vectorize when no rule rewrites them
+ROW_PATTERNS = ("iterrows loop", "itertuples loop", "index loop", "apply axis=1")
+
+# np.<name>(x) / math.<name>(x) on a scalar is np.<name>(series)
+NUMPY_FUNCTIONS = {
+    "abs", "ceil", "cos", "exp", "fabs", "floor", "log", "log10", "log1p", "log2",
+    "sign", "sin", "sqrt", "tan",
+}  # fmt: skip
+# str methods that pandas has under .str
+STR_METHODS = {
+    "capitalize", "endswith", "isalnum", "isalpha", "isdigit", "islower",
+    "isnumeric", "isspace", "isupper", "lower", "lstrip", "rstrip", "startswith",
+    "strip", "swapcase", "title", "upper", "zfill",
+}  # fmt: skip
+PANDAS_NULL_CHECKS = {"isna", "isnull", "notna", "notnull"}
+# calls that return True or False for every value
+PREDICATES = PANDAS_NULL_CHECKS | {
+    name for name in STR_METHODS if name.startswith(("is", "startswith", "endswith"))
+}
+AGGREGATES = {ast.Add: "sum", ast.Sub: "sum", ast.Mult: "prod"}
+
+
+def _expr(source) -> ast.expr:
+    return ast.parse(source, mode="eval").body
+
+
+def _call(func, *args, **keywords) -> ast.Call:
+    return ast.Call(
+        func=_expr(func) if isinstance(func, str) else func,
+        args=list(args),
+        keywords=[ast.keyword(arg=k, value=v) for k, v in keywords.items()],
+    )
+
+
+def _method(obj, name, *args, **keywords) -> ast.Call:
+    return _call(ast.Attribute(value=obj, attr=name, ctx=ast.Load()), *args, **keywords)
+
+
+def _column(frame, name) -> ast.Subscript:
+    return ast.Subscript(
+        value=copy.deepcopy(frame), slice=ast.Constant(name), ctx=ast.Load()
+    )
+
+
+def _no_calls(node) -> bool:
+    # evaluated once per use after the rewrite, it must not do anything
+    return not any(isinstance(n, (ast.Call, ast.NamedExpr)) for n in ast.walk(node))
+
+
+def _frame_name(node):
+    return node.id if isinstance(node, ast.Name) else None
+
+
+class ExprVectorizer:
+    """Turn an expression on one row (or one value) into the same expression on
+    the columns.
+
+    Args:
+        env (dict): name -> ("row", frame) for a row of the frame, or
+            ("value", series) for a value of the series
+        small_ints (set): columns of `dff` with integers narrower than int64. The
+            values of a row are Python ints, the columns are widened so that sums
+            and products do not overflow.
+        bools (set): columns of `dff` with True/False values. not/and/or and if
+            only become ~, &, | and masks on those, on other values they are
+            bitwise operations and label lookups.
+    """
+
+    def __init__(self, env, small_ints=(), bools=()) -> None:
+        self.env = env
+        self.small_ints = small_ints
+        self.bools = bools
+        self.uses = False
+
+    def _widened(self, column):
+        if (
+            isinstance(column.value, ast.Name)
+            and column.value.id == "dff"
+            and column.slice.value in self.small_ints
+        ):
+            return _method(column, "astype", ast.Constant("int64"))
+        return column
+
+    def _refs(self, node) -> bool:
+        return any(isinstance(n, ast.Name) and n.id in self.env for n in ast.walk(node))
+
+    def _dff_column(self, node):
+        """The column of `dff` the node reads for every row, None for the others."""
+        if isinstance(node, ast.Name) and node.id in self.env:
+            kind, source = self.env[node.id]
+            if kind != "value":
+                return None
+        elif isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant):
+            source = self._row(node.value)
+            source = source and _column(source, node.slice.value)
+        elif isinstance(node, ast.Attribute):
+            source = self._row(node.value)
+            source = source and _column(source, node.attr)
+        else:
+            return None
+        if (
+            isinstance(source, ast.Subscript)
+            and isinstance(source.value, ast.Name)
+            and source.value.id == "dff"
+            and isinstance(source.slice, ast.Constant)
+        ):
+            return source.slice.value
+        return None
+
+    def boolean(self, node) -> bool:
+        """Whether the expression is True or False for every row."""
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, bool)
+        if isinstance(node, ast.Compare):
+            return True
+        if isinstance(node, ast.UnaryOp):
+            return isinstance(node.op, ast.Not) and self.boolean(node.operand)
+        if isinstance(node, ast.BoolOp):
+            return all(self.boolean(value) for value in node.values)
+        if isinstance(node, ast.Call):
+            return isinstance(node.func, ast.Attribute) and node.func.attr in PREDICATES
+        return self._dff_column(node) in self.bools
+
+    def _row(self, node):
+        if isinstance(node, ast.Name) and self.env.get(node.id, ("",))[0] == "row":
+            return self.env[node.id][1]
+        return None
+
+    def vectorize(self, node):
+        """The vectorized expression, None when there is no rule for it."""
+        return self.visit(node)
+
+    def _series(self, value):
+        """A series of `value` for every row."""
+        kind, frame = next(iter(self.env.values()))
+        keywords = {
+            "index": ast.Attribute(
+                value=copy.deepcopy(frame), attr="index", ctx=ast.Load()
+            )
+        }
+        if kind == "value":
+            # Series.map and apply keep the name of the series
+            keywords["name"] = ast.Attribute(
+                value=copy.deepcopy(frame), attr="name", ctx=ast.Load()
+            )
+        return _call("pd.Series", value, **keywords)
+
+    def visit(self, node):
+        if not self._refs(node):
+            # the same for every row, it is evaluated once
+            return node
+        method = getattr(self, f"visit_{type(node).__name__}", None)
+        return method(node) if method is not None else None
+
+    def visit_Name(self, node):
+        kind, source = self.env[node.id]
+        if kind != "value":
+            return None
+        self.uses = True
+        source = copy.deepcopy(source)
+        if isinstance(source, ast.Subscript) and isinstance(source.slice, ast.Constant):
+            return self._widened(source)
+        return source
+
+    def visit_Subscript(self, node):
+        frame = self._row(node.value)
+        if frame is None or not isinstance(node.slice, ast.Constant):
+            return None
+        if not isinstance(node.slice.value, str):
+            return None
+        self.uses = True
+        return self._widened(_column(frame, node.slice.value))
+
+    def visit_Attribute(self, node):
+        frame = self._row(node.value)
+        # the label of the row (iterrows .name, itertuples .Index) is not a column
+        if frame is None or node.attr in ("name", "Index", "index"):
+            return None
+        self.uses = True
+        return self._widened(_column(frame, node.attr))
+
+    def visit_BinOp(self, node):
+        left, right = self.visit(node.left), self.visit(node.right)
+        if left is None or right is None:
+            return None
+        return ast.BinOp(left=left, op=node.op, right=right)
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not) and not self.boolean(node.operand):
+            return None
+        operand = self.visit(node.operand)
+        if operand is None or isinstance(node.op, ast.Invert):
+            return None
+        op = ast.Invert() if isinstance(node.op, ast.Not) else node.op
+        return ast.UnaryOp(op=op, operand=operand)
+
+    def visit_BoolOp(self, node):
+        # 2 and 3 is 3, 2 & 3 is 2
+        if not all(self.boolean(value) for value in node.values):
+            return None
+        values = [self.visit(value) for value in node.values]
+        if any(value is None for value in values):
+            return None
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        result = values[0]
+        for value in values[1:]:
+            result = ast.BinOp(left=result, op=op, right=value)
+        return result
+
+    def visit_Compare(self, node):
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            part = self._compare(left, op, right)
+            if part is None:
+                return None
+            parts.append(part)
+            left = right
+        result = parts[0]
+        for part in parts[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=part)
+        return result
+
+    def _compare(self, left, op, right):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if self._refs(left) and not self._refs(right):
+                # value in [...] -> series.isin([...])
+                if not isinstance(right, (ast.List, ast.Tuple, ast.Set)):
+                    return None
+                series = self.visit(left)
+                result = series and _method(
+                    series, "isin", ast.List(elts=right.elts, ctx=ast.Load())
+                )
+            elif self._refs(right) and not self._refs(left):
+                # "text" in value -> series.str.contains("text", regex=False)
+                series = self.visit(right)
+                result = series and _method(
+                    ast.Attribute(value=series, attr="str", ctx=ast.Load()),
+                    "contains",
+                    left,
+                    regex=ast.Constant(False),
+                )
+            else:
+                return None
+            if result is not None and isinstance(op, ast.NotIn):
+                result = ast.UnaryOp(op=ast.Invert(), operand=result)
+            return result
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            return None
+        left, right = self.visit(left), self.visit(right)
+        if left is None or right is None:
+            return None
+        return ast.Compare(left=left, ops=[op], comparators=[right])
+
+    def visit_IfExp(self, node):
+        if not self.boolean(node.test):
+            return None
+        parts = [self.visit(n) for n in (node.test, node.body, node.orelse)]
+        if any(part is None for part in parts):
+            return None
+        test, body, orelse = parts
+        if not self._refs(node.body):
+            body = self._series(body)
+        # np.where would make one dtype of both ('big' if ... else 0 gives '0'),
+        # Series.where keeps the values as they are
+        return _method(body, "where", test, orelse)
+
+    def visit_Call(self, node):
+        if node.keywords or any(isinstance(a, ast.Starred) for a in node.args):
+            return None
+        func = node.func
+
+        if isinstance(func, ast.Name):
+            args = [self.visit(arg) for arg in node.args]
+            if any(arg is None for arg in args):
+                return None
+            name = func.id
+            if name == "abs" and len(args) == 1:
+                return _call("np.abs", *args)
+            if name in ("min", "max") and len(args) == 2:
+                return _call("np.minimum" if name == "min" else "np.maximum", *args)
+            if name in ("float", "int", "str") and len(args) == 1:
+                return _method(args[0], "astype", ast.Name(id=name, ctx=ast.Load()))
+            if name == "round" and len(args) in (1, 2):
+                return _method(args[0], "round", *args[1:])
+            if name == "len" and len(args) == 1:
+                return _method(
+                    ast.Attribute(value=args[0], attr="str", ctx=ast.Load()), "len"
+                )
+            return None
+
+        if not isinstance(func, ast.Attribute):
+            return None
+
+        module = func.value.id if isinstance(func.value, ast.Name) else None
+        if module in ("np", "numpy", "math") and func.attr in NUMPY_FUNCTIONS:
+            args = [self.visit(arg) for arg in node.args]
+            if len(args) != 1 or args[0] is None:
+                return None
+            name = "abs" if func.attr == "fabs" else func.attr
+            return _call(f"np.{name}", *args)
+        if module == "pd" and func.attr in PANDAS_NULL_CHECKS and len(node.args) == 1:
+            arg = self.visit(node.args[0])
+            return arg and _call(f"pd.{func.attr}", arg)
+
+        # value.upper() -> series.str.upper()
+        if any(self._refs(arg) for arg in node.args):
+            return None
+        obj = self.visit(func.value)
+        if obj is None:
+            return None
+        text = ast.Attribute(value=obj, attr="str", ctx=ast.Load())
+        if func.attr in STR_METHODS:
+            return _method(text, func.attr, *node.args)
+        if func.attr == "replace" and len(node.args) == 2:
+            return _method(text, "replace", *node.args, regex=ast.Constant(False))
+        return None
+
+
+def _function_expr(function):
+    """The body of a one argument function as a single expression, for the
+    functions made only of if/elif/else and return."""
+    args = function.args
+    if (
+        len(args.args) != 1
+        or args.vararg
+        or args.kwarg
+        or args.kwonlyargs
+        or args.defaults
+        or function.decorator_list
+    ):
+        return None
+
+    def expression(statements):
+        if (
+            statements
+            and isinstance(statements[0], ast.Expr)
+            and isinstance(statements[0].value, ast.Constant)
+        ):
+            # docstring
+            statements = statements[1:]
+        if not statements:
+            return None
+        first = statements[0]
+        if isinstance(first, ast.Return) and first.value is not None:
+            return first.value
+        if isinstance(first, ast.If):
+            # a branch without a return goes on with the statements after the if
+            body = expression(first.body + statements[1:])
+            orelse = expression(first.orelse + statements[1:])
+            if body is None or orelse is None:
+                return None
+            return ast.IfExp(test=first.test, body=body, orelse=orelse)
+        return None
+
+    return args.args[0].arg, expression(function.body)
+
+
+class Rule:
+    """A rewrite of a slow pattern into a vectorized one.
+
+    `rewrite` gets a node of the `node_type` and returns the node (or statements)
+    that replace it, None to leave it. `examples` are scripts the rule rewrites,
+    `check_rules` runs them before and after the rewrite and compares the results.
+    `counterexamples` are scripts it must leave alone.
+    """
+
+    name = ""
+    node_type = ast.AST
+    # the pattern it rewrites, when the node does not tell (X.apply(f) with a name)
+    pattern = None
+    examples = ()
+    counterexamples = ()
+
+    def rewrite(self, node, context):
+        raise NotImplementedError
+
+
+class RowApplyRule(Rule):
+    """frame.apply(lambda row: <expression of the row>, axis=1), or a function of
+    if/return statements, becomes the expression on the columns."""
+
+    name = "row_apply"
+    node_type = ast.Call
+    pattern = "apply axis=1"
+    examples = (
+        "dff['total'] = dff.apply(lambda row: row['math_score'] + row['reading_score'], axis=1)\n"
+        "print(dff['total'].sum())",
+        "def level(row):\n"
+        "    if row['math_score'] >= 80:\n"
+        "        return 'high'\n"
+        "    elif row['math_score'] >= 50:\n"
+        "        return 'medium'\n"
+        "    return 'low'\n"
+        "dff['level'] = dff.apply(level, axis=1)\n"
+        "print(dff['level'].value_counts())",
+        "dff['passed'] = dff.apply(lambda r: r.math_score > 50 and r.gender == 'female', axis=1)\n"
+        "print(dff['passed'].mean())",
+    )
+    counterexamples = (
+        # not/and/or of numbers are not ~, &, |
+        "dff['none'] = dff.apply(lambda row: not row['math_score'], axis=1)\n"
+        "print(dff['none'].sum())",
+        "dff['both'] = dff.apply(lambda r: r.math_score and r.reading_score, axis=1)\n"
+        "print(dff['both'].sum())",
+    )
+
+    def rewrite(self, node, context):
+        function = context.apply_function(node, axis=True)
+        if function is None or not _no_calls(node.func.value):
+            return None
+        arg, expression = function
+        vectorizer = ExprVectorizer(
+            {arg: ("row", node.func.value)}, context.small_ints, context.bools
+        )
+        result = vectorizer.vectorize(expression)
+        return result if vectorizer.uses else None
+
+
+class ElementApplyRule(Rule):
+    """series.apply(lambda value: ...) and series.map(lambda value: ...) become the
+    expression on the series."""
+
+    name = "element_apply"
+    node_type = ast.Call
+    pattern = "element apply"
+    examples = (
+        "dff['ratio'] = dff['math_score'].apply(lambda x: x / 100 if x > 0 else 0)\n"
+        "print(dff['ratio'].round(4).sum())",
+        "print(dff['reading_score'].map(lambda s: 'pass' if s >= 50 else 'fail')"
+        ".value_counts())",
+        # a string and a number, np.where would make the 0 a '0'
+        "print(dff['math_score'].apply(lambda x: 'top' if x > 90 else 0)"
+        ".value_counts())",
+    )
+    counterexamples = ("print(dff['math_score'].apply(lambda x: 1 if x else 0).sum())",)
+
+    def rewrite(self, node, context):
+        function = context.apply_function(node, axis=False)
+        if function is None or not _no_calls(node.func.value):
+            return None
+        series = node.func.value
+        if (
+            isinstance(series, ast.Subscript)
+            and isinstance(series.value, ast.Name)
+            and series.value.id == "dff"
+            and isinstance(series.slice, ast.Constant)
+            and series.slice.value in context.categories
+        ):
+            return None
+        arg, expression = function
+        vectorizer = ExprVectorizer(
+            {arg: ("value", node.func.value)}, context.small_ints, context.bools
+        )
+        result = vectorizer.vectorize(expression)
+        return result if vectorizer.uses else None
+
+
+class LoopReduceRule(Rule):
+    """A for loop over the rows (iterrows, itertuples, a column or a zip of columns)
+    whose body only adds up (+=, -=, *=), appends to a list or sets a column of the
+    row, optionally under if/else, becomes a vectorized sum, extend or column
+    assignment."""
+
+    name = "loop_reduce"
+    node_type = ast.For
+    examples = (
+        "total = 0\n"
+        "for _, row in dff.iterrows():\n"
+        "    if row['gender'] == 'female':\n"
+        "        total += row['math_score']\n"
+        "print(total)",
+        "count = 0\n"
+        "for row in dff.itertuples():\n"
+        "    if row.math_score > 70:\n"
+        "        count += 1\n"
+        "print(count)",
+        "for i, row in dff.iterrows():\n"
+        "    if row['math_score'] > row['reading_score']:\n"
+        "        dff.loc[i, 'better'] = 'math'\n"
+        "    else:\n"
+        "        dff.loc[i, 'better'] = 'reading'\n"
+        "print(dff['better'].value_counts())",
+        "scores = []\n"
+        "for m, r in zip(dff['math_score'], dff['reading_score']):\n"
+        "    scores.append((m + r) / 2)\n"
+        "print(sum(scores) / len(scores))",
+    )
+    counterexamples = (
+        # the items of the rows under if and else go in the order of the rows
+        "labels = []\n"
+        "for _, row in dff.iterrows():\n"
+        "    if row['math_score'] >= 50:\n"
+        "        labels.append('pass')\n"
+        "    else:\n"
+        "        labels.append('fail')\n"
+        "print(labels[:20])",
+        "values = []\n"
+        "for m, r in zip(dff['math_score'], dff['reading_score']):\n"
+        "    values.append(m)\n"
+        "    values.append(r)\n"
+        "print(values[:20])",
+        # a mask of numbers is a lookup of the labels
+        "for i, row in dff.iterrows():\n"
+        "    if row['math_score']:\n"
+        "        dff.loc[i, 'scored'] = 'yes'\n"
+        "print(dff['scored'].value_counts())",
+    )
+
+    def rewrite(self, node, context):
+        if node.orelse:
+            return None
+        loop = self._loop(node)
+        if loop is None:
+            return None
+        return _LoopBody(*loop, context.small_ints, context.bools).rewrite(node.body)
+
+    def _loop(self, node):
+        target, it = node.target, node.iter
+        if isinstance(it, ast.Call) and isinstance(it.func, ast.Attribute):
+            frame = it.func.value
+            if not _no_calls(frame):
+                return None
+            if (
+                it.func.attr == "iterrows"
+                and not it.args
+                and isinstance(target, ast.Tuple)
+                and len(target.elts) == 2
+                and all(isinstance(e, ast.Name) for e in target.elts)
+            ):
+                index, row = (e.id for e in target.elts)
+                return {row: ("row", frame)}, frame, index
+            if it.func.attr == "itertuples" and isinstance(target, ast.Name):
+                if it.args or any(k.arg == "name" for k in it.keywords):
+                    return None
+                return {target.id: ("row", frame)}, frame, None
+            return None
+
+        if (
+            isinstance(it, ast.Call)
+            and isinstance(it.func, ast.Name)
+            and it.func.id == "zip"
+            and isinstance(target, ast.Tuple)
+            and len(target.elts) == len(it.args)
+            and all(isinstance(e, ast.Name) for e in target.elts)
+            and all(self._column(a) for a in it.args)
+        ):
+            env = {e.id: ("value", a) for e, a in zip(target.elts, it.args)}
+            return env, it.args[0], None
+
+        if isinstance(target, ast.Name) and self._column(it):
+            return {target.id: ("value", it)}, it, None
+        return None
+
+    @staticmethod
+    def _column(node):
+        return (
+            isinstance(node, ast.Subscript)
+            and isinstance(node.value, ast.Name)
+            and isinstance(node.slice, ast.Constant)
+            and isinstance(node.slice.value, str)
+        )
+
+
+class _LoopBody:
+    """Rewrite of the body of a loop over rows, for `LoopReduceRule`."""
+
+    def __init__(self, env, frame, index, small_ints=(), bools=()) -> None:
+        self.env = env
+        self.frame = frame
+        self.index = index
+        self.small_ints = small_ints
+        self.bools = bools
+        self.written = set()
+        self.appended = set()
+
+    def rewrite(self, body):
+        assigned = set()
+        for statement in body:
+            for n in ast.walk(statement):
+                if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+                    assigned.add(n.id)
+                elif (
+                    isinstance(n, ast.Subscript)
+                    and isinstance(n.ctx, ast.Store)
+                    and isinstance(n.slice, ast.Tuple)
+                    and n.slice.elts
+                    and isinstance(n.slice.elts[-1], ast.Constant)
+                ):
+                    self.written.add(n.slice.elts[-1].value)
+        return self._statements(body, None, assigned) or None
+
+    def _vector(self, node, assigned):
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and (n.id in assigned or n.id == self.index):
+                # depends on what the loop changes, or on the label of the row
+                return None, False
+            if (
+                isinstance(n, ast.Subscript)
+                and isinstance(n.slice, ast.Constant)
+                and n.slice.value in self.written
+            ) or (isinstance(n, ast.Attribute) and n.attr in self.written):
+                # the row is a copy taken before the loop set the column
+                return None, False
+        vectorizer = ExprVectorizer(self.env, self.small_ints, self.bools)
+        result = vectorizer.vectorize(node)
+        return result, vectorizer.uses
+
+    def _boolean(self, node):
+        return ExprVectorizer(self.env, self.small_ints, self.bools).boolean(node)
+
+    def _count(self, mask):
+        if mask is None:
+            return _call("len", copy.deepcopy(self.frame))
+        return _call("int", _method(copy.deepcopy(mask), "sum"))
+
+    def _selected(self, series, mask):
+        if mask is None:
+            return series
+        return ast.Subscript(value=series, slice=copy.deepcopy(mask), ctx=ast.Load())
+
+    def _statements(self, body, mask, assigned):
+        out = []
+        for statement in body:
+            if isinstance(statement, ast.Pass):
+                continue
+            if isinstance(statement, ast.If):
+                if not self._boolean(statement.test):
+                    # a mask of other values selects rows by label
+                    return None
+                test, uses = self._vector(statement.test, assigned)
+                if test is None or not uses:
+                    return None
+                inner = test if mask is None else _and(mask, test)
+                negated = ast.UnaryOp(op=ast.Invert(), operand=copy.deepcopy(test))
+                outer = negated if mask is None else _and(mask, negated)
+                then = self._statements(statement.body, inner, assigned)
+                orelse = self._statements(statement.orelse, outer, assigned)
+                if then is None or orelse is None:
+                    return None
+                out += then + orelse
+                continue
+
+            rewritten = self._statement(statement, mask, assigned)
+            if rewritten is None:
+                return None
+            out.append(rewritten)
+        return out
+
+    def _statement(self, statement, mask, assigned):
+        # total += <expression>
+        if (
+            isinstance(statement, ast.AugAssign)
+            and isinstance(statement.target, ast.Name)
+            and type(statement.op) in AGGREGATES
+        ):
+            value, uses = self._vector(statement.value, assigned)
+            if value is None:
+                return None
+            if uses:
+                # the loop adds the NaN of a row, so does the sum
+                total = _method(
+                    self._selected(value, mask),
+                    AGGREGATES[type(statement.op)],
+                    skipna=ast.Constant(False),
+                )
+            elif isinstance(statement.op, ast.Mult):
+                return None
+            else:
+                total = ast.BinOp(left=value, op=ast.Mult(), right=self._count(mask))
+            return ast.AugAssign(target=statement.target, op=statement.op, value=total)
+
+        # values.append(<expression>)
+        if (
+            isinstance(statement, ast.Expr)
+            and isinstance(statement.value, ast.Call)
+            and isinstance(statement.value.func, ast.Attribute)
+            and statement.value.func.attr == "append"
+            and isinstance(statement.value.func.value, ast.Name)
+            and len(statement.value.args) == 1
+            and not statement.value.keywords
+        ):
+            name = statement.value.func.value.id
+            if mask is not None or name in self.appended:
+                # the extends would put the items of a row after the other rows
+                return None
+            self.appended.add(name)
+            value, uses = self._vector(statement.value.args[0], assigned)
+            if value is None:
+                return None
+            if uses:
+                items = _method(self._selected(value, mask), "tolist")
+            else:
+                items = ast.BinOp(
+                    left=ast.List(elts=[value], ctx=ast.Load()),
+                    op=ast.Mult(),
+                    right=self._count(mask),
+                )
+            return ast.Expr(_method(statement.value.func.value, "extend", items))
+
+        # frame.loc[index, "column"] = <expression>
+        if (
+            isinstance(statement, ast.Assign)
+            and len(statement.targets) == 1
+            and self.index is not None
+        ):
+            target = statement.targets[0]
+            frame = _frame_name(self.frame)
+            if not (
+                isinstance(target, ast.Subscript)
+                and isinstance(target.value, ast.Attribute)
+                and target.value.attr in ("loc", "at")
+                and frame is not None
+                and _frame_name(target.value.value) == frame
+                and isinstance(target.slice, ast.Tuple)
+                and len(target.slice.elts) == 2
+                and isinstance(target.slice.elts[0], ast.Name)
+                and target.slice.elts[0].id == self.index
+                and isinstance(target.slice.elts[1], ast.Constant)
+            ):
+                return None
+            value, uses = self._vector(statement.value, assigned)
+            if value is None:
+                return None
+            column = target.slice.elts[1]
+            if mask is None:
+                store = ast.Subscript(
+                    value=ast.Name(id=frame, ctx=ast.Load()),
+                    slice=column,
+                    ctx=ast.Store(),
+                )
+            else:
+                store = ast.Subscript(
+                    value=ast.Attribute(
+                        value=ast.Name(id=frame, ctx=ast.Load()),
+                        attr="loc",
+                        ctx=ast.Load(),
+                    ),
+                    slice=ast.Tuple(elts=[copy.deepcopy(mask), column], ctx=ast.Load()),
+                    ctx=ast.Store(),
+                )
+                if uses:
+                    value = self._selected(value, mask)
+            return ast.Assign(targets=[store], value=value)
+
+        return None
+
+
+def _and(left, right):
+    return ast.BinOp(left=copy.deepcopy(left), op=ast.BitAnd(), right=right)
+
+
+RULES = [RowApplyRule(), ElementApplyRule(), LoopReduceRule()]
+
+
+def _pattern(node):
+    """The slow pattern of the node, None when it is not one."""
+    if isinstance(node, ast.For):
+        it = node.iter
+        if isinstance(it, ast.Call) and isinstance(it.func, ast.Attribute):
+            if it.func.attr == "iterrows":
+                return "iterrows loop"
+            if it.func.attr == "itertuples":
+                return "itertuples loop"
+        if (
+            isinstance(it, ast.Call)
+            and isinstance(it.func, ast.Name)
+            and it.func.id == "range"
+            and len(it.args) == 1
+        ):
+            bound = ast.unparse(it.args[0])
+            if re.match(r"len\(\w+\)$|\w+\.shape\[0\]$", bound):
+                return "index loop"
+        if LoopReduceRule._column(it) or (
+            isinstance(it, ast.Call)
+            and isinstance(it.func, ast.Name)
+            and it.func.id == "zip"
+            and it.args
+            and all(LoopReduceRule._column(a) for a in it.args)
+        ):
+            return "value loop"
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr in ("apply", "map")
+        and node.args
+    ):
+        if _axis(node) in (1, "columns"):
+            return "apply axis=1"
+        if _axis(node) is None and isinstance(node.args[0], ast.Lambda):
+            return "element apply"
+    return None
+
+
+def _axis(node):
+    for keyword in node.keywords:
+        if keyword.arg == "axis" and isinstance(keyword.value, ast.Constant):
+            return keyword.value.value
+    return None
+
+
+class _Context:
+    """What the rules need to know about the whole script."""
+
+    def __init__(self, tree, df=None) -> None:
+        # one argument functions made of if/return, by name
+        self.functions = {
+            node.name: _function_expr(node)
+            for node in tree.body
+            if isinstance(node, ast.FunctionDef)
+        }
+        self.small_ints = set()
+        self.categories = set()
+        self.bools = set()
+        if df is not None:
+            # .map on a categorical only maps the categories, it is fast already
+            self.categories = {
+                col
+                for col, dtype in df.dtypes.items()
+                if isinstance(dtype, pd.CategoricalDtype)
+            }
+            self.small_ints = {
+                col
+                for col, dtype in df.dtypes.items()
+                if isinstance(dtype, np.dtype)
+                and dtype.kind in "iu"
+                and dtype.itemsize < 8
+            }
+            self.bools = {
+                col
+                for col, dtype in df.dtypes.items()
+                if pd.api.types.is_bool_dtype(dtype)
+            }
+
+    def apply_function(self, node, axis):
+        """(argument, expression) of X.apply(f, axis=1) when `axis`, of
+        X.apply(f) / X.map(f) otherwise."""
+        if not (
+            isinstance(node.func, ast.Attribute)
+            and node.func.attr in ("apply", "map")
+            and len(node.args) == 1
+        ):
+            return None
+        if axis:
+            if node.func.attr != "apply" or _axis(node) not in (1, "columns"):
+                return None
+            if len(node.keywords) != 1:
+                return None
+        elif node.keywords:
+            return None
+
+        function = node.args[0]
+        if isinstance(function, ast.Lambda):
+            args = function.args
+            if len(args.args) != 1 or args.vararg or args.kwarg or args.defaults:
+                return None
+            return args.args[0].arg, function.body
+        if isinstance(function, ast.Name):
+            found = self.functions.get(function.id)
+            if found is not None and found[1] is not None:
+                return found
+        return None
+
+
+class _Rewriter(ast.NodeTransformer):
+
+    def __init__(self, rules, context) -> None:
+        self.rules = rules
+        self.context = context
+        self.applied = []
+
+    def _apply(self, node):
+        pattern = _pattern(node)
+        for rule in self.rules:
+            if not isinstance(node, rule.node_type):
+                continue
+            rewritten = rule.rewrite(node, self.context)
+            if rewritten is not None:
+                self.applied.append(
+                    {
+                        "line": node.lineno,
+                        "pattern": pattern or rule.pattern,
+                        "rule": rule.name,
+                    }
+                )
+                return rewritten
+        return None
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        return self._apply(node) or node
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        return self._apply(node) or node
+
+
+def analyze(code, df=None, rules=None) -> dict:
+    """Find the row wise loops of the code and rewrite the ones a rule knows.
+
+    Args:
+        code (str): python code
+        df (pd.DataFrame): the frame the code runs on, for the dtypes
+        rules (list): `Rule` objects, `RULES` by default
+
+    Returns:
+        dict: {"findings": [{"line", "pattern", "rule", "estimated_speedup"}],
+            "code": the rewritten code, None when nothing was rewritten,
+            "estimated_speedup": of the slowest loop rewritten}
+    """
+    tree = parse(code)
+    if tree is None:
+        return {"findings": [], "code": None, "estimated_speedup": 1.0}
+
+    findings = {}
+    for node in ast.walk(tree):
+        pattern = _pattern(node)
+        if pattern is not None:
+            findings[(node.lineno, pattern)] = {
+                "line": node.lineno,
+                "pattern": pattern,
+                "rule": None,
+                "estimated_speedup": PATTERN_SPEEDUP[pattern],
+            }
+    if not findings:
+        return {"findings": [], "code": None, "estimated_speedup": 1.0}
+
+    rewriter = _Rewriter(RULES if rules is None else rules, _Context(tree, df))
+    new_tree = ast.fix_missing_locations(rewriter.visit(copy.deepcopy(tree)))
+    for applied in rewriter.applied:
+        finding = findings.setdefault(
+            (applied["line"], applied["pattern"]),
+            {
+                **applied,
+                "estimated_speedup": PATTERN_SPEEDUP.get(applied["pattern"], 1.0),
+            },
+        )
+        finding["rule"] = applied["rule"]
+
+    findings = sorted(findings.values(), key=lambda f: f["line"])
+    rewritten = [f for f in findings if f["rule"] is not None]
+    return {
+        "findings": findings,
+        "code": ast.unparse(new_tree) if rewriter.applied else None,
+        "estimated_speedup": max(
+            (f["estimated_speedup"] for f in rewritten), default=1.0
+        ),
+    }
+
+
+def remaining_loops(findings) -> list:
+    """The row loops no rule rewrote, as problems for the model (see
+    `validation.format_problems`)."""
+    return [
+        {
+            "line": finding["line"],
+            "kind": "loop",
+            "message": f"{finding['pattern']} goes over the rows one by one in "
+            "Python. Use vectorized pandas or NumPy operations on whole columns.",
+        }
+        for finding in findings
+        if finding["rule"] is None and finding["pattern"] in ROW_PATTERNS
+    ]
+
+
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:e[-+]?\d+)?")
+
+
+def same_output(a, b, rel_tol=1e-6) -> bool:
+    """Printed outputs with the same text and the same numbers, up to float
+    rounding (10 and 10.0 are the same)."""
+    if _NUMBER.sub("#", a) != _NUMBER.sub("#", b):
+        return False
+    return all(
+        math.isclose(float(x), float(y), rel_tol=rel_tol, abs_tol=1e-9)
+        for x, y in zip(_NUMBER.findall(a), _NUMBER.findall(b))
+    )
+
+
+def same_frame(a, b) -> bool:
+    try:
+        pd.testing.assert_frame_equal(
+            a, b, check_dtype=False, check_exact=False, rtol=1e-6
+        )
+    except (AssertionError, TypeError, ValueError):
+        return False
+    return True
+
+
+def _run_copy(code, df, namespace):
+    return run_code(code, df.copy(deep=False), namespace)
+
+
+def compare_runs(original, rewritten, df, namespace=None, run=None) -> dict:
+    """Run both versions on copies of `df` and compare what they print, the
+    figures they make and the frame they leave.
+
+    `run(code, df, namespace)` runs them, `executor.run_code` on a shallow copy by
+    default; the agent passes its worker processes when it has them.
+
+    Returns:
+        dict: {"equivalent": bool, "original_seconds", "rewritten_seconds",
+            "measured_speedup"}
+    """
+    run = run or _run_copy
+    start = time.perf_counter()
+    run_a, frame_a = run(original, df, namespace)
+    middle = time.perf_counter()
+    run_b, frame_b = run(rewritten, df, namespace)
+    end = time.perf_counter()
+
+    equivalent = (
+        "output" in run_a
+        and "output" in run_b
+        and same_output(run_a["output"], run_b["output"])
+        and len(run_a.get("figures", [])) == len(run_b.get("figures", []))
+        and same_frame(frame_a, frame_b)
+    )
+    return {
+        "equivalent": equivalent,
+        "original_seconds": middle - start,
+        "rewritten_seconds": end - middle,
+        "measured_speedup": (middle - start) / max(end - middle, 1e-9),
+    }
+
+
+def check_rules(df, rules=None) -> list:
+    """Rewrite the examples of every rule and check the results are the same as
+    the ones of the loops, on `df`. The counterexamples are checked to be left
+    alone."""
+    results = []
+    for rule in RULES if rules is None else rules:
+        examples = [(example, False) for example in rule.examples]
+        examples += [(example, True) for example in rule.counterexamples]
+        for example, counterexample in examples:
+            analysis = analyze(example, df, [rule])
+            result = {
+                "rule": rule.name,
+                "example": example,
+                "counterexample": counterexample,
+                "rewritten": False,
+            }
+            if analysis["code"] is not None:
+                result["rewritten"] = True
+                result["code"] = analysis["code"]
+                result.update(compare_runs(example, analysis["code"], df))
+            results.append(result)
+    return results
+
+
+def main():
+    parser = ArgumentParser(
+        prog="vectorize", description="Check the rewrites of the loop rules"
+    )
+    parser.add_argument(
+        "filename",
+        nargs="?",
+        default="./app/data/student-perf.csv",
+        help="Table with the columns of the examples",
+    )
+    parser.add_argument("--rows", type=int, help="Repeat the table up to N rows")
+    args = parser.parse_args()
+
+    from ingest import load_table
+
+    df, _ = load_table(args.filename)
+    df.columns = [re.sub(r"\W+", "_", str(col)) for col in df.columns]
+    if args.rows:
+        df = pd.concat([df] * (args.rows // len(df) + 1), ignore_index=True)
+        df = df.iloc[: args.rows]
+
+    failed = 0
+    for result in check_rules(df):
+        if result["counterexample"]:
+            ok = not result["rewritten"]
+        else:
+            ok = result["rewritten"] and result["equivalent"]
+        failed += not ok
+        detail = (
+            f"{result['measured_speedup']:.1f}x"
+            if result["rewritten"]
+            else "no rewrite"
+        )
+        print(f"{'ok  ' if ok else 'FAIL'} {result['rule']:<14} {detail:>10}")
+        print("  " + result["example"].replace("\n", "\n  "))
+        if result["rewritten"]:
+            print("  ->\n  " + result["code"].replace("\n", "\n  "))
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
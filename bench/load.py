@@ -0,0 +1,121 @@
+"""Load test of the async agents: many sessions in one process, one event loop.
+
+python bench/load.py --sessions 1 10 50 --questions 5 --latency 0.5
+"""
+
+import json
+import time
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from argparse import ArgumentParser
+
+from replay import ReplayAgent, load_responses
+from ingest import load_table
+from telemetry import Telemetry
+from run import DATASETS, RESULTS, dataset_path, git_commit, percentiles
+
+
+async def session(df, responses, args, telemetry, latencies, errors):
+    """One user asking the questions one after the other, with an agent of its own."""
+    agent = ReplayAgent(
+        df,
+        responses,
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        save_plot=True,
+        telemetry=telemetry,
+    )
+    for rec in responses:
+        asked = time.perf_counter()
+        if args.stream:
+            resp = None
+            async for event in agent.generate_content_stream_async(rec["question"]):
+                if event["type"] == "result":
+                    resp = event["result"]
+        else:
+            resp = await agent.generate_content_async(rec["question"])
+        latencies.append(time.perf_counter() - asked)
+        if resp is None or "exception" in resp.get("code_run", {}):
+            errors.append(rec["question"])
+
+
+async def load(df, responses, sessions, args) -> dict:
+    telemetry = Telemetry()
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            session(df, responses, args, telemetry, latencies, errors)
+            for _ in range(sessions)
+        )
+    )
+    wall = time.perf_counter() - start
+    return {
+        "sessions": sessions,
+        "questions": len(latencies),
+        "seconds": wall,
+        "throughput_qps": len(latencies) / wall,
+        "latency": percentiles(latencies),
+        "stages": {
+            stage["stage"]: {k: float(v) for k, v in stage.items() if k != "stage"}
+            for stage in telemetry.summary()
+        },
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = ArgumentParser(prog="load", description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--questions", type=int, default=5, help="Questions asked by every session"
+    )
+    parser.add_argument("--dataset", choices=DATASETS, default="student")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--output", help="Result file, by default in bench/results")
+    args = parser.parse_args()
+
+    df, _ = load_table(dataset_path(args.dataset))
+    responses = load_responses(**DATASETS[args.dataset]["columns"])[: args.questions]
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "settings": {
+            key: getattr(args, key)
+            for key in (
+                "dataset",
+                "questions",
+                "latency",
+                "tokens_per_second",
+                "stream",
+            )
+        },
+        "levels": [],
+    }
+    for sessions in args.sessions:
+        result = asyncio.run(load(df, responses, sessions, args))
+        results["levels"].append(result)
+        print(
+            f"{sessions} sessions: {result['questions']} questions in "
+            f"{result['seconds']:.2f}s, {result['throughput_qps']:.1f}/s, "
+            f"p50 {result['latency']['p50']:.3f}s p95 {result['latency']['p95']:.3f}s, "
+            f"{result['errors']} errors"
+        )
+
+    path = Path(
+        args.output
+        or RESULTS
+        / f"load-{results['date'].replace(':', '-')}-{results['commit']['sha']}.json"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved in {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import asyncio
+from string import Template
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from reason_agents import DfBaseAgent
+from history import count_tokens
+
+RESPONSES = Path(__file__).with_name("responses.json")
+
+
+def load_responses(path=RESPONSES, **columns) -> list:
+    """Recorded questions and answers, with $num, $cat and $drop replaced by the
+    columns of the dataset."""
+    with open(path) as f:
+        records = json.load(f)
+    return [
+        {key: Template(value).safe_substitute(columns) for key, value in rec.items()}
+        for rec in records
+    ]
+
+
+class ReplayAgent(DfBaseAgent):
+    """Agent whose provider replays recorded responses, for benchmarks without an
+    API key or a bill.
+
+    The response is the recorded one whose question starts the prompt. The call
+    takes `latency` seconds plus the time to generate the answer at
+    `tokens_per_second`; streaming spreads that time over the chunks.
+
+    Args:
+        responses (list): {"question", "answer", "explanation"} records
+        latency (float): seconds before the first token
+        tokens_per_second (float): generation speed, 0 for instant answers
+    """
+
+    def __init__(
+        self, df, responses, latency=0.0, tokens_per_second=0.0, **kwargs
+    ) -> None:
+        self.responses = responses
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        super().__init__(df, api_key="", model="replay", **kwargs)
+
+    def _create_client(self, api_key):
+        pass
+
+    def _reply(self, prompt) -> str:
+        for rec in self.responses:
+            if prompt.startswith(f"Question: {rec['question']}."):
+                text = json.dumps(
+                    {"answer": rec["answer"], "explanation": rec["explanation"]}
+                )
+                break
+        else:
+            text = json.dumps({"answer": "no code", "explanation": "not recorded"})
+
+        self.usage = {
+            "prompt_tokens": count_tokens(self.system_instruction + prompt),
+            "completion_tokens": count_tokens(text),
+        }
+        return text
+
+    def _generation_seconds(self, text) -> float:
+        if not self.tokens_per_second:
+            return 0.0
+        return count_tokens(text) / self.tokens_per_second
+
+    def _complete(self, prompt):
+        text = self._reply(prompt)
+        time.sleep(self.latency + self._generation_seconds(text))
+        return text
+
+    async def _complete_async(self, prompt):
+        text = self._reply(prompt)
+        await asyncio.sleep(self.latency + self._generation_seconds(text))
+        return text
+
+    async def _stream_async(self, prompt, chunk_size=16):
+        text = self._reply(prompt)
+        await asyncio.sleep(self.latency)
+        for start in range(0, len(text), chunk_size):
+            chunk = text[start : start + chunk_size]
+            await asyncio.sleep(self._generation_seconds(chunk))
+            yield chunk
+
+    def _stream(self, prompt, chunk_size=16):
+        text = self._reply(prompt)
+        time.sleep(self.latency)
+        for start in range(0, len(text), chunk_size):
+            chunk = text[start : start + chunk_size]
+            time.sleep(self._generation_seconds(chunk))
+            yield chunk
@@ -0,0 +1,284 @@
+"""End-to-end benchmark of the agent pipeline with a replaying provider.
+
+Every dataset runs in its own process, so the peak memory is its own:
+
+    python bench/run.py --datasets student 1m --latency 0.2
+    python bench/run.py --compare bench/results/<older>.json
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from argparse import ArgumentParser, SUPPRESS
+import numpy as np
+
+from replay import ReplayAgent, load_responses
+from ingest import load_table, synthetic_csv
+from telemetry import Telemetry
+from intents import default_matcher
+
+ROOT = Path(__file__).resolve().parents[1]
+RESULTS = Path(__file__).with_name("results")
+
+# the columns the recorded answers use, after the names are cleaned
+DATASETS = {
+    "student": {
+        "path": ROOT / "app" / "data" / "student-perf.csv",
+        "columns": {"num": "math_score", "cat": "gender", "drop": "lunch"},
+    },
+    "1m": {
+        "rows": 1_000_000,
+        "columns": {"num": "value", "cat": "group", "drop": "label"},
+    },
+    "10m": {
+        "rows": 10_000_000,
+        "columns": {"num": "value", "cat": "group", "drop": "label"},
+    },
+}
+
+
+def dataset_path(name) -> Path:
+    spec = DATASETS[name]
+    if "path" in spec:
+        return spec["path"]
+    # the same file `python ./app/ingest.py --synthetic N` writes
+    path = ROOT / "app" / "cache" / f"synthetic-{spec['rows']}.csv"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        synthetic_csv(path, spec["rows"])
+    return path
+
+
+def percentiles(values) -> dict:
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {}
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "mean": float(values.mean()),
+        "max": float(values.max()),
+    }
+
+
+def run_dataset(name, args) -> dict:
+    """Ask the recorded questions about one dataset and measure every stage."""
+    df, report = load_table(dataset_path(name))
+    responses = load_responses(**DATASETS[name]["columns"])
+    telemetry = Telemetry()
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    for repeat in range(args.repeat):
+        # a fresh agent per round, the data changes along the questions
+        agent = ReplayAgent(
+            df,
+            responses,
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second,
+            save_plot=True,
+            telemetry=telemetry,
+            execution_mode=args.execution,
+            intents=default_matcher() if args.local else None,
+        )
+        for rec in responses:
+            asked = time.perf_counter()
+            with telemetry.trace("answer", question=rec["question"]):
+                if args.stream:
+                    resp = None
+                    for event in agent.generate_content_stream(rec["question"]):
+                        if event["type"] == "result":
+                            resp = event["result"]
+                else:
+                    resp = agent.generate_content(rec["question"])
+                if resp and resp.get("pending"):
+                    resp = agent.run_pending()
+
+                # what st.plotly_chart does with the figures
+                with telemetry.span("render"):
+                    for figure in (resp or {}).get("code_run", {}).get("figures", []):
+                        if figure["kind"] == "plotly":
+                            figure["figure"].to_json()
+            latencies.append(time.perf_counter() - asked)
+
+            code_run = (resp or {}).get("code_run", {})
+            if resp is None or "exception" in code_run:
+                errors.append(
+                    {
+                        "question": rec["question"],
+                        "error": code_run.get("exception", "no response"),
+                    }
+                )
+    wall = time.perf_counter() - start
+
+    return {
+        "rows": report["rows"],
+        "load_seconds": report["load_seconds"],
+        "memory_mb": report["memory_mb"],
+        # ru_maxrss is in KB on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "questions": len(latencies),
+        "seconds": wall,
+        "throughput_qps": len(latencies) / wall,
+        "latency": percentiles(latencies),
+        "stages": {
+            stage["stage"]: {k: float(v) for k, v in stage.items() if k != "stage"}
+            for stage in telemetry.summary()
+        },
+        "counters": telemetry.totals(),
+        "errors": errors,
+    }
+
+
+def git_commit() -> dict:
+    def git(*cmd):
+        return subprocess.run(
+            ["git", *cmd], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "sha": git("rev-parse", "--short", "HEAD") or "unknown",
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def compare(old, new) -> None:
+    """Print the change of the latencies between two result files."""
+    print(f"{old['commit']['sha']} -> {new['commit']['sha']}")
+    for name, result in new["datasets"].items():
+        before = old["datasets"].get(name)
+        if before is None:
+            continue
+        print(f"\n{name}")
+        rows = [("total", before["latency"], result["latency"])] + [
+            (stage, before["stages"].get(stage, {}), values)
+            for stage, values in result["stages"].items()
+        ]
+        for label, a, b in rows:
+            if not a or not b:
+                continue
+            change = (b["p50"] - a["p50"]) / a["p50"] * 100 if a["p50"] else 0.0
+            print(
+                f"  {label:<15} p50 {a['p50']:.4f}s -> {b['p50']:.4f}s ({change:+.1f}%)"
+                f"  p95 {a['p95']:.4f}s -> {b['p95']:.4f}s"
+            )
+        print(
+            f"  peak memory     {before['peak_rss_mb']:.0f} MB -> "
+            f"{result['peak_rss_mb']:.0f} MB"
+        )
+
+
+def main():
+    parser = ArgumentParser(prog="bench", description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--datasets", nargs="+", choices=DATASETS, default=["student", "1m"]
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds before the first token"
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=0.0,
+        help="Simulated generation speed, 0 for instant answers",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--execution", choices=("full", "sample_first", "confirm"), default="full"
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Answer the common questions from the local templates",
+    )
+    parser.add_argument("--output", help="Result file, by default in bench/results")
+    parser.add_argument("--compare", help="Older result file to compare with")
+    parser.add_argument("--worker", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # one dataset, in a process of its own
+        name, output = args.worker.split(":", 1)
+        with open(output, "w") as f:
+            json.dump(run_dataset(name, args), f)
+        return
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "settings": {
+            key: getattr(args, key)
+            for key in (
+                "latency",
+                "tokens_per_second",
+                "repeat",
+                "stream",
+                "execution",
+                "local",
+            )
+        },
+        "datasets": {},
+    }
+
+    for name in args.datasets:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            output = tmp.name
+        try:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    *sys.argv[1:],
+                    "--worker",
+                    f"{name}:{output}",
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            with open(output) as f:
+                result = json.load(f)
+        finally:
+            os.unlink(output)
+
+        results["datasets"][name] = result
+        print(
+            f"{name}: {result['rows']} rows, {result['questions']} questions in "
+            f"{result['seconds']:.2f}s ({result['throughput_qps']:.1f}/s), "
+            f"p50 {result['latency']['p50']:.4f}s p95 {result['latency']['p95']:.4f}s, "
+            f"peak {result['peak_rss_mb']:.0f} MB, {len(result['errors'])} errors"
+        )
+        local = result["counters"].get("local_answers", 0)
+        if args.local:
+            answered = result["stages"].get("local_answer", {})
+            print(
+                f"  answered locally: {local:.0f} of {result['questions']} "
+                f"({local / result['questions']:.0%}), "
+                f"p50 {answered.get('p50', 0):.4f}s p95 {answered.get('p95', 0):.4f}s"
+            )
+
+    path = Path(
+        args.output
+        or RESULTS
+        / f"{results['date'].replace(':', '-')}-{results['commit']['sha']}.json"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved in {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()